@@ -0,0 +1,58 @@
+"""
+PostgreSQL backend that takes its connections from a per-process pool.
+
+Under ASGI, Django runs each request's sync code in a thread of its own and
+persistent connections (``CONN_MAX_AGE``) stay with the thread that opened
+them, so they are never reused and pile up. With this backend ``close()``
+gives the connection back to the pool instead, and the next thread to
+connect takes it from there. Use it with ``CONN_MAX_AGE = 0``; the pool is
+what keeps connections open between requests.
+
+Pool settings go in the database's ``POOL`` dict, see ``pool.ConnectionPool``::
+
+    'POOL': {'MAX_SIZE': 10, 'TIMEOUT': 10, 'MAX_IDLE': 300, 'CHECK_AFTER': 30}
+"""
+from django.db.backends.postgresql import base, creation
+
+from .pool import close_pools, get_pool
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # Postgres refuses to drop a database that has open connections.
+        close_pools(test_database_name)
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = None
+
+    def get_pool(self, conn_params):
+        options = self.settings_dict.get('POOL', {})
+        key = (conn_params.get('dbname'), repr(sorted(conn_params.items())))
+        return get_pool(
+            key,
+            max_size=options.get('MAX_SIZE', 10),
+            timeout=options.get('TIMEOUT', 10.0),
+            max_idle=options.get('MAX_IDLE', 300.0),
+            check_after=options.get('CHECK_AFTER', 30.0),
+        )
+
+    def get_new_connection(self, conn_params):
+        self.pool = self.get_pool(conn_params)
+        return self.pool.getconn(lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+
+    def _close(self):
+        if self.connection is None:
+            return
+        with self.wrap_database_errors:
+            if self.in_atomic_block:
+                # close() keeps a reference to a connection closed inside
+                # atomic(), so it must not be handed to another thread.
+                self.pool.discard(self.connection)
+            else:
+                self.pool.putconn(self.connection)
@@ -0,0 +1,151 @@
+"""
+A bounded pool of psycopg2 connections, shared by the threads of a worker.
+
+At most ``max_size`` connections are open at a time, counting both those in
+use and those idle in the pool. A thread that needs a connection while all of
+them are in use waits up to ``timeout`` seconds for one to be returned.
+Idle connections are handed out most recently used first, so under light
+load the same few stay warm and the rest age out after ``max_idle`` seconds.
+A connection idle for longer than ``check_after`` seconds is checked with
+``SELECT 1`` before it is handed out; one that fails is replaced.
+"""
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extensions
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, max_size=10, timeout=10.0, max_idle=300.0, check_after=30.0):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self._slots = threading.BoundedSemaphore(max_size)
+        # (connection, returned_at) pairs, most recently returned last.
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def getconn(self, connect):
+        """An idle connection, or a new one made by calling ``connect()``."""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(
+                f'No database connection became free within {self.timeout}s; '
+                f'all {self.max_size} connections of the pool are in use.'
+            )
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    connection, returned_at = self._idle.pop()
+                idle = time.monotonic() - returned_at
+                if idle < self.max_idle and (idle < self.check_after or self._is_usable(connection)):
+                    return connection
+                self._close(connection)
+            return connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, connection):
+        """Give back a connection taken with ``getconn``."""
+        try:
+            if self._reset(connection):
+                with self._lock:
+                    self._idle.append((connection, time.monotonic()))
+                    expired = self._expire()
+                for old in expired:
+                    self._close(old)
+            else:
+                self._close(connection)
+        finally:
+            self._slots.release()
+
+    def discard(self, connection):
+        """Give back a connection taken with ``getconn`` that must not be reused."""
+        try:
+            self._close(connection)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Close the idle connections. Connections in use are closed when given back."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._close(connection)
+
+    def stats(self):
+        with self._lock:
+            idle = len(self._idle)
+        return {'max_size': self.max_size, 'idle': idle}
+
+    def _expire(self):
+        # The oldest connections are at the front; called with the lock held.
+        deadline = time.monotonic() - self.max_idle
+        count = 0
+        while count < len(self._idle) and self._idle[count][1] < deadline:
+            count += 1
+        expired = [connection for connection, _ in self._idle[:count]]
+        del self._idle[:count]
+        return expired
+
+    def _reset(self, connection):
+        """Roll back whatever the last user left open; False if the connection is broken."""
+        if connection.closed:
+            return False
+        status = connection.info.transaction_status
+        if status == extensions.TRANSACTION_STATUS_IDLE:
+            return True
+        if status in (extensions.TRANSACTION_STATUS_INTRANS, extensions.TRANSACTION_STATUS_INERROR):
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                return False
+            return True
+        # A query is still running or the server is gone.
+        return False
+
+    def _is_usable(self, connection):
+        if connection.closed:
+            return False
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            if not connection.autocommit:
+                connection.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key, **options):
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(**options)
+        return pool
+
+
+def close_pools(dbname=None):
+    """Close the idle connections of every pool, or of the pools for ``dbname``."""
+    with _pools_lock:
+        pools = [pool for (name, _), pool in _pools.items() if dbname is None or name == dbname]
+    for pool in pools:
+        pool.close()
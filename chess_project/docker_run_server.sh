@@ -1,2 +1,4 @@
 #!/bin/sh
-python3 manage.py runserver 0.0.0.0:80
+set -e
+python3 manage.py migrate --noinput
+python3 manage.py sync_presence
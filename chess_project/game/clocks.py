@@ -0,0 +1,228 @@
+"""
+Server-side chess clocks.
+
+A timed game stores what was left on each clock when the current turn began
+and the moment the player to move runs out of time, ``clock_deadline``.
+Making a move charges the time since the turn began to the mover, adds the
+increment and moves the deadline to the opponent's, so a running clock
+costs nothing between moves. No clock runs until white's first move, which
+is free, so neither player loses time before both have the board open.
+
+Flag fall is found by one hashed timer wheel per worker rather than one
+asyncio task per game: the wheel ticks ``tick`` times a second and each tick
+looks only at the timers hashed to its slot, so tens of thousands of clocks
+cost a dict entry each and a handful of dict lookups per tick. Every move
+reschedules its game's timer. When a timer fires, a game whose player to
+move is out of time is ended the way resigning ends it.
+
+A game being played on another worker is not flagged from a session here
+that has no sockets: its moves reach the database up to
+``GAME_WRITE_BEHIND_INTERVAL`` seconds late, so the timer is given
+``FLAG_GRACE`` seconds more and the game is read back before judging it.
+"""
+import asyncio
+import logging
+import math
+from datetime import timedelta
+
+import chess
+from django.conf import settings
+from django.utils import timezone
+
+from .live import game_sessions
+from .models import BLACK_WINS, WHITE_WINS, ChessGame
+from .persistence import end_game
+
+logger = logging.getLogger(__name__)
+
+FLAG_GRACE = settings.GAME_WRITE_BEHIND_INTERVAL + 2.0
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel of ``slots`` slots of ``tick`` seconds each. A timer
+    due at tick ``n`` lives in slot ``n % slots`` and fires on the first
+    pass over that slot at or after tick ``n``. Scheduling and cancelling
+    are O(1); one task per event loop drives the wheel while it has timers.
+    """
+
+    def __init__(self, tick=0.1, slots=1024):
+        self.tick = tick
+        self._slots = [{} for _ in range(slots)]
+        # key -> (due tick, callback, args)
+        self._timers = {}
+        self._current = None
+        self._task = None
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def schedule(self, key, delay, callback, *args):
+        """Call ``await callback(*args)`` in ``delay`` seconds, replacing the timer of ``key``."""
+        self.cancel(key)
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._current = math.floor(loop.time() / self.tick)
+            self._task = loop.create_task(self._run())
+        due = max(math.ceil((loop.time() + delay) / self.tick), self._current + 1)
+        self._slots[due % len(self._slots)][key] = due
+        self._timers[key] = (due, callback, args)
+
+    def cancel(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            del self._slots[timer[0] % len(self._slots)][key]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self._timers:
+            await asyncio.sleep(max(0.0, (self._current + 1) * self.tick - loop.time()))
+            now = math.floor(loop.time() / self.tick)
+            # After a stall longer than a whole turn of the wheel, one pass
+            # over every slot finds everything that is due.
+            for current in range(max(self._current + 1, now - len(self._slots) + 1), now + 1):
+                slot = self._slots[current % len(self._slots)]
+                for key in [key for key, due in slot.items() if due <= now]:
+                    del slot[key]
+                    _, callback, args = self._timers.pop(key)
+                    loop.create_task(self._fire(key, callback, args))
+            self._current = now
+
+    async def _fire(self, key, callback, args):
+        try:
+            await callback(*args)
+        except Exception:
+            logger.exception('Timer %r failed', key)
+
+
+clock_wheel = TimerWheel()
+
+
+def start_clocks(game):
+    """Set up the clocks of a new game; they start with white's first move."""
+    if game.time_base is None:
+        return
+    game.player1_clock_ms = game.player2_clock_ms = game.time_base * 1000
+    game.clock_deadline = None
+
+
+def time_left_ms(game, now=None):
+    """Milliseconds left to the player to move, None if the clock is not running."""
+    if game.clock_deadline is None:
+        return None
+    now = now or timezone.now()
+    return math.floor((game.clock_deadline - now).total_seconds() * 1000)
+
+
+def press_clock(session, now):
+    """
+    Stop the mover's clock after a move pushed onto the session, and start
+    the opponent's if the game goes on. Returns the mover's time left.
+    """
+    game = session.game
+    if game.clock_deadline is None:
+        if game.time_base is None or game.ply != 1:
+            return None
+        # White's first move: nothing to charge, black's clock starts.
+        session.unsaved_moves[-1].clock_ms = game.player1_clock_ms
+        if game.is_active:
+            game.clock_deadline = now + timedelta(milliseconds=game.player2_clock_ms)
+            watch(session)
+        return game.player1_clock_ms
+    left = time_left_ms(game, now) + game.time_increment * 1000
+    if session.board.turn == chess.BLACK:
+        game.player1_clock_ms = left
+        opponent = game.player2_clock_ms
+    else:
+        game.player2_clock_ms = left
+        opponent = game.player1_clock_ms
+    session.unsaved_moves[-1].clock_ms = left
+    if game.is_active:
+        game.clock_deadline = now + timedelta(milliseconds=opponent)
+    else:
+        game.clock_deadline = None
+    watch(session)
+    return left
+
+
+def clock_payload(game, now=None):
+    """The clocks as the pages show them, in milliseconds."""
+    if game.time_base is None:
+        return None
+    white, black = game.player1_clock_ms, game.player2_clock_ms
+    running = None
+    if game.is_active and game.clock_deadline is not None:
+        left = max(0, time_left_ms(game, now))
+        if game.ply % 2 == 0:
+            white, running = left, 'white'
+        else:
+            black, running = left, 'black'
+    return {'white': white, 'black': black, 'running': running}
+
+
+def watch(session):
+    """(Re)schedule the flag check of the session's game."""
+    game = session.game
+    if not game.is_active or game.clock_deadline is None:
+        clock_wheel.cancel(game.id)
+        return
+    delay = max(0, time_left_ms(game)) / 1000
+    clock_wheel.schedule(game.id, delay, check_flag, game.id)
+
+
+async def check_flag(game_id, grace=False):
+    session = game_sessions.get(game_id)
+    if session is not None and session.connections > 0 and not session.stale:
+        await _flag_if_out_of_time(session)
+        return
+
+    if not grace:
+        clock_wheel.schedule(game_id, FLAG_GRACE, check_flag, game_id, True)
+        return
+    try:
+        session = await game_sessions.acquire(game_id)
+    except ChessGame.DoesNotExist:
+        return
+    try:
+        await _flag_if_out_of_time(session)
+    finally:
+        game_sessions.release(session)
+
+
+async def _flag_if_out_of_time(session):
+    game = session.game
+    if not game.is_active or game.clock_deadline is None:
+        return
+    left = time_left_ms(game)
+    if left > 0:
+        watch(session)
+        return
+    await flag(session)
+
+
+def stop_clocks(session, now=None):
+    """Stop the running clock of a game that is ending off the board."""
+    game = session.game
+    left = time_left_ms(game, now)
+    if left is None:
+        return
+    if session.board.turn == chess.WHITE:
+        game.player1_clock_ms = max(0, left)
+    else:
+        game.player2_clock_ms = max(0, left)
+    game.clock_deadline = None
+    clock_wheel.cancel(game.id)
+
+
+async def flag(session):
+    """End the game of a player whose time has run out."""
+    game = session.game
+    if session.board.turn == chess.WHITE:
+        loser, winner, result = game.player1, game.player2, BLACK_WINS
+    else:
+        loser, winner, result = game.player2, game.player1, WHITE_WINS
+    stop_clocks(session)
+    return await end_game(session, f"{loser.username} ran out of time. {winner.username} wins!", result)
@@ -1,115 +1,251 @@
+import asyncio
 import json
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from asgiref.sync import sync_to_async
-from django.contrib.auth.models import User
-from django.contrib.sessions.models import Session
+from django.conf import settings
+from django.db import DatabaseError
 from django.utils import timezone
-from django.db.models import Q
-from .models import GameInvite, ChessGame
+from .models import BLACK_WINS, DRAW, WHITE_WINS, ChessGame
+from .fanout import player_group, send_to_game, spectator_hub
+from .explorer import aexplore
+from .encoding import DEFAULT_ENCODING, ENCODINGS, encode_position, position_payload
+from .live import game_sessions
+from .positions import game_outcome
+from .persistence import end_game, game_writer
+from .clocks import clock_payload, flag, press_clock, stop_clocks, time_left_ms, watch
+from .presence import abroadcast, ensure_sweeper, get_presence
+from .metrics import InstrumentedConsumer, open_sockets, set_action, timed_group_send
+from .services import active_game_id, answer_invite, create_invite, parse_time_control
+from .matchmaking import arating_for, ensure_pairer, get_matchmaker, start_match
+from .draining import worker_drain
 import logging
 import chess
-from .models import ChessGame
 
 logger = logging.getLogger(__name__)
 
-class GameConsumer(AsyncWebsocketConsumer):
+class GameConsumer(InstrumentedConsumer, AsyncWebsocketConsumer):
+    metric_actions = ('move', 'exit', 'sync', 'explore')
+
     async def connect(self):
+        self.session = None
+        worker_drain.install()
+        if not self.scope['user'].is_authenticated or worker_drain.draining:
+            await self.close()
+            return
+
         self.game_id = self.scope['url_route']['kwargs']['game_id']
-        self.group_name = f'game_{self.game_id}'
-        await self.channel_layer.group_add(
-            self.group_name,
-            self.channel_name
-        )
+        self.group_name = player_group(self.game_id)
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.encoding = query.get('encoding', [DEFAULT_ENCODING])[0]
+        if self.encoding not in ENCODINGS:
+            self.encoding = DEFAULT_ENCODING
+        try:
+            self.session = await game_sessions.acquire(self.game_id)
+        except ChessGame.DoesNotExist:
+            await self.close()
+            return
+
+        self.role = 'player' if self.session.is_player(self.scope['user']) else 'spectator'
+        watch(self.session)
         await self.accept()
-        logger.info(f"WebSocket connected: {self.channel_name} for game {self.game_id}")
+        open_sockets.inc(self.socket_group())
+        worker_drain.add(self)
+        if self.role == 'player':
+            await self.channel_layer.group_add(
+                self.group_name,
+                self.channel_name
+            )
+        else:
+            await spectator_hub.add(self.game_id, self)
+        await self.send(text_data=json.dumps({
+            'action': 'role',
+            'role': self.role,
+            'spectators': spectator_hub.count(self.game_id),
+        }))
+        logger.info(f"WebSocket connected: {self.channel_name} for game {self.game_id} as {self.role}")
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(
-            self.group_name,
-            self.channel_name
-        )
+        if self.session is None:
+            return
+
+        game_sessions.release(self.session)
+        open_sockets.dec(self.socket_group())
+        worker_drain.discard(self)
+        if self.role == 'player':
+            await self.channel_layer.group_discard(
+                self.group_name,
+                self.channel_name
+            )
+        else:
+            await spectator_hub.remove(self.game_id, self)
         logger.info(f"WebSocket disconnected: {self.channel_name}")
 
     async def receive(self, text_data):
         data = json.loads(text_data)
         action = data.get('action')
-
-        if action == 'move':
-            await self.handle_move(data.get('move'))
+        set_action(action)
+
+        if self.role == 'spectator' and action in ('move', 'exit'):
+            await self.send(text_data=json.dumps({'action': 'error', 'message': 'Spectators cannot make moves.'}))
+        elif worker_drain.draining and action in ('move', 'exit'):
+            # The socket is about to be closed and the game handed over.
+            await self.send(text_data=json.dumps({'action': 'error', 'message': 'The server is restarting, please try again in a moment.'}))
+        elif action == 'move':
+            await self.handle_move(data.get('move'), data.get('ply'))
         elif action == 'exit':
             await self.handle_exit()
+        elif action == 'sync':
+            await self.send_sync()
+        elif action == 'explore':
+            await self.send_explorer()
         else:
             logger.warning(f"Unknown action received: {action}")
 
 
 
-    async def handle_move(self, move):
-        try:
-            game = await self.get_game()
-            board = chess.Board(game.fen)
-            user = self.scope['user']
+    def socket_group(self):
+        return 'game' if self.role == 'player' else 'spectate'
 
-            if user != game.player1 and user != game.player2:
-                await self.send(text_data=json.dumps({'action': 'error', 'message': 'You are not a player in this game.'}))
-                return
+    async def handle_move(self, move, ply=None):
+        game = self.session.game
+        board = self.session.board
+        user = self.scope['user']
 
-            board.push_uci(move)
-            game.fen = board.fen()
-
-            if user == game.player1:
-                game.player1_move_count += 1
-            elif user == game.player2:
-                game.player2_move_count += 1
-
-
-            if board.is_checkmate():
-                winner = game.player2 if board.turn == chess.WHITE else game.player1
-                game.game_status = f"{winner.username} won by checkmate"
-                game.is_active = False
-                game.current_turn = None
-            elif board.is_stalemate():
-                game.game_status = f"Game drawn by stalemate between {game.player1.username} and {game.player2.username}"
-                game.is_active = False
-                game.current_turn = None
-            elif board.is_insufficient_material():
-                game.game_status = "Draw by insufficient material"
-                game.is_active = False
-            elif board.is_fivefold_repetition():
-                game.game_status = "Draw by repetition"
-                game.is_active = False
-            else:
-                game.current_turn = game.player1 if board.turn == chess.WHITE else game.player2
-
-            await sync_to_async(game.save)()
-
-            current_turn_username = game.current_turn.username if game.current_turn else "unknown"
-
-            await self.channel_layer.group_send(
-                self.group_name,
-                {
-                    'type': 'game_update',
-                    'fen': game.fen,
-                    'game_status': game.game_status,
-                    'current_turn_username': current_turn_username,
-                }
-            )
+        if not self.session.is_player(user):
+            await self.send(text_data=json.dumps({'action': 'error', 'message': 'You are not a player in this game.'}))
+            return
+
+        # ply is the position the client made the move in, if it says.
+        if self.session.stale or (ply is not None and ply != game.ply):
+            await self.send_resync('The game has moved on since your board was last updated.')
+            return
+
+        if not game.is_active:
+            await self.send(text_data=json.dumps({'action': 'error', 'message': 'This game is over.'}))
+            return
+
+        if not self.session.is_turn_of(user):
+            await self.send(text_data=json.dumps({'action': 'error', 'message': 'It is not your turn.'}))
+            return
+
+        now = timezone.now()
+        left = time_left_ms(game, now)
+        if left is not None and left <= 0:
+            await flag(self.session)
+            return
+
+        try:
+            move = self.session.push(move)
         except ValueError:
             await self.send(text_data=json.dumps({'action': 'error', 'message': 'Invalid move'}))
+            return
+        outcome = game_outcome(board, self.session.position())
+
+        if outcome == 'checkmate':
+            winner = game.player2 if board.turn == chess.WHITE else game.player1
+            game.game_status = f"{winner.username} won by checkmate"
+            game.result = BLACK_WINS if board.turn == chess.WHITE else WHITE_WINS
+            game.is_active = False
+        elif outcome == 'stalemate':
+            game.game_status = f"Game drawn by stalemate between {game.player1.username} and {game.player2.username}"
+            game.result = DRAW
+            game.is_active = False
+        elif outcome == 'insufficient_material':
+            game.game_status = "Draw by insufficient material"
+            game.result = DRAW
+            game.is_active = False
+        elif outcome == 'fivefold_repetition':
+            game.game_status = "Draw by repetition"
+            game.result = DRAW
+            game.is_active = False
+        elif outcome == 'seventyfive_moves':
+            game.game_status = "Draw by the 75-move rule"
+            game.result = DRAW
+            game.is_active = False
+        else:
+            game.current_turn = self.session.player_to_move()
+        press_clock(self.session, now)
+
+        if not game.is_active:
+            game.current_turn = None
+            try:
+                written = await game_writer.flush_game(self.session)
+            except DatabaseError:
+                # Still in the session; the writer retries it with its
+                # next batch.
+                written = None
+                await self.send(text_data=json.dumps({'action': 'error', 'message': 'The end of the game could not be saved yet, retrying.'}))
+            if written is False:
+                # The move lost against a change made elsewhere; the
+                # sockets are being resynced.
+                return
+            await abroadcast(await get_presence().aset_available(game.player1_id, game.player2_id))
+
+        current_turn_username = game.current_turn.username if game.current_turn else "unknown"
+
+        await send_to_game(
+            self.game_id,
+            {
+                'type': 'game_update',
+                'position': position_payload(
+                    board, game.ply, move.uci(), self.session.key,
+                    self.session.position().legal_payload if game.is_active else {},
+                ),
+                'game_status': game.game_status,
+                'current_turn_username': current_turn_username,
+                'clock': clock_payload(game, now),
+            }
+        )
+
+        if game.is_active:
+            game_writer.mark_dirty(self.session)
 
     async def game_update(self, event):
-        await self.send(text_data=json.dumps({
+        message = {
             'action': 'move',
-            'fen': event['fen'],
+            **encode_position(event['position'], self.encoding),
             'game_status': event['game_status'],
             'current_turn_username': event['current_turn_username'],
+            'clock': event.get('clock'),
+        }
+        if self.role == 'player':
+            message['legal'] = event['position']['legal']
+        await self.send(text_data=json.dumps(message))
+
+    async def send_sync(self):
+        game = self.session.game
+        current_turn = self.session.player_to_move() if game.is_active else None
+        position = position_payload(self.session.board, game.ply, key=self.session.key)
+        await self.send(text_data=json.dumps({
+            'action': 'sync',
+            **encode_position(position, self.encoding),
+            'game_status': game.game_status,
+            'current_turn_username': current_turn.username if current_turn else "unknown",
+            'legal': self.session.position().legal_payload if game.is_active else {},
+            'clock': clock_payload(game),
         }))
 
-    @sync_to_async
-    def get_game(self):
-        return ChessGame.objects.select_related('player1', 'player2', 'current_turn').get(id=self.game_id)
+    async def send_explorer(self):
+        # What was played from the current position in finished games; not
+        # for the players while they are still playing it.
+        if self.session.game.is_active and self.session.is_player(self.scope['user']):
+            await self.send(text_data=json.dumps({'action': 'error', 'message': 'The explorer is not available during your own game.'}))
+            return
+        # A copy: the session's board may move on while the query runs.
+        board, key, ply = self.session.board.copy(stack=False), self.session.key, self.session.game.ply
+        moves = await aexplore(board, key)
+        await self.send(text_data=json.dumps({'action': 'explorer', 'ply': ply, 'moves': moves}))
+
+    async def send_resync(self, message):
+        await self.send(text_data=json.dumps({'action': 'error', 'message': message, 'resync': True}))
+        await self.send_sync()
 
     async def handle_exit(self):
-        game = await self.get_game()
+        if self.session.stale:
+            await self.send_resync('The game has changed, please try again.')
+            return
+
+        game = self.session.game
         resigning_player = self.scope['user']
 
         if not resigning_player.is_authenticated:
@@ -117,68 +253,104 @@ class GameConsumer(AsyncWebsocketConsumer):
             return
 
         if resigning_player == game.player1:
-            winner = game.player2
-            game.game_status = f"{game.player1.username} has resigned. {game.player2.username} wins!"
+            status = f"{game.player1.username} has resigned. {game.player2.username} wins!"
+            result = BLACK_WINS
         elif resigning_player == game.player2:
-            winner = game.player1
-            game.game_status = f"{game.player2.username} has resigned. {game.player1.username} wins!"
+            status = f"{game.player2.username} has resigned. {game.player1.username} wins!"
+            result = WHITE_WINS
         else:
             await self.send(text_data=json.dumps({'action': 'error', 'message': 'You are not a player in this game'}))
             return
 
-        game.is_active = False
-        game.current_turn = None  
-        await sync_to_async(game.save)()
-
-        await self.channel_layer.group_send(
-            self.group_name,
-            {
-                'type': 'game_status',
-                'message': game.game_status,
-            }
-        )
+        stop_clocks(self.session)
+        await end_game(self.session, status, result)
 
 
     async def game_status(self, event):
+        game = self.session.game
+        if game.is_active:
+            game.is_active = False
+            game.current_turn = None
+            game.game_status = event['message']
+            game.result = event.get('result', game.result)
         await self.send(text_data=json.dumps({
             'action': 'game_status',
             'message': event['message'],
         }))
 
+    async def session_stale(self, event):
+        # The game was changed by another process and its session dropped:
+        # continue on a freshly loaded one.
+        stale = self.session
+        if stale.stale:
+            try:
+                self.session = await game_sessions.acquire(self.game_id)
+            except ChessGame.DoesNotExist:
+                await self.close()
+                return
+            game_sessions.release(stale)
+            watch(self.session)
+        await self.send_resync('The game was changed elsewhere and has been reloaded.')
+
+    async def spectator_count(self, event):
+        await self.send(text_data=json.dumps({
+            'action': 'spectators',
+            'count': event['count'],
+        }))
+
 
 
-class LobbyConsumer(AsyncWebsocketConsumer):
+class LobbyConsumer(InstrumentedConsumer, AsyncWebsocketConsumer):
+    metric_actions = ('fetch_active_users', 'send_invite', 'respond_invite', 'check_game_status', 'find_match', 'cancel_match')
+
     async def connect(self):
         self.user = self.scope['user']
-        if not self.user.is_authenticated:
+        self.accepted = False
+        # Whether this socket has the user waiting in the matchmaking queue.
+        self.searching = False
+        worker_drain.install()
+        if not self.user.is_authenticated or worker_drain.draining:
             await self.close()
             return
 
         await self.channel_layer.group_add('lobby', self.channel_name)
         await self.channel_layer.group_add(f'user_{self.user.id}', self.channel_name)
         await self.accept()
+        self.accepted = True
+        open_sockets.inc('lobby')
+        worker_drain.add(self)
 
-        await self.channel_layer.group_send('lobby', {
-            'type': 'user_update',
-            'action': 'join',
-            'user_id': self.user.id,
-            'username': self.user.username,
-        })
+        presence = get_presence()
+        await abroadcast(await presence.aconnect(self.user.id, self.user.username))
+        self.heartbeat_task = asyncio.create_task(self.heartbeat(presence))
+        ensure_sweeper()
+
+        await self.send_active_users()
 
     async def disconnect(self, close_code):
+        if not self.accepted:
+            return
+
+        self.heartbeat_task.cancel()
+        open_sockets.dec('lobby')
+        worker_drain.discard(self)
+
         await self.channel_layer.group_discard('lobby', self.channel_name)
         await self.channel_layer.group_discard(f'user_{self.user.id}', self.channel_name)
 
-        await self.channel_layer.group_send('lobby', {
-            'type': 'user_update',
-            'action': 'leave',
-            'user_id': self.user.id,
-            'username': self.user.username,
-        })
+        if self.searching:
+            await get_matchmaker().acancel(self.user.id)
+        await abroadcast(await get_presence().adisconnect(self.user.id))
+
+    async def heartbeat(self, presence):
+        while True:
+            await asyncio.sleep(presence.heartbeat_interval)
+            await presence.aheartbeat(self.user.id)
 
     async def receive(self, text_data):
         data = json.loads(text_data)
         action = data.get('action')
+        set_action(action)
 
         if action == 'fetch_active_users':
             await self.send_active_users()
@@ -188,14 +360,19 @@ class LobbyConsumer(AsyncWebsocketConsumer):
             await self.handle_respond_invite(data)
         elif action == 'check_game_status':
             await self.check_game_status()
+        elif action == 'find_match':
+            await self.handle_find_match(data)
+        elif action == 'cancel_match':
+            await self.handle_cancel_match()
         else:
             await self.send(text_data=json.dumps({'error': 'Invalid action'}))
 
     async def send_active_users(self):
-        active_users = await self.get_active_users()
+        seq, active_users = await get_presence().asnapshot(exclude_id=self.user.id)
         await self.send(text_data=json.dumps({
             'action': 'active_users',
             'active_users': active_users,
+            'seq': seq,
         }))
 
     async def handle_send_invite(self, data):
@@ -204,40 +381,21 @@ class LobbyConsumer(AsyncWebsocketConsumer):
             await self.send(text_data=json.dumps({'error': 'User ID is required'}))
             return
 
-        def fetch_receiver_and_check():
-            try:
-                receiver = User.objects.get(id=user_id)
-            except User.DoesNotExist:
-                return None, 'User does not exist'
-
-            existing_game = ChessGame.objects.filter(
-                (Q(player1=self.user, player2=receiver) | Q(player1=receiver, player2=self.user)) & Q(is_active=True)
-            ).exists()
-            if existing_game:
-                return None, 'You are already playing a game with this user.'
-                
-            return receiver, None
-
-        receiver, error = await sync_to_async(fetch_receiver_and_check)()
+        invite, error = await create_invite(self.user, user_id, data.get('time_control', settings.DEFAULT_TIME_CONTROL))
         if error:
             await self.send(text_data=json.dumps({'error': error}))
             return
 
-        def create_invite():
-            invite = GameInvite.objects.create(sender=self.user, receiver=receiver)
-            return invite.id
-
-        invite_id = await sync_to_async(create_invite)()
-
-        await self.channel_layer.group_send(f'user_{receiver.id}', {
+        await timed_group_send(self.channel_layer, f'user_{invite.receiver_id}', {
             'type': 'receive_invite',
-            'invite_id': invite_id,
+            'invite_id': invite.id,
             'sender': self.user.username,
+            'time_control': [invite.time_base, invite.time_increment] if invite.time_base is not None else None,
         })
 
         await self.send(text_data=json.dumps({
             'action': 'invite_sent',
-            'message': f'Invite sent to {receiver.username}.',
+            'message': f'Invite sent to {invite.receiver.username}.',
         }))
 
     async def handle_respond_invite(self, data):
@@ -246,65 +404,63 @@ class LobbyConsumer(AsyncWebsocketConsumer):
         if not invite_id or not response:
             await self.send(text_data=json.dumps({'error': 'Invite ID and response are required'}))
             return
+        if response not in ('accept', 'decline'):
+            await self.send(text_data=json.dumps({'error': 'Invalid response'}))
+            return
 
-        def get_invite_and_check():
-            try:
-                invite = GameInvite.objects.select_related('sender', 'receiver').get(id=invite_id)
-            except GameInvite.DoesNotExist:
-                return None, None, None, 'Invite does not exist'
-            if invite.receiver_id != self.user.id:
-                return None, None, None, 'Invalid invite'
-            return invite, invite.sender.id, invite.receiver.username, None
-
-        invite, sender_id, receiver_username, error = await sync_to_async(get_invite_and_check)()
+        invite, error = await answer_invite(self.user, invite_id, response == 'accept')
         if error:
             await self.send(text_data=json.dumps({'error': error}))
             return
 
         if response == 'accept':
-            def accept_invite():
-                invite.status = 'accepted'
-                game = ChessGame.objects.create(
-                    player1=invite.sender,
-                    player2=invite.receiver,
-                    is_active=True
-                )
-                invite.game = game
-                invite.save()
-                return game.id, invite.sender.id, invite.receiver.id
-
-            game_id, sender_id, receiver_id = await sync_to_async(accept_invite)()
-
-            for user_id in [sender_id, receiver_id]:
-                await self.channel_layer.group_send(f'user_{user_id}', {
+            await get_matchmaker().acancel(invite.sender_id, invite.receiver_id)
+            await abroadcast(await get_presence().aset_busy(invite.sender_id, invite.receiver_id))
+
+            for user_id in [invite.sender_id, invite.receiver_id]:
+                await timed_group_send(self.channel_layer, f'user_{user_id}', {
                     'type': 'start_game',
-                    'game_id': game_id,
+                    'game_id': invite.game_id,
                 })
-        elif response == 'decline':
-            def decline_invite():
-                invite.status = 'declined'
-                invite.save()
-                return invite.sender.id
-
-            sender_id = await sync_to_async(decline_invite)()
-
-            await self.channel_layer.group_send(f'user_{sender_id}', {
+        else:
+            await timed_group_send(self.channel_layer, f'user_{invite.sender_id}', {
                 'type': 'invite_declined',
                 'receiver': self.user.username,
             })
-        else:
-            await self.send(text_data=json.dumps({'error': 'Invalid response'}))
+
+    async def handle_find_match(self, data):
+        time_control, error = parse_time_control(data.get('time_control', settings.DEFAULT_TIME_CONTROL))
+        if error:
+            await self.send(text_data=json.dumps({'error': error}))
+            return
+        if await active_game_id(self.user):
+            await self.send(text_data=json.dumps({'error': 'You already have a game in progress.'}))
+            return
+
+        ensure_pairer()
+        self.searching = True
+        rating = await arating_for(self.user)
+        opponent = await get_matchmaker().aenqueue(self.user.id, rating, time_control)
+        if opponent is not None:
+            await start_match((self.user.id, rating), opponent, time_control)
+            return
+        await self.send(text_data=json.dumps({
+            'action': 'match_searching',
+            'time_control': list(time_control) if time_control[0] is not None else None,
+        }))
+
+    async def handle_cancel_match(self):
+        await get_matchmaker().acancel(self.user.id)
+        self.searching = False
+        await self.send(text_data=json.dumps({'action': 'match_cancelled'}))
 
     async def check_game_status(self):
-        game = await sync_to_async(ChessGame.objects.filter)(
-            (Q(player1=self.user) | Q(player2=self.user)) & Q(is_active=True)
-        )
-        game = await sync_to_async(game.first)()
-        if game:
+        game_id = await active_game_id(self.user)
+        if game_id:
             await self.send(text_data=json.dumps({
                 'action': 'game_status',
                 'status': 'active',
-                'game_id': game.id,
+                'game_id': game_id,
             }))
         else:
             await self.send(text_data=json.dumps({
@@ -313,16 +469,25 @@ class LobbyConsumer(AsyncWebsocketConsumer):
             }))
 
     async def user_update(self, event):
-        await self.send_active_users()
+        await self.send(text_data=json.dumps({
+            'action': 'user_update',
+            'change': event['action'],
+            'user_id': event['user_id'],
+            'username': event['username'],
+            'busy': event['busy'],
+            'seq': event['seq'],
+        }))
 
     async def receive_invite(self, event):
         await self.send(text_data=json.dumps({
             'action': 'receive_invite',
             'invite_id': event['invite_id'],
             'sender': event['sender'],
+            'time_control': event.get('time_control'),
         }))
 
     async def start_game(self, event):
+        self.searching = False
         await self.send(text_data=json.dumps({
             'action': 'start_game',
             'game_id': event['game_id'],
@@ -333,22 +498,3 @@ class LobbyConsumer(AsyncWebsocketConsumer):
             'action': 'invite_declined',
             'receiver': event['receiver'],
         }))
-
-    async def get_active_users(self):
-        def fetch_active_users():
-            sessions = Session.objects.filter(expire_date__gte=timezone.now())
-            user_ids = []
-            for session in sessions:
-                data = session.get_decoded()
-                user_id = data.get('_auth_user_id')
-                if user_id:
-                    user_ids.append(int(user_id))
-            active_games = ChessGame.objects.filter(is_active=True).values_list('player1', 'player2')
-            active_game_user_ids = set([uid for pair in active_games for uid in pair if uid])
-            available_user_ids = set(user_ids) - active_game_user_ids - {self.user.id}
-            active_users = User.objects.filter(id__in=available_user_ids).values('id', 'username')
-            return list(active_users)
-        
-        active_users_list = await sync_to_async(fetch_active_users)()
-        return active_users_list
-
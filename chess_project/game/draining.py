@@ -0,0 +1,93 @@
+"""
+Graceful shutdown of one ASGI worker out of several.
+
+nginx pins every socket of a game to one worker by consistent hashing of the
+game id (see nginx.conf), so a game's live session exists on that worker
+only. Stopping a worker with SIGTERM makes daphne cancel its consumers on the
+spot: the atexit hook of ``game.persistence`` still writes pending moves,
+but the browsers just see their sockets die.
+
+``DRAIN_SIGNAL``, which supervisord sends as the stop signal, drains the
+worker first:
+
+1. new sockets are refused and moves that arrive are turned away, so the
+   sessions stop changing;
+2. the moves still buffered by the write-behind are written;
+3. every socket is closed with ``CLOSE_RECONNECT``, which the pages answer by
+   reconnecting straight away;
+4. the worker stops itself with SIGTERM.
+
+nginx then hashes the drained worker's games onto the next worker of the
+ring, which loads them from the database; games of the other workers do not
+move. If a game's sockets do end up on two workers for a while, the
+conditional writes of ``game.persistence`` keep them from overwriting each
+other.
+"""
+import asyncio
+import logging
+import os
+import signal
+import time
+
+from .persistence import game_writer
+
+logger = logging.getLogger(__name__)
+
+DRAIN_SIGNAL = signal.SIGUSR1
+
+# Application close code telling the page to reconnect, possibly to another worker.
+CLOSE_RECONNECT = 4000
+
+
+class WorkerDrain:
+    def __init__(self):
+        self.draining = False
+        self._sockets = set()
+        self._loops = set()
+
+    def install(self):
+        """
+        Handle DRAIN_SIGNAL on the running loop; called by every consumer.
+        Until the first socket connects the signal stops the worker outright,
+        which is fine as it has nothing to drain.
+        """
+        loop = asyncio.get_running_loop()
+        if loop in self._loops:
+            return
+        self._loops.add(loop)
+        try:
+            loop.add_signal_handler(DRAIN_SIGNAL, lambda: loop.create_task(self.drain()))
+        except (NotImplementedError, RuntimeError, ValueError):
+            # No signals off the main thread or on Windows; such a worker
+            # simply cannot be drained.
+            pass
+
+    def add(self, consumer):
+        self._sockets.add(consumer)
+
+    def discard(self, consumer):
+        self._sockets.discard(consumer)
+
+    async def drain(self, exit=True, close_timeout=5.0):
+        if self.draining:
+            return
+        self.draining = True
+        logger.info('Draining worker %s with %d open sockets', os.getpid(), len(self._sockets))
+
+        await game_writer.flush()
+        for consumer in list(self._sockets):
+            try:
+                await consumer.close(code=CLOSE_RECONNECT)
+            except Exception:
+                logger.exception('Failed to close a socket while draining')
+        # Give the close frames time to go out before the server is stopped.
+        deadline = time.monotonic() + close_timeout
+        while self._sockets and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        # Anything that got in before the sockets closed.
+        await game_writer.flush()
+        if exit:
+            os.kill(os.getpid(), signal.SIGTERM)
+
+
+worker_drain = WorkerDrain()
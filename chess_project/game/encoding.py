@@ -0,0 +1,115 @@
+"""
+Compact board encodings for the game WebSocket protocol.
+
+A ``GameConsumer`` connection picks its encoding with ``?encoding=`` on the
+socket URL; connections that do not ask get FEN strings as before.
+
+    fen     the position as a FEN string
+    packed  the position as 38 bytes, base64 encoded (see pack_board)
+    delta   only the move in UCI notation, the ply it was played at and
+            the Zobrist hash of the resulting position; clients apply the
+            move to their own board and send a ``sync`` action to get the
+            full position again if they miss a ply
+"""
+import base64
+import struct
+
+import chess
+import chess.polyglot
+
+ENCODINGS = ('fen', 'packed', 'delta')
+DEFAULT_ENCODING = 'fen'
+
+# 32 bytes of squares (two per byte, a1 first, low nibble first), then flags,
+# en passant square, halfmove clock and fullmove number.
+PACKED_FORMAT = '>32sBBHH'
+PACKED_SIZE = struct.calcsize(PACKED_FORMAT)
+
+NO_EP_SQUARE = 0xFF
+
+# Flag bits
+WHITE_TO_MOVE = 0x01
+CASTLING_BITS = (
+    (chess.BB_H1, 0x02),
+    (chess.BB_A1, 0x04),
+    (chess.BB_H8, 0x08),
+    (chess.BB_A8, 0x10),
+)
+
+
+def piece_code(piece):
+    # 0 is an empty square, 1-6 white pawn..king, 9-14 black pawn..king.
+    if piece is None:
+        return 0
+    return piece.piece_type | (0 if piece.color == chess.WHITE else 8)
+
+
+def pack_board(board):
+    squares = bytearray(32)
+    for square, piece in board.piece_map().items():
+        squares[square >> 1] |= piece_code(piece) << (4 * (square & 1))
+
+    flags = WHITE_TO_MOVE if board.turn == chess.WHITE else 0
+    for mask, bit in CASTLING_BITS:
+        if board.castling_rights & mask:
+            flags |= bit
+
+    ep_square = board.ep_square if board.ep_square is not None else NO_EP_SQUARE
+    return struct.pack(
+        PACKED_FORMAT,
+        bytes(squares),
+        flags,
+        ep_square,
+        min(board.halfmove_clock, 0xFFFF),
+        min(board.fullmove_number, 0xFFFF),
+    )
+
+
+def unpack_board(data):
+    squares, flags, ep_square, halfmove_clock, fullmove_number = struct.unpack(PACKED_FORMAT, data)
+    board = chess.Board.empty()
+    for square in chess.SQUARES:
+        code = (squares[square >> 1] >> (4 * (square & 1))) & 0x0F
+        if code:
+            board.set_piece_at(square, chess.Piece(code & 0x07, chess.WHITE if code < 8 else chess.BLACK))
+
+    board.turn = chess.WHITE if flags & WHITE_TO_MOVE else chess.BLACK
+    board.castling_rights = chess.BB_EMPTY
+    for mask, bit in CASTLING_BITS:
+        if flags & bit:
+            board.castling_rights |= mask
+    board.ep_square = None if ep_square == NO_EP_SQUARE else ep_square
+    board.halfmove_clock = halfmove_clock
+    board.fullmove_number = fullmove_number
+    return board
+
+
+def pack_board_b64(board):
+    return base64.b64encode(pack_board(board)).decode('ascii')
+
+
+def position_hash(board, key=None):
+    if key is None:
+        key = chess.polyglot.zobrist_hash(board)
+    return format(key, '016x')
+
+
+def position_payload(board, ply, move=None, key=None, legal=None):
+    """Everything any encoding may need about a position, computed once per move."""
+    return {
+        'fen': board.fen(),
+        'board': pack_board_b64(board),
+        'hash': position_hash(board, key),
+        'ply': ply,
+        'move': move,
+        'legal': legal,
+    }
+
+
+def encode_position(payload, encoding):
+    """The fields of ``position_payload`` a connection using ``encoding`` gets."""
+    if encoding == 'packed':
+        return {'board': payload['board'], 'ply': payload['ply']}
+    if encoding == 'delta' and payload['move'] is not None:
+        return {'move': payload['move'], 'ply': payload['ply'], 'hash': payload['hash']}
+    return {'fen': payload['fen'], 'ply': payload['ply']}
@@ -0,0 +1,152 @@
+"""
+Opening explorer: what was played from a position in the site's games.
+
+``PositionMove`` holds, per position and move, how many finished games
+played that move there and how they ended. Positions are keyed by their
+Zobrist hash, as in game/positions.py, so transpositions share a row, and
+looking a position up is one index range scan however many games there
+are. Only the first ``POSITION_INDEX_MAX_PLY`` plies of each game are
+indexed; beyond the opening almost every position is unique.
+
+Finished games are added by ``index_games``, which the reaper runs every
+pass (game/reaper.py), so a game shows up within a minute or so of
+ending. ``manage.py index_positions`` runs it over the whole archive, or
+rebuilds the index from scratch with ``--rebuild``. Games deleted after
+they were indexed stay counted.
+"""
+import chess
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import BLACK_WINS, DRAW, WHITE_WINS, ChessGame, GameMove, PositionMove
+from .positions import position_key
+
+RESULT_COLUMNS = {WHITE_WINS: 'white_wins', DRAW: 'draws', BLACK_WINS: 'black_wins'}
+
+# Rows per INSERT statement of ``_add_counts``.
+INSERT_BATCH_SIZE = 500
+
+
+def index_key(board, key=None):
+    """
+    The Zobrist hash of the position, or ``key`` if already worked out, as
+    the signed 64-bit integer stored.
+    """
+    key = position_key(board) if key is None else key
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+
+START_KEY = index_key(chess.Board())
+
+
+def index_games(batch_size=500, max_ply=None):
+    """
+    Add up to ``batch_size`` finished games that are not indexed yet to the
+    index. Returns how many games were taken.
+    """
+    max_ply = settings.POSITION_INDEX_MAX_PLY if max_ply is None else max_ply
+    with transaction.atomic():
+        games = list(
+            ChessGame.objects.filter(is_active=False, positions_indexed=False)
+            .only('id', 'ply', 'result')
+            .order_by('id')
+            .select_for_update(skip_locked=True)[:batch_size]
+        )
+        if not games:
+            return 0
+        moves = {}
+        for game_id, ply, uci in (
+            GameMove.objects.filter(game_id__in=[game.id for game in games], ply__lte=max_ply)
+            .order_by('game_id', 'ply')
+            .values_list('game_id', 'ply', 'uci')
+        ):
+            moves.setdefault(game_id, []).append((ply, uci))
+
+        counts = {}
+        # (key, uci) -> key of the position the move leads to. Games mostly
+        # open the same way, so the positions they share are only set up and
+        # hashed once per batch.
+        next_keys = {}
+        for game in games:
+            logged = moves.get(game.id, [])
+            # Games from before the move log, or with gaps in it, cannot be replayed.
+            if [ply for ply, _ in logged] != list(range(1, min(game.ply, max_ply) + 1)):
+                continue
+            game_moves = [uci for _, uci in logged]
+            column = RESULT_COLUMNS.get(game.result)
+            key, board = START_KEY, None
+            for i, uci in enumerate(game_moves):
+                row = counts.setdefault((key, uci), {'games': 0, 'white_wins': 0, 'draws': 0, 'black_wins': 0})
+                row['games'] += 1
+                if column:
+                    row[column] += 1
+                if i + 1 == len(game_moves):
+                    break
+                next_key = next_keys.get((key, uci))
+                if next_key is None and board is None:
+                    # Off the known positions: set up the board to go on from here.
+                    board = chess.Board()
+                    for played in game_moves[:i]:
+                        board.push_uci(played)
+                if board is not None:
+                    board.push_uci(uci)
+                    if next_key is None:
+                        next_key = next_keys[key, uci] = index_key(board)
+                key = next_key
+
+        _add_counts(counts)
+        ChessGame.objects.filter(id__in=[game.id for game in games]).update(positions_indexed=True)
+    return len(games)
+
+
+def _add_counts(counts):
+    # bulk_create(update_conflicts=True) can only overwrite the counts, so
+    # the increment is written out; PostgreSQL and SQLite share the syntax.
+    table = connection.ops.quote_name(PositionMove._meta.db_table)
+    columns = ['games', 'white_wins', 'draws', 'black_wins']
+    rows = [(key, uci, *(row[column] for column in columns)) for (key, uci), row in counts.items()]
+    updates = ', '.join(f'{column} = {table}.{column} + excluded.{column}' for column in columns)
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), INSERT_BATCH_SIZE):
+            batch = rows[start:start + INSERT_BATCH_SIZE]
+            values = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(batch))
+            cursor.execute(
+                f'INSERT INTO {table} (position_key, uci, {", ".join(columns)}) VALUES {values} '
+                f'ON CONFLICT (position_key, uci) DO UPDATE SET {updates}',
+                [value for row in batch for value in row],
+            )
+
+
+def _moves_payload(board, rows):
+    moves = []
+    for uci, games, white_wins, draws, black_wins in rows:
+        move = chess.Move.from_uci(uci)
+        moves.append({
+            'uci': uci,
+            'san': board.san(move) if board.is_legal(move) else uci,
+            'games': games,
+            'white': white_wins,
+            'draws': draws,
+            'black': black_wins,
+        })
+    return moves
+
+
+def _rows(board, key):
+    return (
+        PositionMove.objects.filter(position_key=index_key(board, key))
+        .order_by('-games', 'uci')
+        .values_list('uci', 'games', 'white_wins', 'draws', 'black_wins')
+    )
+
+
+def explore(board, key=None):
+    """
+    The moves played from the position on ``board``, most played first, as
+    ``{'uci', 'san', 'games', 'white', 'draws', 'black'}`` dicts.
+    """
+    return _moves_payload(board, _rows(board, key))
+
+
+async def aexplore(board, key=None):
+    return _moves_payload(board, [row async for row in _rows(board, key)])
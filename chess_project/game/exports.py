@@ -0,0 +1,206 @@
+"""
+Streaming export of games as PGN or NDJSON.
+
+An export reads the games ``chunk_size`` at a time in id order, each chunk
+with one short query that starts after the last id of the previous one, and
+streams the chunk's ``GameMove`` rows with a cursor in the same order. At
+most one chunk of games and one game's moves are in memory however many
+games are exported, and no query or transaction stays open for the whole
+export: on SQLite a long read would keep every writer waiting.
+
+The text is produced in a thread and handed to the response through a
+small queue: the first bytes go out as soon as the first games are read,
+and a slow client holds the thread back rather than letting the output
+pile up in memory. Django 4.2 does not stop a streaming response when the
+client goes away, so an abandoned export still runs to its end.
+
+Games older than the move log, or whose log has gaps, are exported from
+their final position (a PGN ``FEN`` tag) without moves.
+"""
+import asyncio
+import json
+import textwrap
+
+import chess
+
+from .metrics import timed_sync_to_async
+from .models import NO_RESULT, GameMove
+
+FORMATS = {
+    'pgn': 'application/x-chess-pgn',
+    'ndjson': 'application/x-ndjson',
+}
+
+# Text handed to the response at a time.
+BUFFER_SIZE = 16 * 1024
+
+
+def game_result(game):
+    """The PGN result of a game."""
+    return NO_RESULT if game.is_active else game.result
+
+
+def _is_complete(game, moves):
+    """Whether ``moves`` are all the moves of the game."""
+    if game.ply == 0:
+        # Games from before the move log have a position but no plies.
+        return game.fen == chess.STARTING_FEN
+    return len(moves) == game.ply and all(move[0] == ply for ply, move in enumerate(moves, 1))
+
+
+def _format_clock(ms):
+    seconds = max(0, ms) // 1000
+    return f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+def _date(game, moves):
+    played_at = moves[0][3] if moves else game.last_move_at
+    return played_at.strftime('%Y.%m.%d')
+
+
+def game_pgn(game, moves, site=''):
+    """
+    One game in PGN. ``moves`` are the game's ``(ply, uci, clock_ms,
+    played_at)`` rows in ply order.
+    """
+    result = game_result(game)
+    tags = [
+        ('Event', 'Casual game'),
+        ('Site', f'{site}/game/{game.id}/'),
+        ('Date', _date(game, moves)),
+        ('Round', '-'),
+        ('White', game.player1.username),
+        ('Black', game.player2.username if game.player2 else '?'),
+        ('Result', result),
+        ('TimeControl', f'{game.time_base}+{game.time_increment}' if game.time_base is not None else '-'),
+    ]
+    if game.game_status not in ('active', 'ended'):
+        tags.append(('Termination', game.game_status))
+
+    movetext = []
+    if not _is_complete(game, moves):
+        tags += [('SetUp', '1'), ('FEN', game.fen)]
+    else:
+        board = chess.Board()
+        for ply, uci, clock_ms, _ in moves:
+            move = chess.Move.from_uci(uci)
+            if ply % 2:
+                movetext.append(f'{(ply + 1) // 2}.')
+            movetext.append(board.san(move))
+            board.push(move)
+            if clock_ms is not None:
+                movetext.append(f'{{[%clk {_format_clock(clock_ms)}]}}')
+    movetext.append(result)
+
+    header = ''.join(f'[{name} "{_escape(value)}"]\n' for name, value in tags)
+    body = textwrap.fill(' '.join(movetext), width=79, break_long_words=False, break_on_hyphens=False)
+    return f'{header}\n{body}\n\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def game_ndjson(game, moves, site=''):
+    """One game as a line of JSON; ``moves`` as for ``game_pgn``."""
+    complete = _is_complete(game, moves)
+    record = {
+        'id': game.id,
+        'url': f'{site}/game/{game.id}/',
+        'date': _date(game, moves).replace('.', '-'),
+        'white': game.player1.username,
+        'black': game.player2.username if game.player2 else None,
+        'result': game_result(game),
+        'status': game.game_status,
+        'time_control': [game.time_base, game.time_increment] if game.time_base is not None else None,
+        # UCI moves from the initial position; null when the log is incomplete.
+        'moves': ' '.join(uci for _, uci, _, _ in moves) if complete else None,
+        'clocks': [clock_ms for _, _, clock_ms, _ in moves] if complete and game.time_base is not None else None,
+        'fen': game.fen,
+    }
+    return json.dumps(record, separators=(',', ':')) + '\n'
+
+
+def iter_games(games, chunk_size=200):
+    """
+    ``(game, moves)`` for each game of the ``games`` queryset, in id order,
+    reading ``chunk_size`` games at a time.
+    """
+    games = games.select_related('player1', 'player2').order_by('id')
+    last_id = 0
+    while True:
+        chunk = list(games.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+            return
+        last_id = chunk[-1].id
+        moves = (
+            GameMove.objects.filter(game_id__in=[game.id for game in chunk])
+            .order_by('game_id', 'ply')
+            .values_list('game_id', 'ply', 'uci', 'clock_ms', 'played_at')
+            .iterator(chunk_size=chunk_size)
+        )
+        pending = next(moves, None)
+        for game in chunk:
+            game_moves = []
+            while pending is not None and pending[0] == game.id:
+                game_moves.append(pending[1:])
+                pending = next(moves, None)
+            yield game, game_moves
+
+
+def export_lines(games, fmt, site='', chunk_size=200):
+    render = game_pgn if fmt == 'pgn' else game_ndjson
+    for game, moves in iter_games(games, chunk_size):
+        yield render(game, moves, site)
+
+
+async def stream(lines, max_buffers=4):
+    """
+    Iterate the sync iterable ``lines`` in a thread, inside one
+    ``sync_to_async`` call so its cursors stay open, and yield its text in
+    pieces of about ``BUFFER_SIZE`` bytes as a ``StreamingHttpResponse``
+    body.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(max_buffers)
+    stopped = False
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def produce():
+        buffer, size = [], 0
+        try:
+            for line in lines:
+                if stopped:
+                    return
+                buffer.append(line)
+                size += len(line)
+                if size >= BUFFER_SIZE:
+                    put(''.join(buffer).encode())
+                    buffer, size = [], 0
+            if buffer:
+                put(''.join(buffer).encode())
+        finally:
+            # Closes the open cursor in this thread, not whenever the
+            # generator happens to be collected.
+            if hasattr(lines, 'close'):
+                lines.close()
+            put(None)
+
+    producer = asyncio.ensure_future(timed_sync_to_async(produce)())
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            yield item
+    finally:
+        # The client went away: let the producer finish its current put and stop.
+        stopped = True
+        while not producer.done():
+            try:
+                queue.get_nowait()
+            except asyncio.QueueEmpty:
+                await asyncio.sleep(0.01)
+        await producer
@@ -0,0 +1,136 @@
+"""
+Fan-out of game events to spectators.
+
+Players of a game are members of the ``game_<id>`` group as before. Spectator
+sockets are not added to any channel-layer group: instead the first spectator
+of a game on a worker makes that worker join ``spectate_<id>`` with a single
+relay channel, and every event received on it is handed to the worker's local
+spectator consumers in-process. A move in a game with thousands of
+spectators therefore costs one channel-layer message per worker watching it
+rather than one per spectator.
+
+The spectator count is the number of spectators connected to this worker,
+which is all of them when a game's sockets are served by one worker. Joins
+and leaves only mark it changed; the relay sends it at most once every
+``SPECTATOR_COUNT_INTERVAL`` seconds, so a crowd arriving at once costs a
+few messages rather than one per spectator to every socket of the game.
+"""
+import asyncio
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .metrics import timed_group_send
+
+logger = logging.getLogger(__name__)
+
+
+def player_group(game_id):
+    return f'game_{game_id}'
+
+
+def spectator_group(game_id):
+    return f'spectate_{game_id}'
+
+
+async def send_to_game(game_id, event, channel_layer=None):
+    """Send an event to the players and to every worker with spectators of the game."""
+    channel_layer = channel_layer or get_channel_layer()
+    await timed_group_send(channel_layer, player_group(game_id), event)
+    await timed_group_send(channel_layer, spectator_group(game_id), event)
+
+
+def send_to_game_sync(game_id, event):
+    async_to_sync(send_to_game)(game_id, event)
+
+
+class _Relay:
+    def __init__(self):
+        self.channel = None
+        self.task = None
+        self.spectators = set()
+        # Whether spectators joined or left since the count was last sent.
+        self.count_changed = False
+        # Done once the relay channel has joined the spectator group.
+        self.ready = asyncio.get_running_loop().create_future()
+
+
+class SpectatorHub:
+    def __init__(self):
+        self._relays = {}
+
+    def count(self, game_id):
+        relay = self._relays.get(game_id)
+        return len(relay.spectators) if relay else 0
+
+    async def add(self, game_id, consumer):
+        relay = self._relays.get(game_id)
+        if relay is None:
+            # Registered before the first await, so spectators arriving
+            # while it is set up join this relay rather than start another.
+            relay = self._relays[game_id] = _Relay()
+            relay.spectators.add(consumer)
+            relay.count_changed = True
+            channel_layer = consumer.channel_layer
+            try:
+                relay.channel = await channel_layer.new_channel()
+                relay.task = asyncio.create_task(self._relay(game_id, relay, channel_layer))
+                await channel_layer.group_add(spectator_group(game_id), relay.channel)
+            finally:
+                relay.ready.set_result(None)
+        else:
+            relay.spectators.add(consumer)
+            relay.count_changed = True
+
+    async def remove(self, game_id, consumer):
+        relay = self._relays.get(game_id)
+        if relay is None:
+            return
+        relay.spectators.discard(consumer)
+        if relay.spectators:
+            relay.count_changed = True
+            return
+        del self._relays[game_id]
+        # Let a setup still in progress finish before undoing it.
+        await relay.ready
+        if relay.task is not None:
+            relay.task.cancel()
+        if relay.channel is not None:
+            await consumer.channel_layer.group_discard(spectator_group(game_id), relay.channel)
+        # The relay that would have sent it is gone.
+        await self._announce(game_id, consumer.channel_layer)
+
+    async def _announce(self, game_id, channel_layer):
+        await send_to_game(game_id, {
+            'type': 'spectator_count',
+            'count': self.count(game_id),
+        }, channel_layer)
+
+    async def _announce_changes(self, game_id, relay, channel_layer):
+        while True:
+            await asyncio.sleep(settings.SPECTATOR_COUNT_INTERVAL)
+            if relay.count_changed:
+                relay.count_changed = False
+                try:
+                    await self._announce(game_id, channel_layer)
+                except Exception:
+                    logger.exception('Failed to announce the spectators of game %s', game_id)
+
+    async def _relay(self, game_id, relay, channel_layer):
+        announcer = asyncio.create_task(self._announce_changes(game_id, relay, channel_layer))
+        try:
+            while True:
+                event = await channel_layer.receive(relay.channel)
+                handler_name = event['type'].replace('.', '_')
+                for consumer in list(relay.spectators):
+                    try:
+                        await getattr(consumer, handler_name)(event)
+                    except Exception:
+                        logger.exception('Failed to relay %s to a spectator of game %s', event['type'], game_id)
+        finally:
+            announcer.cancel()
+
+
+spectator_hub = SpectatorHub()
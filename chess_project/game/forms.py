@@ -2,7 +2,17 @@ from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
 
+from .pgn import IMPORTED_PREFIX, UNNAMED_PREFIX
+
+
 class RegisterForm(UserCreationForm):
     class Meta:
         model = User
         fields = ['username', 'password1', 'password2']
+
+    def clean_username(self):
+        username = super().clean_username()
+        # Kept for the players of imported games.
+        if username.startswith((IMPORTED_PREFIX, UNNAMED_PREFIX)):
+            raise forms.ValidationError('This username is reserved.')
+        return username
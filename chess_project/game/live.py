@@ -0,0 +1,213 @@
+"""
+In-process state of the games being played on this worker.
+
+The first socket that connects to ``game_<id>`` loads the game once; after
+that ``GameConsumer`` validates and applies moves against the live board
+held here instead of re-reading the row on every move. The cache is
+authoritative for a game as long as every socket of that game is served by
+the same process, which nginx arranges by hashing the game id to a worker.
+When workers are added or drained, games move to another worker; a session
+left cached without sockets is therefore checked against the row before a
+socket uses it again.
+
+Sessions nobody is connected to are evicted once they have been idle for
+``GAME_SESSION_IDLE_TIMEOUT`` seconds, or least recently used first when more
+than ``GAME_SESSION_CACHE_SIZE`` games are cached. Sessions with changes not
+yet written by ``game.persistence`` are kept until they are.
+
+The game's ``ply`` doubles as the version of its row. A session only writes
+the row if it still has the ply the session last saw there; if some other
+process moved the game on, the session is marked stale and dropped, and its
+sockets load the game again.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+
+import chess
+from django.conf import settings
+from django.utils import timezone
+
+from .metrics import timed_sync_to_async
+from .models import ChessGame, GameMove
+from .positions import position_cache, position_key
+
+
+class GameSession:
+    def __init__(self, game, moves=()):
+        """
+        Rebuild the board from the game's last snapshot and the logged moves
+        played after it. The board's move stack then holds exactly the
+        moves since the last irreversible one, which is all that repetition
+        detection needs.
+        """
+        self.game = game
+        self.board = chess.Board(game.snapshot_fen)
+        self.unsaved_moves = []
+        self.connections = 0
+        self.dirty = False
+        self.stale = False
+        # The game row in the database as far as this session knows; it
+        # is only written while it still looks like this.
+        self.saved_ply = game.ply
+        self.saved_active = game.is_active
+        self.last_used = time.monotonic()
+
+        for uci in moves:
+            self.board.push_uci(uci)
+
+        self.key = position_key(self.board)
+        self._position = None
+        # (ply, fen, last move or None if not known here), replaced in one
+        # assignment so views on other threads never see half a move.
+        self.shown = (game.ply, game.fen, moves[-1] if moves else None)
+
+    @property
+    def game_id(self):
+        return self.game.id
+
+    def is_player(self, user):
+        # An anonymous user's id is None, like player2_id of a game nobody
+        # has joined yet.
+        return user.is_authenticated and user.id in (self.game.player1_id, self.game.player2_id)
+
+    def player_to_move(self):
+        return self.game.player1 if self.board.turn == chess.WHITE else self.game.player2
+
+    def is_turn_of(self, user):
+        return user.id == (self.game.player1_id if self.board.turn == chess.WHITE else self.game.player2_id)
+
+    def position(self):
+        if self._position is None:
+            self._position = position_cache.get(self.board, self.key)
+        return self._position
+
+    def push(self, uci):
+        """Apply a move in UCI notation. Raises ValueError if it is illegal."""
+        if uci not in self.position().legal_moves:
+            raise ValueError(f'illegal move: {uci!r}')
+        board = self.board
+        move = chess.Move.from_uci(uci)
+        irreversible = board.is_irreversible(move)
+        self._count_move(board.turn)
+        board.push(move)
+        self.key = position_key(board)
+        self._position = None
+
+        game = self.game
+        game.ply += 1
+        game.fen = board.fen()
+        game.last_move_at = timezone.now()
+        self.unsaved_moves.append(GameMove(game_id=game.id, ply=game.ply, uci=move.uci(), played_at=game.last_move_at))
+
+        if irreversible:
+            # No earlier position can repeat, so start a new snapshot here
+            # and drop the history the board no longer needs.
+            board.clear_stack()
+            game.snapshot_fen = game.fen
+            game.snapshot_ply = game.ply
+        self.shown = (game.ply, game.fen, move.uci())
+        return move
+
+    def _count_move(self, color):
+        if color == chess.WHITE:
+            self.game.player1_move_count += 1
+        else:
+            self.game.player2_move_count += 1
+
+
+class GameSessionCache:
+    def __init__(self, max_size=1000, idle_timeout=300):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._sessions = OrderedDict()
+        self._loading = {}
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, game_id):
+        session = self._sessions.get(game_id)
+        if session is not None:
+            self._touch(session)
+        return session
+
+    def peek(self, game_id):
+        """The cached session of a game, without counting as a use; safe from other threads."""
+        session = self._sessions.get(game_id)
+        return None if session is None or session.stale else session
+
+    async def acquire(self, game_id):
+        """
+        Return the session of the game, loading it if needed, and count one
+        more socket as connected to it. Raises ChessGame.DoesNotExist.
+        """
+        session = self._sessions.get(game_id)
+        if session is not None and session.connections <= 0 and not session.dirty:
+            # Nobody here has used it lately; another worker may have since.
+            if not await timed_sync_to_async(self._is_current)(session):
+                self.discard(session)
+                session = self._sessions.get(game_id)
+        if session is None:
+            # Sockets connecting at the same time share a single load.
+            loading = self._loading.get(game_id)
+            if loading is None:
+                loading = asyncio.ensure_future(self._load(game_id))
+                self._loading[game_id] = loading
+                loading.add_done_callback(lambda _: self._loading.pop(game_id, None))
+            session = await loading
+
+        session.connections += 1
+        self._touch(session)
+        self.evict()
+        return session
+
+    def release(self, session):
+        session.connections -= 1
+        self._touch(session)
+        self.evict()
+
+    def discard(self, session):
+        """Drop a stale session so the next acquire loads the game again."""
+        session.stale = True
+        if self._sessions.get(session.game_id) is session:
+            del self._sessions[session.game_id]
+
+    def evict(self):
+        now = time.monotonic()
+        for game_id, session in list(self._sessions.items()):
+            idle_for = now - session.last_used
+            if idle_for <= self.idle_timeout and len(self._sessions) <= self.max_size:
+                break
+            if session.connections <= 0 and not session.dirty:
+                del self._sessions[game_id]
+
+    def _touch(self, session):
+        session.last_used = time.monotonic()
+        self._sessions.move_to_end(session.game_id)
+
+    async def _load(self, game_id):
+        game, moves = await timed_sync_to_async(self._fetch)(game_id)
+        return self._sessions.setdefault(game_id, GameSession(game, moves))
+
+    @staticmethod
+    def _is_current(session):
+        return ChessGame.objects.filter(
+            id=session.game_id, ply=session.saved_ply, is_active=session.saved_active,
+        ).exists()
+
+    @staticmethod
+    def _fetch(game_id):
+        game = ChessGame.objects.select_related('player1', 'player2', 'current_turn').get(id=game_id)
+        moves = list(
+            GameMove.objects.filter(game=game, ply__gt=game.snapshot_ply, ply__lte=game.ply)
+            .order_by('ply')
+            .values_list('uci', flat=True)
+        )
+        return game, moves
+
+
+game_sessions = GameSessionCache(
+    max_size=settings.GAME_SESSION_CACHE_SIZE,
+    idle_timeout=settings.GAME_SESSION_IDLE_TIMEOUT,
+)
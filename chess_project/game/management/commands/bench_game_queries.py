@@ -0,0 +1,138 @@
+import random
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.utils import setup_databases, teardown_databases
+
+from game.models import ChessGame
+
+
+def timed(func, args_list):
+    durations = []
+    for args in args_list:
+        started = time.perf_counter()
+        func(*args)
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a throwaway test database with games and time the active-game '
+        'and finished-game lookups with and without the partial indexes on '
+        'ChessGame.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--games', type=int, default=1_000_000, help='Number of games to seed.')
+        parser.add_argument('--users', type=int, default=10_000, help='Number of users the games are spread over.')
+        parser.add_argument('--active', type=float, default=0.002, help='Fraction of the games that are active.')
+        parser.add_argument('--samples', type=int, default=200, help='Lookups per query and configuration.')
+        parser.add_argument('--seed', type=int, default=0, help='Seed for the generated data.')
+        parser.add_argument('--explain', action='store_true', help='Print the query plans with the indexes in place.')
+
+    def handle(self, *args, **options):
+        if options['users'] < 2:
+            raise CommandError('--users must be at least 2.')
+        self.random = random.Random(options['seed'])
+
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            self.seed(options['games'], options['users'], options['active'])
+            queries = self.queries(options['samples'])
+            if options['explain']:
+                self.explain()
+
+            with_indexes = self.measure(queries)
+            self.drop_indexes()
+            without_indexes = self.measure(queries)
+        finally:
+            connections.close_all()
+            teardown_databases(old_config, verbosity=0)
+
+        self.report(with_indexes, without_indexes)
+
+    def seed(self, games, users, active):
+        started = time.perf_counter()
+        User.objects.bulk_create(
+            [User(username=f'bench{i}', password='!') for i in range(users)],
+            batch_size=5000,
+        )
+        self.user_ids = list(User.objects.values_list('id', flat=True))
+
+        batch = []
+        for _ in range(games):
+            player1, player2 = self.random.sample(self.user_ids, 2)
+            batch.append(ChessGame(player1_id=player1, player2_id=player2, is_active=self.random.random() < active))
+            if len(batch) == 10_000:
+                ChessGame.objects.bulk_create(batch)
+                batch = []
+        ChessGame.objects.bulk_create(batch)
+        self.analyze()
+        self.stdout.write(f'Seeded {games} games for {users} users in {time.perf_counter() - started:.1f}s')
+
+    def analyze(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def queries(self, samples):
+        users = [self.random.choice(self.user_ids) for _ in range(samples)]
+        pairs = [tuple(self.random.sample(self.user_ids, 2)) for _ in range(samples)]
+        return [
+            (
+                'active game for user (login, check_game_status)',
+                lambda user: ChessGame.objects.active_for(user).values_list('id', flat=True).first(),
+                [(user,) for user in users],
+            ),
+            (
+                'active game between users (send_invite)',
+                lambda user, other: ChessGame.objects.active_between(user, other).exists(),
+                pairs,
+            ),
+            (
+                'finished games for user (home)',
+                lambda user: list(ChessGame.objects.finished_for(user).select_related('player1', 'player2')),
+                [(user,) for user in users],
+            ),
+            (
+                'all active games (sync_presence)',
+                lambda: list(ChessGame.objects.filter(is_active=True).values_list('player1_id', 'player2_id')),
+                [()] * max(1, samples // 20),
+            ),
+        ]
+
+    def explain(self):
+        user, other = self.user_ids[:2]
+        for queryset in (
+            ChessGame.objects.active_for(user).values_list('id', flat=True)[:1],
+            ChessGame.objects.active_between(user, other),
+            ChessGame.objects.finished_for(user),
+        ):
+            self.stdout.write(str(queryset.query))
+            self.stdout.write(queryset.explain())
+            self.stdout.write('')
+
+    def measure(self, queries):
+        results = {}
+        for name, func, args_list in queries:
+            durations = timed(func, args_list)
+            results[name] = (statistics.median(durations), sorted(durations)[int(len(durations) * 0.95)])
+        return results
+
+    def drop_indexes(self):
+        with connection.schema_editor() as schema_editor:
+            for index in ChessGame._meta.indexes:
+                schema_editor.remove_index(ChessGame, index)
+        self.analyze()
+
+    def report(self, with_indexes, without_indexes):
+        self.stdout.write(f"{'query':<50} {'indexed p50/p95 ms':>20} {'unindexed p50/p95 ms':>22} {'speedup':>8}")
+        for name, (median, p95) in with_indexes.items():
+            old_median, old_p95 = without_indexes[name]
+            self.stdout.write(
+                f'{name:<50} {median * 1000:>9.3f}/{p95 * 1000:<10.3f} '
+                f'{old_median * 1000:>10.3f}/{old_p95 * 1000:<11.3f} {old_median / median:>7.1f}x'
+            )
@@ -0,0 +1,187 @@
+import multiprocessing
+import os
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from game.models import ChessGame, GameMove, PgnImport
+from game.pgn import UNNAMED_PREFIX, parse_chunk, split_games
+
+
+class Command(BaseCommand):
+    help = (
+        'Import the games of PGN files as finished games. The games are parsed '
+        'in a pool of processes and written in batches, one transaction each, '
+        'together with how far the file has been read: an interrupted import '
+        'resumes where it stopped when run again. Players get inactive accounts '
+        'without a usable password, apart from the site\'s users: "pgn." and '
+        'their name, or one "pgn-" account each for players a game does not name.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='PGN files to import.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Parsing processes; 0 parses in this process.')
+        parser.add_argument('--batch-size', type=int, default=2000, help='Games written per transaction.')
+        parser.add_argument('--chunk-size', type=int, default=200, help='Games handed to a parsing process at a time.')
+        parser.add_argument('--restart', action='store_true', help='Read the files from the start, even if imported before.')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['chunk_size'] < 1:
+            raise CommandError('--batch-size and --chunk-size must be at least 1.')
+        if options['workers'] < 0:
+            raise CommandError('--workers must not be negative.')
+        self.batch_size = options['batch_size']
+        self.chunk_size = options['chunk_size']
+        self.workers = options['workers']
+        self.user_ids = {}
+
+        executor = None
+        if self.workers:
+            # Spawned rather than forked: the workers need nothing of this
+            # process, least of all its database connections.
+            executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            for path in options['paths']:
+                self.import_file(os.path.abspath(path), executor, options['restart'])
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+    def import_file(self, path, executor, restart):
+        try:
+            size = os.path.getsize(path)
+        except OSError as error:
+            raise CommandError(f'Cannot read {path}: {error}')
+        progress, created = PgnImport.objects.get_or_create(path=path, defaults={'size': size})
+        if restart and not created:
+            progress.offset = progress.games = progress.skipped = 0
+            progress.size, progress.finished = size, False
+            progress.save()
+        elif progress.size != size:
+            raise CommandError(f'{path} has changed since it was last imported; use --restart to import it again.')
+        elif progress.finished:
+            self.stdout.write(f'{path}: already imported ({progress.games} games), skipping.')
+            return
+        elif progress.offset:
+            self.stdout.write(f'{path}: resuming at byte {progress.offset} after {progress.games} games.')
+
+        started = time.monotonic()
+        games_at_start = progress.games
+        batch, skipped = [], {}
+        with open(path, 'rb') as stream:
+            for offset, records, chunk_skipped in self.parse(stream, progress.offset, executor):
+                batch.extend(records)
+                for reason, count in chunk_skipped.items():
+                    skipped[reason] = skipped.get(reason, 0) + count
+                # Batches end on chunk boundaries, where the file can be resumed.
+                if len(batch) >= self.batch_size:
+                    self.write(progress, batch, skipped, offset)
+                    self.report(progress, games_at_start, started)
+                    batch, skipped = [], {}
+            self.write(progress, batch, skipped, stream.tell(), finished=True)
+        self.report(progress, games_at_start, started)
+        if progress.skipped:
+            self.stdout.write(f'{path}: {progress.skipped} games skipped, see the messages above.')
+        self.stdout.write(self.style.SUCCESS(f'{path}: imported {progress.games} games.'))
+
+    def parse(self, stream, start, executor):
+        """``(end_offset, records, skipped)`` per chunk, in file order."""
+        chunks = split_games(stream, start, self.chunk_size)
+        if executor is None:
+            for offset, games in chunks:
+                yield (offset, *parse_chunk(games))
+            return
+        # A few chunks per process in flight: enough to keep them busy, few
+        # enough that the file is not read faster than it is written.
+        pending = deque()
+        for offset, games in chunks:
+            pending.append((offset, executor.submit(parse_chunk, games)))
+            if len(pending) >= 2 * self.workers:
+                offset, future = pending.popleft()
+                yield (offset, *future.result())
+        while pending:
+            offset, future = pending.popleft()
+            yield (offset, *future.result())
+
+    def write(self, progress, records, skipped, offset, finished=False):
+        with transaction.atomic():
+            names = [name for record in records for name in record[:2]]
+            user_ids = self.get_user_ids({name for name in names if name is not None})
+            unnamed = iter(self.create_unnamed(names.count(None)))
+            games = ChessGame.objects.bulk_create(
+                [self.make_game(record, user_ids, unnamed) for record in records],
+                batch_size=self.batch_size,
+            )
+            GameMove.objects.bulk_create(
+                (
+                    GameMove(game_id=game.id, ply=ply, uci=uci, played_at=game.last_move_at, clock_ms=clock_ms)
+                    for game, record in zip(games, records)
+                    for ply, (uci, clock_ms) in enumerate(record[9], 1)
+                ),
+                batch_size=10 * self.batch_size,
+            )
+            progress.offset = offset
+            progress.games += len(games)
+            progress.skipped += sum(skipped.values())
+            progress.finished = finished
+            progress.save(update_fields=['offset', 'games', 'skipped', 'finished', 'updated_at'])
+        for reason, count in skipped.items():
+            self.stderr.write(f'Skipped {count} games: {reason}.')
+
+    def get_user_ids(self, names):
+        missing = [name for name in names if name not in self.user_ids]
+        if missing:
+            User.objects.bulk_create([self.placeholder(name) for name in missing], ignore_conflicts=True)
+            self.user_ids.update(
+                User.objects.filter(username__in=missing, is_active=False).values_list('username', 'id')
+            )
+            # Registered before the prefix was reserved.
+            taken = [name for name in missing if name not in self.user_ids]
+            if taken:
+                raise CommandError(f'Users already have the names of imported players: {", ".join(taken[:10])}.')
+        return self.user_ids
+
+    def create_unnamed(self, count):
+        """The ids of ``count`` new accounts for players the games do not name."""
+        names = [f'{UNNAMED_PREFIX}{uuid.uuid4().hex}' for _ in range(count)]
+        User.objects.bulk_create([self.placeholder(name) for name in names], batch_size=self.batch_size)
+        ids = dict(User.objects.filter(username__in=names).values_list('username', 'id'))
+        return [ids[name] for name in names]
+
+    @staticmethod
+    def placeholder(name):
+        return User(username=name, password=make_password(None), is_active=False)
+
+    def make_game(self, record, user_ids, unnamed):
+        white, black, result, status, played_at, time_control, fen, snapshot_fen, snapshot_ply, moves = record
+        ply = len(moves)
+        return ChessGame(
+            player1_id=next(unnamed) if white is None else user_ids[white],
+            player2_id=next(unnamed) if black is None else user_ids[black],
+            is_active=False,
+            game_status=status,
+            result=result,
+            fen=fen,
+            ply=ply,
+            move_count=ply,
+            player1_move_count=(ply + 1) // 2,
+            player2_move_count=ply // 2,
+            snapshot_fen=snapshot_fen,
+            snapshot_ply=snapshot_ply,
+            time_base=time_control[0] if time_control else None,
+            time_increment=time_control[1] if time_control else 0,
+            last_move_at=played_at or timezone.now(),
+        )
+
+    def report(self, progress, games_at_start, started):
+        elapsed = time.monotonic() - started
+        rate = (progress.games - games_at_start) / elapsed if elapsed else 0
+        percent = 100 * progress.offset / progress.size if progress.size else 100
+        self.stdout.write(f'{percent:5.1f}%  {progress.games} games  {rate:.0f} games/s')
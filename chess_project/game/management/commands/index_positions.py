@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from game.explorer import index_games
+from game.models import ChessGame, PositionMove
+
+
+class Command(BaseCommand):
+    help = (
+        'Add the finished games not indexed yet to the opening explorer, e.g. '
+        'after a large import; the reaper otherwise indexes games as they '
+        'finish. --rebuild empties the index and counts every game again.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Empty the index first and index every finished game.')
+        parser.add_argument('--batch-size', type=int, default=2000, help='Games indexed per transaction.')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        if options['rebuild']:
+            with transaction.atomic():
+                PositionMove.objects.all().delete()
+                ChessGame.objects.filter(positions_indexed=True).update(positions_indexed=False)
+            self.stdout.write('Emptied the position index.')
+
+        started = time.monotonic()
+        total = 0
+        while True:
+            count = index_games(options['batch_size'])
+            if not count:
+                break
+            total += count
+            elapsed = time.monotonic() - started
+            self.stdout.write(f'{total} games  {total / elapsed if elapsed else 0:.0f} games/s')
+        self.stdout.write(self.style.SUCCESS(f'Indexed {total} games.'))
@@ -0,0 +1,269 @@
+import asyncio
+import json
+import random
+import statistics
+import time
+import tracemalloc
+
+import chess
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+from game import metrics
+
+# Everything the harness needs runs in this process: no Redis, and a
+# throwaway test database instead of the configured one.
+LOADTEST_SETTINGS = {
+    'CHANNEL_LAYERS': {
+        'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'},
+    },
+    'PRESENCE': {
+        'BACKEND': 'game.presence.InMemoryPresence',
+        'CONFIG': {'ttl': 90, 'heartbeat_interval': 30},
+    },
+    'MATCHMAKING': {
+        'BACKEND': 'game.matchmaking.InMemoryMatchmaker',
+    },
+}
+
+
+class Socket:
+    """A simulated browser socket that counts what it receives."""
+
+    def __init__(self, application, path, cookie, stats, timeout):
+        self.communicator = WebsocketCommunicator(application, path, headers=[(b'cookie', cookie.encode())])
+        self.stats = stats
+        self.timeout = timeout
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=self.timeout)
+        if not connected:
+            raise CommandError(f'Socket to {self.communicator.scope["path"]} was refused')
+
+    async def send(self, **message):
+        await self.communicator.send_to(text_data=json.dumps(message))
+
+    async def receive(self, action=None):
+        """The next message, or the next one with the given action."""
+        while True:
+            message = json.loads(await self.communicator.receive_from(timeout=self.timeout))
+            self.stats['messages'] += 1
+            if action is None or message.get('action') == action:
+                return message
+
+    async def drain(self):
+        while not await self.communicator.receive_nothing(timeout=0.01):
+            await self.receive()
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class Player:
+    def __init__(self, user, cookie):
+        self.user = user
+        self.cookie = cookie
+        self.lobby = None
+        self.game = None
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def kib_per(size, count):
+    return size / 1024 / count if count else 0.0
+
+
+class Command(BaseCommand):
+    help = (
+        'Simulate players that log in, join the lobby, invite each other and '
+        'play random games over the game sockets, then report move latency, '
+        'throughput, queries per move and memory per connection. Runs offline '
+        'against an in-memory channel layer and a test database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20, help='Number of simulated users; pairs of them play one game.')
+        parser.add_argument('--max-plies', type=int, default=80, help='Resign games that have not ended after this many plies.')
+        parser.add_argument('--seed', type=int, default=None, help='Seed for the random move choice.')
+        parser.add_argument('--timeout', type=float, default=10.0, help='Seconds to wait for any single message.')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON.')
+        parser.add_argument('--max-p99-ms', type=float, default=None, help='Fail if the p99 move round trip is slower.')
+        parser.add_argument('--max-queries-per-move', type=float, default=None, help='Fail if moves need more queries on average.')
+        parser.add_argument('--max-sync-hops-per-move', type=float, default=None, help='Fail if moves make more sync_to_async calls on average.')
+
+    def handle(self, *args, **options):
+        users = options['users']
+        if users < 2 or users % 2:
+            raise CommandError('--users must be an even number of at least 2.')
+        self.random = random.Random(options['seed'])
+        self.timeout = options['timeout']
+
+        with override_settings(**LOADTEST_SETTINGS):
+            old_config = setup_databases(verbosity=0, interactive=False)
+            try:
+                report = self.run(users, options['max_plies'])
+            finally:
+                connections.close_all()
+                teardown_databases(old_config, verbosity=0)
+
+        self.print_report(report, options['json'])
+        failures = self.check_thresholds(report, options)
+        if failures:
+            raise CommandError('; '.join(failures))
+        if not options['json']:
+            self.stdout.write(self.style.SUCCESS('Load test finished.'))
+
+    def run(self, users, max_plies):
+        # Imported here so the consumers pick up the loadtest settings.
+        from chess_project.asgi import application
+
+        players = self.log_in(users)
+        self.application = application
+        self.stats = {'messages': 0}
+        return async_to_sync(self.simulate)(players, max_plies)
+
+    def log_in(self, count):
+        User.objects.bulk_create([User(username=f'loadtest{i}') for i in range(count)])
+        players = []
+        for user in User.objects.filter(username__startswith='loadtest').order_by('id'):
+            client = Client()
+            client.force_login(user)
+            cookie = f'{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}'
+            players.append(Player(user, cookie))
+        return players
+
+    def socket(self, path, player):
+        return Socket(self.application, path, player.cookie, self.stats, self.timeout)
+
+    async def simulate(self, players, max_plies):
+        from game.persistence import game_writer
+
+        report = {'users': len(players), 'games': len(players) // 2}
+        started = time.perf_counter()
+
+        tracemalloc.start()
+        before, _ = tracemalloc.get_traced_memory()
+        for player in players:
+            player.lobby = self.socket('/ws/lobby/', player)
+            await player.lobby.connect()
+        await asyncio.gather(*(player.lobby.drain() for player in players))
+        after, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report['lobby_kib_per_connection'] = kib_per(after - before, len(players))
+
+        pairs = [(players[i], players[i + 1]) for i in range(0, len(players), 2)]
+        game_ids = await asyncio.gather(*(self.invite(sender, receiver) for sender, receiver in pairs))
+
+        tracemalloc.start()
+        before, _ = tracemalloc.get_traced_memory()
+        for game_id, (white, black) in zip(game_ids, pairs):
+            for player in (white, black):
+                player.game = self.socket(f'/ws/game/{game_id}/?encoding=delta', player)
+                await player.game.connect()
+                await player.game.receive('role')
+        after, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report['game_kib_per_connection'] = kib_per(after - before, 2 * len(pairs))
+
+        messages_before = self.stats['messages']
+        queries_before = metrics.queries.value()
+        hops_before = metrics.handler_sync_calls.value('GameConsumer', 'move')
+        play_started = time.perf_counter()
+        results = await asyncio.gather(*(self.play(white, black, max_plies) for white, black in pairs))
+        await game_writer.flush()
+        await asyncio.gather(*(player.lobby.drain() for player in players))
+        play_seconds = time.perf_counter() - play_started
+
+        round_trips = [rtt for game_round_trips in results for rtt in game_round_trips]
+        moves = len(round_trips)
+        report['moves'] = moves
+        report['play_seconds'] = play_seconds
+        report['messages_per_second'] = (self.stats['messages'] - messages_before) / play_seconds if play_seconds else 0.0
+        report['queries_per_move'] = (metrics.queries.value() - queries_before) / moves if moves else 0.0
+        hops = metrics.handler_sync_calls.value('GameConsumer', 'move') - hops_before
+        report['sync_hops_per_move'] = hops / moves if moves else 0.0
+        if round_trips:
+            report['rtt_ms'] = {
+                'p50': percentile(round_trips, 0.50) * 1000,
+                'p90': percentile(round_trips, 0.90) * 1000,
+                'p99': percentile(round_trips, 0.99) * 1000,
+                'max': max(round_trips) * 1000,
+                'mean': statistics.fmean(round_trips) * 1000,
+            }
+
+        for player in players:
+            await player.game.close()
+            await player.lobby.close()
+        report['total_seconds'] = time.perf_counter() - started
+        return report
+
+    async def invite(self, sender, receiver):
+        await sender.lobby.send(action='send_invite', user_id=receiver.user.id)
+        invite = await receiver.lobby.receive('receive_invite')
+        await receiver.lobby.send(action='respond_invite', invite_id=invite['invite_id'], response='accept')
+        started = await sender.lobby.receive('start_game')
+        await receiver.lobby.receive('start_game')
+        return started['game_id']
+
+    async def play(self, white, black, max_plies):
+        """Play random legal moves until the game ends; returns the move round trips."""
+        board = chess.Board()
+        round_trips = []
+        while not board.is_game_over():
+            mover, opponent = (white, black) if board.turn == chess.WHITE else (black, white)
+            if board.ply() >= max_plies:
+                await mover.game.send(action='exit')
+                await mover.game.receive('game_status')
+                await opponent.game.receive('game_status')
+                break
+
+            move = self.random.choice(list(board.legal_moves)).uci()
+            sent = time.perf_counter()
+            await mover.game.send(action='move', move=move)
+            echo = await mover.game.receive('move')
+            round_trips.append(time.perf_counter() - sent)
+            if echo.get('move') != move:
+                raise CommandError(f'Expected {move} back, got {echo}')
+            await opponent.game.receive('move')
+            board.push_uci(move)
+        return round_trips
+
+    def print_report(self, report, as_json):
+        if as_json:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        self.stdout.write(f"{report['users']} users, {report['games']} games, {report['moves']} moves in {report['total_seconds']:.2f}s")
+        rtt = report.get('rtt_ms')
+        if rtt:
+            self.stdout.write(
+                f"move round trip: p50 {rtt['p50']:.2f}ms  p90 {rtt['p90']:.2f}ms  "
+                f"p99 {rtt['p99']:.2f}ms  max {rtt['max']:.2f}ms"
+            )
+        self.stdout.write(f"messages/s: {report['messages_per_second']:.0f}")
+        self.stdout.write(f"queries/move: {report['queries_per_move']:.3f}")
+        self.stdout.write(f"sync_to_async hops/move: {report['sync_hops_per_move']:.3f}")
+        self.stdout.write(
+            f"memory/connection: lobby {report['lobby_kib_per_connection']:.1f} KiB, "
+            f"game {report['game_kib_per_connection']:.1f} KiB"
+        )
+
+    def check_thresholds(self, report, options):
+        failures = []
+        p99 = report.get('rtt_ms', {}).get('p99')
+        if options['max_p99_ms'] is not None and p99 is not None and p99 > options['max_p99_ms']:
+            failures.append(f"p99 move round trip {p99:.2f}ms is over {options['max_p99_ms']}ms")
+        if options['max_queries_per_move'] is not None and report['queries_per_move'] > options['max_queries_per_move']:
+            failures.append(f"{report['queries_per_move']:.3f} queries per move is over {options['max_queries_per_move']}")
+        if options['max_sync_hops_per_move'] is not None and report['sync_hops_per_move'] > options['max_sync_hops_per_move']:
+            failures.append(f"{report['sync_hops_per_move']:.3f} sync_to_async hops per move is over {options['max_sync_hops_per_move']}")
+        return failures
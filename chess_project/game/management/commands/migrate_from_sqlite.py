@@ -0,0 +1,214 @@
+import json
+import re
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core import serializers
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections, router, transaction
+from django.db.migrations.executor import MigrationExecutor
+
+SOURCE_ALIAS = 'migrate_from_sqlite_source'
+
+
+def iter_fixture(path, chunk_size=1 << 16):
+    """
+    Yield the objects of a ``dumpdata`` JSON fixture one at a time, reading
+    it in chunks rather than all at once. Returns whether the fixture was
+    complete; a truncated one yields every object before the cut.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as fixture:
+        buffer = fixture.read(chunk_size).lstrip()
+        if not buffer.startswith('['):
+            raise CommandError(f'{path} is not a JSON list of objects.')
+        buffer = buffer[1:]
+        at_end = False
+        while True:
+            buffer = buffer.lstrip()
+            if buffer.startswith(','):
+                buffer = buffer[1:].lstrip()
+            if buffer.startswith(']'):
+                return True
+            try:
+                obj, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if at_end:
+                    return False
+                chunk = fixture.read(chunk_size)
+                at_end = not chunk
+                buffer += chunk
+                continue
+            yield obj
+            buffer = buffer[end:]
+
+
+CONTENT_TYPE_OBJECT = re.compile(r'"model"\s*:\s*"contenttypes\.contenttype"')
+
+
+def has_content_types(path, chunk_size=1 << 16):
+    """
+    Whether a ``dumpdata`` fixture holds content types. A plain text scan, so
+    a large fixture is not parsed twice.
+    """
+    with open(path, encoding='utf-8') as fixture:
+        tail = ''
+        while True:
+            chunk = fixture.read(chunk_size)
+            if not chunk:
+                return False
+            text = tail + chunk
+            if CONTENT_TYPE_OBJECT.search(text):
+                return True
+            # Enough to catch a match split across chunks.
+            tail = text[-64:]
+
+
+def batches(iterable, size, key=lambda item: None):
+    """Lists of up to ``size`` consecutive items with the same ``key``."""
+    batch, batch_key = [], None
+    for item in iterable:
+        item_key = key(item)
+        if batch and (item_key != batch_key or len(batch) == size):
+            yield batch
+            batch = []
+        batch.append(item)
+        batch_key = item_key
+    if batch:
+        yield batch
+
+
+class Command(BaseCommand):
+    help = (
+        'Copy the data of a SQLite database and/or a dumpdata JSON fixture into '
+        'the configured database, typically PostgreSQL, in batches. Rows keep '
+        'their primary keys and rows that already exist are overwritten, so the '
+        'command can be re-run. Everything is copied in one transaction.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sqlite', default=str(settings.BASE_DIR / 'db.sqlite3'),
+            help='SQLite database to copy; pass an empty string to skip it.',
+        )
+        parser.add_argument(
+            '--fixture', action='append', default=[],
+            help='dumpdata JSON fixture to load after the SQLite data, e.g. backup.json. May be repeated.',
+        )
+        parser.add_argument('--batch-size', type=int, default=2000, help='Rows read and written per query.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Database to copy into.')
+
+    def handle(self, *args, **options):
+        self.target = options['database']
+        self.batch_size = options['batch_size']
+        if self.batch_size < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        if options['sqlite'] and connections[self.target].vendor == 'sqlite' and \
+                str(connections[self.target].settings_dict['NAME']) == options['sqlite']:
+            raise CommandError('The SQLite database to copy is the database to copy into.')
+        self.check_migrated(self.target, 'the target database')
+
+        started = time.perf_counter()
+        self.copied_models = set()
+        # The content types created by migrate are replaced with the copied
+        # ones, whose ids the copied rows use. Deleting them also deletes
+        # their permissions, so only when the source brings its own.
+        replace_content_types = bool(options['sqlite']) or any(map(has_content_types, options['fixture']))
+        with transaction.atomic(using=self.target):
+            if replace_content_types:
+                ContentType.objects.using(self.target).all().delete()
+                ContentType.objects.clear_cache()
+            if options['sqlite']:
+                self.copy_sqlite(options['sqlite'])
+            for path in options['fixture']:
+                self.load_fixture(path)
+            self.reset_sequences()
+        ContentType.objects.clear_cache()
+        self.stdout.write(self.style.SUCCESS(f'Copied the data in {time.perf_counter() - started:.1f}s.'))
+
+    def check_migrated(self, alias, name):
+        executor = MigrationExecutor(connections[alias])
+        if executor.migration_plan(executor.loader.graph.leaf_nodes()):
+            raise CommandError(f'Apply all migrations to {name} first (manage.py migrate).')
+
+    def writable_models(self):
+        for model in apps.get_models(include_auto_created=True):
+            if model._meta.managed and not model._meta.proxy and router.allow_migrate_model(self.target, model):
+                yield model
+
+    def copy_sqlite(self, path):
+        # configure_settings() fills in the defaults of a DATABASES entry; it
+        # insists on the entry being called 'default'.
+        connections.settings[SOURCE_ALIAS] = connections.configure_settings({
+            DEFAULT_DB_ALIAS: {'ENGINE': 'django.db.backends.sqlite3', 'NAME': path},
+        })[DEFAULT_DB_ALIAS]
+        try:
+            self.check_migrated(SOURCE_ALIAS, path)
+            tables = set(connections[SOURCE_ALIAS].introspection.table_names())
+            for model in self.writable_models():
+                if model._meta.db_table not in tables:
+                    continue
+                rows = model._base_manager.using(SOURCE_ALIAS).order_by('pk').iterator(chunk_size=self.batch_size)
+                count = sum(self.save_batch(model, batch) for batch in batches(rows, self.batch_size))
+                self.stdout.write(f'{model._meta.label}: {count} rows from {path}')
+        finally:
+            connections[SOURCE_ALIAS].close()
+            del connections[SOURCE_ALIAS]
+            del connections.settings[SOURCE_ALIAS]
+
+    def load_fixture(self, path):
+        counts = {}
+        complete = False
+
+        def objects():
+            nonlocal complete
+            complete = yield from iter_fixture(path)
+
+        for batch in batches(objects(), self.batch_size, key=lambda obj: obj['model']):
+            deserialized = list(serializers.deserialize('python', batch, using=self.target, ignorenonexistent=True))
+            model = type(deserialized[0].object)
+            counts[model._meta.label] = counts.get(model._meta.label, 0) + self.save_batch(
+                model, [item.object for item in deserialized], [item.m2m_data for item in deserialized],
+            )
+        for label, count in counts.items():
+            self.stdout.write(f'{label}: {count} rows from {path}')
+        if not complete:
+            self.stderr.write(self.style.WARNING(
+                f'{path} is truncated; loaded the {sum(counts.values())} complete objects before the cut.'
+            ))
+
+    def save_batch(self, model, instances, m2m_data=None):
+        fields = [field.name for field in model._meta.concrete_fields if not field.primary_key]
+        model._base_manager.using(self.target).bulk_create(
+            instances,
+            update_conflicts=bool(fields),
+            ignore_conflicts=not fields,
+            unique_fields=[model._meta.pk.name] if fields else None,
+            update_fields=fields or None,
+        )
+        if m2m_data:
+            self.save_m2m(model, instances, m2m_data)
+        self.copied_models.add(model)
+        return len(instances)
+
+    def save_m2m(self, model, instances, m2m_data):
+        for field in model._meta.many_to_many:
+            through = field.remote_field.through
+            source, target = f'{field.m2m_field_name()}_id', f'{field.m2m_reverse_field_name()}_id'
+            rows = [
+                through(**{source: instance.pk, target: related})
+                for instance, data in zip(instances, m2m_data)
+                for related in data.get(field.name, ())
+            ]
+            through._base_manager.using(self.target).bulk_create(rows, batch_size=self.batch_size, ignore_conflicts=True)
+            self.copied_models.add(through)
+
+    def reset_sequences(self):
+        connection = connections[self.target]
+        statements = connection.ops.sequence_reset_sql(no_style(), list(self.copied_models))
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
@@ -0,0 +1,46 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+
+from game.reaper import Reaper
+
+
+class Command(BaseCommand):
+    help = (
+        'Expire stale invites, end abandoned games, clear expired sessions, '
+        'index finished games for the opening explorer and rate the finished '
+        'games not rated yet, in small batches. Runs every REAPER["INTERVAL"] '
+        'seconds until stopped unless --once is given.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Make one pass and exit.')
+        parser.add_argument('--interval', type=float, default=None, help='Seconds between passes.')
+        parser.add_argument('--batch-size', type=int, default=None, help='Rows handled per query.')
+        parser.add_argument('--pause', type=float, default=None, help='Seconds to sleep between batches.')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] is not None and options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        reaper = Reaper.from_settings(batch_size=options['batch_size'], pause=options['pause'])
+        interval = options['interval'] if options['interval'] is not None else settings.REAPER['INTERVAL']
+
+        while True:
+            started = time.monotonic()
+            try:
+                counts = reaper.run()
+            except DatabaseError as error:
+                # Keep going, e.g. while the database restarts or is still
+                # being migrated; the next pass picks up where this one failed.
+                if options['once']:
+                    raise
+                self.stderr.write(f'Reaping failed: {error}')
+                counts = {}
+            summary = ', '.join(f'{count} {name}' for name, count in counts.items() if count)
+            if summary or options['once']:
+                self.stdout.write(f'{summary or "Nothing to reap"} in {time.monotonic() - started:.1f}s.')
+            if options['once']:
+                return
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
@@ -0,0 +1,137 @@
+import itertools
+import time
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+
+from game.models import ChessGame, PlayerRating
+from game.ratings import SCORES, replay
+
+# Game ids per query when marking games rated.
+UPDATE_BATCH_SIZE = 5000
+
+
+def batches(ids):
+    for start in range(0, len(ids), UPDATE_BATCH_SIZE):
+        yield ids[start:start + UPDATE_BATCH_SIZE]
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute every rating from the finished games, replayed in Glicko-2 '
+        'rating periods of RATINGS["PERIOD"] seconds, e.g. after changing the '
+        'rating settings or importing games. Games that end while it runs are '
+        'rated on top of the new ratings by the reaper.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--period', type=float, default=None, help='Seconds per rating period.')
+        parser.add_argument('--tau', type=float, default=None, help='Glicko-2 system constant.')
+        parser.add_argument('--dry-run', action='store_true', help='Show the top of the new ratings without saving them.')
+
+    def handle(self, *args, **options):
+        period = options['period'] or settings.RATINGS['PERIOD']
+        tau = options['tau'] or settings.RATINGS['TAU']
+        if period <= 0 or tau <= 0:
+            raise CommandError('--period and --tau must be positive.')
+        started = time.monotonic()
+
+        # Games up to max_id that were active when read, and any created
+        # since, may end and be rated while this runs; see save().
+        max_id = ChessGame.objects.aggregate(Max('id'))['id__max'] or 0
+        active_ids = list(ChessGame.objects.filter(is_active=True, id__lte=max_id).values_list('id', flat=True))
+        game_ids, white, black, score, times = [], [], [], [], []
+        for game_id, player1_id, player2_id, result, ended_at in (
+            ChessGame.objects.filter(is_active=False, id__lte=max_id)
+            .values_list('id', 'player1_id', 'player2_id', 'result', 'last_move_at')
+            .iterator(chunk_size=10000)
+        ):
+            game_ids.append(game_id)
+            if result in SCORES and player2_id is not None:
+                white.append(player1_id)
+                black.append(player2_id)
+                score.append(SCORES[result])
+                times.append(ended_at)
+        self.stdout.write(f'Read {len(game_ids)} finished games in {time.monotonic() - started:.1f}s.')
+
+        timestamps = np.array([ended_at.timestamp() for ended_at in times])
+        order = np.argsort(timestamps, kind='stable')
+        user_ids, players = np.unique(np.r_[white, black].astype(np.int64), return_inverse=True)
+        white_index, black_index = players[:len(white)][order], players[len(white):][order]
+        # Periods counted from the epoch, so they fall the same way every run.
+        periods = (timestamps[order] // period).astype(np.int64)
+
+        ratings = (
+            np.full(len(user_ids), float(settings.RATINGS['INITIAL_RATING'])),
+            np.full(len(user_ids), float(settings.RATINGS['INITIAL_DEVIATION'])),
+            np.full(len(user_ids), float(settings.RATINGS['INITIAL_VOLATILITY'])),
+            np.full(len(user_ids), -1, dtype=np.int64),
+        )
+        if times:
+            replay(
+                white_index, black_index, np.array(score)[order], periods, ratings,
+                tau, settings.RATINGS['INITIAL_DEVIATION'],
+            )
+        games = np.bincount(np.r_[white_index, black_index], minlength=len(user_ids))
+        # The position in ``order`` of each player's last game.
+        last_game = np.full(len(user_ids), -1, dtype=np.int64)
+        positions = np.arange(len(order))
+        np.maximum.at(last_game, white_index, positions)
+        np.maximum.at(last_game, black_index, positions)
+        self.stdout.write(
+            f'Replayed {len(times)} rated games of {len(user_ids)} players in '
+            f'{len(np.unique(periods))} rating periods in {time.monotonic() - started:.1f}s.'
+        )
+
+        new_ratings = [
+            PlayerRating(
+                user_id=int(user_id), rating=float(rating), deviation=float(deviation),
+                volatility=float(volatility), games=int(count), last_game_at=times[order[last]],
+            )
+            for user_id, rating, deviation, volatility, count, last in zip(user_ids, *ratings[:3], games, last_game)
+        ]
+        if options['dry_run']:
+            self.show(new_ratings)
+            return
+        self.save(new_ratings, np.array(game_ids, dtype=np.int64), max_id, active_ids)
+        self.stdout.write(self.style.SUCCESS(
+            f'Saved the ratings of {len(new_ratings)} players in {time.monotonic() - started:.1f}s.'
+        ))
+
+    def save(self, new_ratings, game_ids, max_id, active_ids):
+        with transaction.atomic():
+            PlayerRating.objects.all().delete()
+            PlayerRating.objects.bulk_create(new_ratings, batch_size=1000)
+
+            # The games replayed count as rated from now on...
+            unrated = np.fromiter(
+                ChessGame.objects.filter(is_active=False, rated=False, id__lte=max_id).values_list('id', flat=True),
+                dtype=np.int64,
+            )
+            replayed = unrated[np.isin(unrated, game_ids)].tolist()
+            for batch in batches(replayed):
+                ChessGame.objects.filter(id__in=batch).update(rated=True)
+            # ...and games that ended and were rated while this ran are rated
+            # again, on top of the new ratings.
+            ended = ChessGame.objects.filter(is_active=False, rated=True)
+            ended_since = np.fromiter(
+                itertools.chain(
+                    ended.filter(id__gt=max_id).values_list('id', flat=True),
+                    *(ended.filter(id__in=batch).values_list('id', flat=True) for batch in batches(active_ids)),
+                ),
+                dtype=np.int64,
+            )
+            for batch in batches(ended_since[~np.isin(ended_since, game_ids)].tolist()):
+                ChessGame.objects.filter(id__in=batch).update(rated=False)
+
+    def show(self, new_ratings):
+        names = dict(User.objects.filter(id__in=[rating.user_id for rating in new_ratings]).values_list('id', 'username'))
+        for rating in sorted(new_ratings, key=lambda rating: -rating.rating)[:20]:
+            self.stdout.write(
+                f'{names.get(rating.user_id, rating.user_id):<30} {rating.rating:7.1f} '
+                f'± {2 * rating.deviation:5.1f}  {rating.games} games'
+            )
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from game.models import ChessGame
+from game.presence import get_presence
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the set of users marked as busy in the presence registry from active games.'
+
+    def handle(self, *args, **options):
+        user_ids = set()
+        for player1_id, player2_id in ChessGame.objects.filter(is_active=True).values_list('player1_id', 'player2_id').iterator():
+            user_ids.add(player1_id)
+            if player2_id:
+                user_ids.add(player2_id)
+
+        get_presence().reset_busy(sorted(user_ids))
+        self.stdout.write(self.style.SUCCESS(f'Marked {len(user_ids)} users as busy.'))
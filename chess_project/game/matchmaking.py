@@ -0,0 +1,415 @@
+"""
+Matchmaking queue behind the lobby's ``find_match`` action.
+
+Players wait in one queue per time control, ordered by rating. A player
+joining a queue is paired at once with the closest-rated player already
+waiting, if that player's rating window allows it; finding them is a range
+lookup on the queue, so joining costs O(log n) however many are waiting.
+Otherwise the player waits. Windows start at ``rating_window`` points and
+widen by ``window_growth`` points a second up to ``max_rating_window``, so
+players are paired ever more loosely the longer they wait: once every
+``interval`` seconds a pairing pass walks each queue in rating order and
+pairs neighbours that are now close enough. Only one worker runs the pass at
+a time, whichever holds the pairer lock. The worker that pairs two players
+creates their game and sends both to it, as an accepted invite would.
+
+The default backend keeps the queues in the Redis instance that already
+backs ``CHANNEL_LAYERS``, so players on different workers are paired with
+each other:
+
+    matchmaking:queue:<time control>  sorted set  user id -> rating
+    matchmaking:tickets               hash        user id -> "<time control>|<queued at>"
+    matchmaking:queues                set         time controls with players waiting
+    matchmaking:pairer                string      token of the worker running the pass
+
+Time controls are "<base>+<increment>" or "untimed". Players whose lobby
+sockets are all gone for longer than the presence ``ttl`` (game/presence.py)
+are dropped from the queues by the pass, so a crashed worker cannot leave
+them waiting forever.
+"""
+import asyncio
+import logging
+import random
+import time
+import uuid
+import weakref
+
+import redis.asyncio
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .metrics import timed_group_send
+from .models import PlayerRating
+from .presence import ONLINE_KEY, abroadcast, get_presence
+from .services import create_match
+
+logger = logging.getLogger(__name__)
+
+TICKETS_KEY = 'matchmaking:tickets'
+QUEUES_KEY = 'matchmaking:queues'
+QUEUE_PREFIX = 'matchmaking:queue:'
+PAIRER_KEY = 'matchmaking:pairer'
+
+# Start of the scripts working on one queue, whose first KEYS are tickets
+# and queues and whose ARGV start with queue prefix, time control, base
+# window, growth, max window, now. window() is the rating window of a
+# waiting player.
+QUEUE_SCRIPT = """
+local queue = ARGV[1] .. ARGV[2]
+local base_window, growth, max_window, now = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6])
+local function window(user_id)
+    local ticket = redis.call('HGET', KEYS[1], user_id)
+    local since = ticket and tonumber(string.match(ticket, '|(.*)$')) or now
+    return math.min(base_window + growth * (now - since), max_window)
+end
+"""
+
+# KEYS: tickets, queues  ARGV: as QUEUE_SCRIPT, then user id, rating, candidates
+# Returns the id and rating of the opponent found, or an empty list when the user was queued.
+ENQUEUE_SCRIPT = QUEUE_SCRIPT + """
+local user_id, rating = ARGV[7], tonumber(ARGV[8])
+local old = redis.call('HGET', KEYS[1], user_id)
+if old then
+    redis.call('ZREM', ARGV[1] .. string.match(old, '^([^|]*)'), user_id)
+    redis.call('HDEL', KEYS[1], user_id)
+end
+local best, best_rating, best_gap
+local function consider(candidates)
+    for i = 1, #candidates, 2 do
+        local other, other_rating = candidates[i], tonumber(candidates[i + 1])
+        local gap = math.abs(other_rating - rating)
+        if gap <= window(other) and (not best or gap < best_gap) then
+            best, best_rating, best_gap = other, other_rating, gap
+        end
+    end
+end
+consider(redis.call('ZRANGEBYSCORE', queue, rating, '+inf', 'WITHSCORES', 'LIMIT', 0, ARGV[9]))
+consider(redis.call('ZREVRANGEBYSCORE', queue, rating, '-inf', 'WITHSCORES', 'LIMIT', 0, ARGV[9]))
+if best then
+    redis.call('ZREM', queue, best)
+    redis.call('HDEL', KEYS[1], best)
+    if redis.call('ZCARD', queue) == 0 then
+        redis.call('SREM', KEYS[2], ARGV[2])
+    end
+    return {best, tostring(best_rating)}
+end
+redis.call('ZADD', queue, rating, user_id)
+redis.call('HSET', KEYS[1], user_id, ARGV[2] .. '|' .. ARGV[6])
+redis.call('SADD', KEYS[2], ARGV[2])
+return {}
+"""
+
+# KEYS: tickets, queues  ARGV: queue prefix, user id
+# Returns 1 if the user was queued.
+CANCEL_SCRIPT = """
+local ticket = redis.call('HGET', KEYS[1], ARGV[2])
+if not ticket then return 0 end
+local time_control = string.match(ticket, '^([^|]*)')
+redis.call('ZREM', ARGV[1] .. time_control, ARGV[2])
+redis.call('HDEL', KEYS[1], ARGV[2])
+if redis.call('ZCARD', ARGV[1] .. time_control) == 0 then
+    redis.call('SREM', KEYS[2], time_control)
+end
+return 1
+"""
+
+# KEYS: tickets, queues, online  ARGV: as QUEUE_SCRIPT, then online cutoff
+# Pairs neighbours in rating order whose gap is within the wider of their
+# windows, and drops players who went offline. Returns a flat list of
+# id, rating, id, rating per pair.
+PAIR_SCRIPT = QUEUE_SCRIPT + """
+local waiting = redis.call('ZRANGE', queue, 0, -1, 'WITHSCORES')
+local result = {}
+local previous, previous_rating
+for i = 1, #waiting, 2 do
+    local user_id, rating = waiting[i], tonumber(waiting[i + 1])
+    local seen = redis.call('ZSCORE', KEYS[3], user_id)
+    if (not seen) or tonumber(seen) < tonumber(ARGV[7]) then
+        redis.call('ZREM', queue, user_id)
+        redis.call('HDEL', KEYS[1], user_id)
+    elseif previous and rating - previous_rating <= math.max(window(previous), window(user_id)) then
+        redis.call('ZREM', queue, previous, user_id)
+        redis.call('HDEL', KEYS[1], previous, user_id)
+        table.insert(result, previous)
+        table.insert(result, tostring(previous_rating))
+        table.insert(result, user_id)
+        table.insert(result, tostring(rating))
+        previous = nil
+    else
+        previous, previous_rating = user_id, rating
+    end
+end
+if redis.call('ZCARD', queue) == 0 then
+    redis.call('SREM', KEYS[2], ARGV[2])
+end
+return result
+"""
+
+# KEYS: pairer  ARGV: token, lock milliseconds
+# Takes the pairer lock, or extends it if this token already holds it.
+LEAD_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+
+def time_control_key(time_control):
+    """The name of the queue for ``(base, increment)``; base is None for untimed games."""
+    base, increment = time_control
+    return 'untimed' if base is None else f'{base}+{increment}'
+
+
+def parse_time_control_key(key):
+    if key == 'untimed':
+        return None, 0
+    base, increment = key.split('+')
+    return int(base), int(increment)
+
+
+async def arating_for(user):
+    """The Glicko-2 rating ``user`` is matched with, see game/ratings.py."""
+    rating = await PlayerRating.objects.filter(user=user).values_list('rating', flat=True).afirst()
+    return settings.RATINGS['INITIAL_RATING'] if rating is None else rating
+
+
+def _pairs(flat, time_control):
+    return [
+        ((int(flat[i]), float(flat[i + 1])), (int(flat[i + 2]), float(flat[i + 3])), time_control)
+        for i in range(0, len(flat), 4)
+    ]
+
+
+class RedisMatchmaker:
+    """
+    Matchmaking backend storing its queues in Redis. Every method is a
+    coroutine for use from consumers and the pairing loop.
+    """
+
+    def __init__(self, url='redis://localhost:6379/0', rating_window=100, window_growth=10,
+                 max_rating_window=400, interval=1.0, candidates=8, ttl=90):
+        self.url = url
+        self.rating_window = rating_window
+        self.window_growth = window_growth
+        self.max_rating_window = max_rating_window
+        self.interval = interval
+        # Waiting players looked at on each side of a joining player's rating.
+        self.candidates = candidates
+        self.ttl = ttl
+        self.token = uuid.uuid4().hex
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def async_client(self):
+        # redis.asyncio connections are bound to the loop that opened them.
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_clients:
+            client = redis.asyncio.Redis.from_url(self.url, decode_responses=True)
+            self._async_clients[loop] = (client, {
+                'enqueue': client.register_script(ENQUEUE_SCRIPT),
+                'cancel': client.register_script(CANCEL_SCRIPT),
+                'pair': client.register_script(PAIR_SCRIPT),
+                'lead': client.register_script(LEAD_SCRIPT),
+            })
+        return self._async_clients[loop]
+
+    def _queue_args(self, key):
+        return [QUEUE_PREFIX, key, self.rating_window, self.window_growth, self.max_rating_window, time.time()]
+
+    async def aenqueue(self, user_id, rating, time_control):
+        """
+        Queue ``user_id`` for a game with ``time_control``, replacing any
+        earlier search of theirs. Returns ``(user id, rating)`` of the
+        opponent found at once, who is no longer queued, or None.
+        """
+        _, scripts = self.async_client()
+        key = time_control_key(time_control)
+        result = await scripts['enqueue'](
+            keys=[TICKETS_KEY, QUEUES_KEY],
+            args=[*self._queue_args(key), user_id, rating, self.candidates],
+        )
+        return (int(result[0]), float(result[1])) if result else None
+
+    async def acancel(self, *user_ids):
+        """Take ``user_ids`` out of the queues; returns whether any was queued."""
+        _, scripts = self.async_client()
+        cancelled = False
+        for user_id in user_ids:
+            cancelled |= bool(await scripts['cancel'](keys=[TICKETS_KEY, QUEUES_KEY], args=[QUEUE_PREFIX, user_id]))
+        return cancelled
+
+    async def apair(self):
+        """
+        One pairing pass over every queue. Returns ``((user id, rating),
+        (user id, rating), time control)`` for each pair made.
+        """
+        client, scripts = self.async_client()
+        cutoff = time.time() - self.ttl
+        pairs = []
+        for key in await client.smembers(QUEUES_KEY):
+            flat = await scripts['pair'](
+                keys=[TICKETS_KEY, QUEUES_KEY, ONLINE_KEY],
+                args=[*self._queue_args(key), cutoff],
+            )
+            pairs += _pairs(flat, parse_time_control_key(key))
+        return pairs
+
+    async def alead(self):
+        """Whether this worker runs the pairing pass, taking the lock if it is free."""
+        _, scripts = self.async_client()
+        return bool(await scripts['lead'](keys=[PAIRER_KEY], args=[self.token, int(self.interval * 3000)]))
+
+
+class InMemoryMatchmaker:
+    """
+    Matchmaking backend keeping its queues in this process.
+
+    Behaves like ``RedisMatchmaker`` but only pairs players on this worker;
+    meant for development and for ``manage.py loadtest``, which runs without
+    Redis. Players are not dropped for going offline here: their sockets
+    cancel their search when they close.
+    """
+
+    def __init__(self, rating_window=100, window_growth=10, max_rating_window=400, interval=1.0):
+        self.rating_window = rating_window
+        self.window_growth = window_growth
+        self.max_rating_window = max_rating_window
+        self.interval = interval
+        # time control -> [(rating, user id)] in rating order
+        self._queues = {}
+        # user id -> (time control, queued at)
+        self._tickets = {}
+
+    def _window(self, user_id, now):
+        since = self._tickets[user_id][1]
+        return min(self.rating_window + self.window_growth * (now - since), self.max_rating_window)
+
+    def _remove(self, user_id):
+        time_control, _ = self._tickets.pop(user_id)
+        queue = self._queues[time_control]
+        queue[:] = [entry for entry in queue if entry[1] != user_id]
+        if not queue:
+            del self._queues[time_control]
+
+    async def aenqueue(self, user_id, rating, time_control):
+        now = time.time()
+        if user_id in self._tickets:
+            self._remove(user_id)
+        queue = self._queues.setdefault(time_control, [])
+        best = None
+        for other_rating, other in queue:
+            gap = abs(other_rating - rating)
+            if gap <= self._window(other, now) and (best is None or gap < best[0]):
+                best = (gap, other, other_rating)
+        if best is not None:
+            self._remove(best[1])
+            return best[1], best[2]
+        queue.append((rating, user_id))
+        queue.sort()
+        self._tickets[user_id] = (time_control, now)
+        return None
+
+    async def acancel(self, *user_ids):
+        cancelled = False
+        for user_id in user_ids:
+            if user_id in self._tickets:
+                self._remove(user_id)
+                cancelled = True
+        return cancelled
+
+    async def apair(self):
+        now = time.time()
+        pairs = []
+        for time_control, queue in list(self._queues.items()):
+            previous = None
+            for rating, user_id in list(queue):
+                if previous is not None and rating - previous[0] <= max(
+                    self._window(previous[1], now), self._window(user_id, now),
+                ):
+                    self._remove(previous[1])
+                    self._remove(user_id)
+                    pairs.append(((previous[1], previous[0]), (user_id, rating), time_control))
+                    previous = None
+                else:
+                    previous = (rating, user_id)
+        return pairs
+
+    async def alead(self):
+        return True
+
+
+_matchmaker = None
+
+
+def get_matchmaker():
+    global _matchmaker
+    if _matchmaker is None:
+        config = settings.MATCHMAKING
+        backend = import_string(config['BACKEND'])
+        _matchmaker = backend(**config.get('CONFIG', {}))
+    return _matchmaker
+
+
+@receiver(setting_changed)
+def reset_matchmaker(setting, **kwargs):
+    global _matchmaker
+    if setting == 'MATCHMAKING':
+        _matchmaker = None
+
+
+async def start_match(player, opponent, time_control):
+    """
+    Create the game of two players taken off a queue, each ``(user id,
+    rating)``, with colours drawn at random, and send both to it. A player
+    who started a game some other way meanwhile is left out, and the other
+    one goes back in the queue.
+    """
+    players = [player, opponent]
+    random.shuffle(players)
+    game, busy = await create_match(players[0][0], players[1][0], time_control)
+    if game is None:
+        for user_id, rating in players:
+            if user_id not in busy:
+                other = await get_matchmaker().aenqueue(user_id, rating, time_control)
+                if other is not None:
+                    await start_match((user_id, rating), other, time_control)
+        return None
+
+    await abroadcast(await get_presence().aset_busy(game.player1_id, game.player2_id))
+    channel_layer = get_channel_layer()
+    for user_id in (game.player1_id, game.player2_id):
+        await timed_group_send(channel_layer, f'user_{user_id}', {
+            'type': 'start_game',
+            'game_id': game.id,
+        })
+    return game
+
+
+_pairers = weakref.WeakKeyDictionary()
+
+
+def ensure_pairer():
+    """Start this worker's pairing loop; the pass itself runs on one worker at a time."""
+    loop = asyncio.get_running_loop()
+    task = _pairers.get(loop)
+    if task is None or task.done():
+        _pairers[loop] = loop.create_task(run_pairer())
+
+
+async def run_pairer():
+    matchmaker = get_matchmaker()
+    while True:
+        await asyncio.sleep(matchmaker.interval)
+        try:
+            if not await matchmaker.alead():
+                continue
+            for player, opponent, time_control in await matchmaker.apair():
+                await start_match(player, opponent, time_control)
+        except Exception:
+            logger.exception('Matchmaking pass failed')
@@ -0,0 +1,279 @@
+"""
+In-process metrics, served by the ``metrics`` view in the Prometheus text
+exposition format.
+
+Consumers that inherit ``InstrumentedConsumer`` time every message they
+handle. Messages from the browser are labelled with their ``action``; events
+from the channel layer with their type. While a message is handled, the time
+spent waiting on ``timed_sync_to_async`` (the thread hop and the ORM work in
+the thread) and the database queries it runs are added to the message, so
+the time left over is what the handler spent on the event loop.
+
+Each worker process keeps its own numbers; scrape every worker. Updating a
+metric is a lock and a few additions, cheap enough to leave on.
+"""
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f'{self.name}{_format_labels(self.label_names, labels)} {value}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *labels, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum.
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            values = sorted((labels, list(counts)) for labels, counts in self._values.items())
+        names = self.label_names + ('le',)
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(names, labels + (bound,))} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.label_names, labels)} {counts[-1]}')
+            lines.append(f'{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+handler_seconds = registry.register(Histogram(
+    'chess_ws_handler_seconds',
+    'Time to handle one socket message, by consumer and action or event type.',
+    labels=('consumer', 'handler'),
+))
+handler_sync_seconds = registry.register(Counter(
+    'chess_ws_handler_sync_seconds_total',
+    'Part of chess_ws_handler_seconds spent waiting on sync_to_async.',
+    labels=('consumer', 'handler'),
+))
+handler_sync_calls = registry.register(Counter(
+    'chess_ws_handler_sync_calls_total',
+    'Calls to sync_to_async made while handling socket messages.',
+    labels=('consumer', 'handler'),
+))
+handler_queries = registry.register(Counter(
+    'chess_ws_handler_queries_total',
+    'Database queries run while handling socket messages.',
+    labels=('consumer', 'handler'),
+))
+sync_to_async_seconds = registry.register(Histogram(
+    'chess_sync_to_async_seconds',
+    'Time from handing a call to the sync thread until its result is back on the event loop.',
+))
+queries = registry.register(Counter(
+    'chess_db_queries_total',
+    'Database queries, including those run outside of socket handlers.',
+))
+group_send_seconds = registry.register(Histogram(
+    'chess_group_send_seconds',
+    'Latency of channel layer group_send, by kind of group.',
+    labels=('group',),
+))
+open_sockets = registry.register(Gauge(
+    'chess_ws_open_sockets',
+    'Open sockets on this worker, by kind of group they belong to.',
+    labels=('group',),
+))
+
+
+class _Span:
+    __slots__ = ('handler', 'sync_calls', 'sync_seconds', 'queries')
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.sync_calls = 0
+        self.sync_seconds = 0.0
+        self.queries = 0
+
+
+_current_span = contextvars.ContextVar('chess_metrics_span', default=None)
+
+
+def set_action(action):
+    """Label the socket message being handled with the client's action."""
+    span = _current_span.get()
+    if span is not None:
+        span.handler = action
+
+
+class InstrumentedConsumer:
+    """
+    Consumer mixin timing every message. Client actions not listed in
+    ``metric_actions`` are recorded as ``unknown`` to keep labels bounded.
+    """
+
+    metric_actions = ()
+
+    async def dispatch(self, message):
+        span = _Span(message['type'])
+        token = _current_span.set(span)
+        started = time.perf_counter()
+        try:
+            await super().dispatch(message)
+        finally:
+            elapsed = time.perf_counter() - started
+            _current_span.reset(token)
+            handler = span.handler
+            if message['type'] == 'websocket.receive' and handler not in self.metric_actions:
+                handler = 'unknown'
+            consumer = type(self).__name__
+            handler_seconds.observe(consumer, handler, value=elapsed)
+            if span.sync_calls:
+                handler_sync_calls.inc(consumer, handler, amount=span.sync_calls)
+                handler_sync_seconds.inc(consumer, handler, amount=span.sync_seconds)
+            if span.queries:
+                handler_queries.inc(consumer, handler, amount=span.queries)
+
+
+def _with_fresh_connections(func):
+    # Like channels' database_sync_to_async: the consumers' sync thread lives
+    # as long as the worker, so without this its connections would never be
+    # checked, recycled or given back to the pool.
+    def call(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return call
+
+
+def timed_sync_to_async(func):
+    """
+    ``sync_to_async`` that records how long the caller waited and, like a
+    request, releases database connections that are broken or past
+    ``CONN_MAX_AGE`` before and after the call.
+    """
+    wrapped = sync_to_async(_with_fresh_connections(func))
+
+    async def call(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await wrapped(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            sync_to_async_seconds.observe(value=elapsed)
+            span = _current_span.get()
+            if span is not None:
+                span.sync_calls += 1
+                span.sync_seconds += elapsed
+
+    return call
+
+
+async def timed_group_send(channel_layer, group, message):
+    started = time.perf_counter()
+    await channel_layer.group_send(group, message)
+    # 'game_12' and 'user_3' are labelled 'game' and 'user'.
+    group_send_seconds.observe(group.split('_', 1)[0], value=time.perf_counter() - started)
+
+
+def count_query(execute, sql, params, many, context):
+    queries.inc()
+    # sync_to_async runs the call in a copy of the caller's context, so the
+    # span of the message being handled is visible from the sync thread.
+    span = _current_span.get()
+    if span is not None:
+        span.queries += 1
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(connection):
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
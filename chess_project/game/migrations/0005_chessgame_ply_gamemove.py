@@ -0,0 +1,53 @@
+# Generated by Django 4.2.16 on 2026-10-18 08:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def snapshot_current_positions(apps, schema_editor):
+    # Games created before the move log have no history, so their current
+    # position is the snapshot everything else is replayed from.
+    ChessGame = apps.get_model('game', 'ChessGame')
+    ChessGame.objects.update(snapshot_fen=models.F('fen'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0004_chessgame_player1_move_count_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chessgame',
+            name='ply',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chessgame',
+            name='snapshot_fen',
+            field=models.CharField(default='rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='chessgame',
+            name='snapshot_ply',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(snapshot_current_positions, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='GameMove',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ply', models.IntegerField()),
+                ('uci', models.CharField(max_length=5)),
+                ('played_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('clock_ms', models.IntegerField(blank=True, null=True)),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='moves', to='game.chessgame')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='gamemove',
+            constraint=models.UniqueConstraint(fields=('game', 'ply'), name='unique_game_move_ply'),
+        ),
+    ]
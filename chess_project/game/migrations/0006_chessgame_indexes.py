@@ -0,0 +1,29 @@
+# Generated by Django 4.2.16 on 2026-10-18 09:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0005_chessgame_ply_gamemove'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chessgame',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['player1'], name='game_active_player1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chessgame',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['player2'], name='game_active_player2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chessgame',
+            index=models.Index(condition=models.Q(('is_active', False)), fields=['player1', '-id'], name='game_finished_player1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chessgame',
+            index=models.Index(condition=models.Q(('is_active', False)), fields=['player2', '-id'], name='game_finished_player2_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-18 09:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0006_chessgame_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chessgame',
+            name='game_status',
+            field=models.CharField(default='active', max_length=400),
+        ),
+    ]
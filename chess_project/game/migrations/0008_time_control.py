@@ -0,0 +1,48 @@
+# Generated by Django 4.2.16 on 2026-10-18 09:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0007_chessgame_game_status_length'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chessgame',
+            name='clock_deadline',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chessgame',
+            name='player1_clock_ms',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chessgame',
+            name='player2_clock_ms',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chessgame',
+            name='time_base',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chessgame',
+            name='time_increment',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='gameinvite',
+            name='time_base',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='gameinvite',
+            name='time_increment',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.16 on 2026-10-18 09:23
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0008_time_control'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chessgame',
+            name='last_move_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='gameinvite',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('accepted', 'Accepted'), ('declined', 'Declined'), ('expired', 'Expired')], default='pending', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='chessgame',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['last_move_at'], name='game_active_last_move_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chessgame',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['clock_deadline'], name='game_active_deadline_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gameinvite',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['created_at'], name='invite_pending_created_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.16 on 2026-10-18 09:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0010_pgnimport'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PositionMove',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position_key', models.BigIntegerField()),
+                ('uci', models.CharField(max_length=5)),
+                ('games', models.IntegerField(default=0)),
+                ('white_wins', models.IntegerField(default=0)),
+                ('draws', models.IntegerField(default=0)),
+                ('black_wins', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='chessgame',
+            name='positions_indexed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='chessgame',
+            index=models.Index(condition=models.Q(('is_active', False), ('positions_indexed', False)), fields=['id'], name='game_unindexed_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='positionmove',
+            constraint=models.UniqueConstraint(fields=('position_key', 'uci'), name='unique_position_move'),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 4.2.16 on 2026-10-18 10:01
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import re
+
+
+def results_from_status(apps, schema_editor):
+    # Finished games only had their outcome in the status message until now.
+    ChessGame = apps.get_model('game', 'ChessGame')
+    finished = ChessGame.objects.filter(is_active=False)
+    finished.filter(
+        models.Q(game_status__startswith='Draw') | models.Q(game_status__startswith='Game drawn')
+        | models.Q(game_status__startswith='Stalemate')
+    ).update(result='1/2-1/2')
+
+    games = (
+        finished.filter(models.Q(game_status__contains='wins!') | models.Q(game_status__contains='won by'))
+        .order_by('id')
+        .values_list('id', 'game_status', 'player1__username', 'player2__username')
+    )
+    last_id = 0
+    while True:
+        chunk = list(games.filter(id__gt=last_id)[:1000])
+        if not chunk:
+            return
+        last_id = chunk[-1][0]
+        updates = []
+        for game_id, status, white, black in chunk:
+            match = re.search(r'(\S+) (?:wins!|won by)', status)
+            if match and match.group(1) in (white, 'White'):
+                updates.append(ChessGame(id=game_id, result='1-0'))
+            elif match and match.group(1) in (black, 'Black'):
+                updates.append(ChessGame(id=game_id, result='0-1'))
+        ChessGame.objects.bulk_update(updates, ['result'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('game', '0011_position_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlayerRating',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='rating', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('rating', models.FloatField()),
+                ('deviation', models.FloatField()),
+                ('volatility', models.FloatField()),
+                ('games', models.IntegerField(default=0)),
+                ('last_game_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='chessgame',
+            name='rated',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='chessgame',
+            name='result',
+            field=models.CharField(choices=[('1-0', 'White wins'), ('0-1', 'Black wins'), ('1/2-1/2', 'Draw'), ('*', 'No result')], default='*', max_length=7),
+        ),
+        migrations.RunPython(results_from_status, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chessgame',
+            index=models.Index(condition=models.Q(('is_active', False), ('rated', False)), fields=['id'], name='game_unrated_idx'),
+        ),
+    ]
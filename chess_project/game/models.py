@@ -1,18 +1,105 @@
 from django.db import models
+from django.db.models import Case, F, Q, When
 from django.contrib.auth.models import User
+from django.utils import timezone
 import chess  
 
+class ChessGameQuerySet(models.QuerySet):
+    # is_active is repeated in each branch of the OR so that every branch
+    # matches the condition of one of the partial indexes in ChessGame.Meta.
+    def active_for(self, user):
+        return self.filter(Q(player1=user, is_active=True) | Q(player2=user, is_active=True))
+
+    def active_between(self, user, other):
+        return self.filter(
+            Q(player1=user, player2=other, is_active=True) | Q(player1=other, player2=user, is_active=True)
+        )
+
+    def finished_for(self, user):
+        return self.filter(Q(player1=user, is_active=False) | Q(player2=user, is_active=False)).order_by('-id')
+
+    def history_for(self, user):
+        """The user's finished games with the opponent and the user's move count worked out in SQL."""
+        is_player1 = Q(player1=user)
+        return self.finished_for(user).only('id', 'game_status').annotate(
+            opponent_username=Case(When(is_player1, then=F('player2__username')), default=F('player1__username')),
+            player_move_count=Case(When(is_player1, then=F('player1_move_count')), default=F('player2_move_count')),
+        )
+
+
+# Results of a game, as in PGN. Active games, and games ended without a
+# winner such as abandoned ones, have no result.
+WHITE_WINS = '1-0'
+BLACK_WINS = '0-1'
+DRAW = '1/2-1/2'
+NO_RESULT = '*'
+RESULT_CHOICES = [
+    (WHITE_WINS, 'White wins'),
+    (BLACK_WINS, 'Black wins'),
+    (DRAW, 'Draw'),
+    (NO_RESULT, 'No result'),
+]
+
+
 class ChessGame(models.Model):
     player1 = models.ForeignKey(User, related_name='games_as_player1', on_delete=models.CASCADE)
     player2 = models.ForeignKey(User, related_name='games_as_player2', on_delete=models.CASCADE, null=True, blank=True)  
     fen = models.CharField(max_length=100, default=chess.Board().fen())  
     current_turn = models.ForeignKey(User, related_name='current_turn_games', on_delete=models.SET_NULL, null=True, blank=True) 
     is_active = models.BooleanField(default=True)  
-    game_status = models.CharField(max_length=20, default='active')
+    # Holds messages such as "<username> has resigned. <username> wins!".
+    game_status = models.CharField(max_length=400, default='active')
+    # The outcome for white (player1); game_status says how it came about.
+    result = models.CharField(max_length=7, choices=RESULT_CHOICES, default=NO_RESULT)
     journal_entry = models.TextField(null=True, blank=True)  
     move_count = models.IntegerField(default=0)
     player1_move_count = models.IntegerField(default=0)
     player2_move_count = models.IntegerField(default=0)
+    # Number of half-moves played. fen is the position after ply moves;
+    # snapshot_fen is the position after snapshot_ply moves, the last
+    # irreversible one, so the board with its repetition history is
+    # snapshot_fen plus the GameMove rows after snapshot_ply.
+    ply = models.IntegerField(default=0)
+    snapshot_fen = models.CharField(max_length=100, default=chess.Board().fen())
+    snapshot_ply = models.IntegerField(default=0)
+    # Time control in seconds: each player starts with time_base and gains
+    # time_increment per move. Untimed if time_base is null. The clocks hold
+    # what was left on them when the current turn began; the player to move
+    # runs out of time at clock_deadline. See game/clocks.py.
+    time_base = models.PositiveIntegerField(null=True, blank=True)
+    time_increment = models.PositiveIntegerField(default=0)
+    player1_clock_ms = models.IntegerField(null=True, blank=True)
+    player2_clock_ms = models.IntegerField(null=True, blank=True)
+    clock_deadline = models.DateTimeField(null=True, blank=True)
+    # When the last move was played, or the game created; the reaper ends
+    # games that have been idle for too long, see game/reaper.py.
+    last_move_at = models.DateTimeField(default=timezone.now)
+    # Whether the opening explorer counts the game yet, see game/explorer.py.
+    positions_indexed = models.BooleanField(default=False)
+    # Whether the ratings have taken the finished game into account, or
+    # passed over it for having no result; see game/ratings.py.
+    rated = models.BooleanField(default=False)
+
+    objects = ChessGameQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # The active game of a user; few games are active at any time.
+            models.Index(fields=['player1'], condition=Q(is_active=True), name='game_active_player1_idx'),
+            models.Index(fields=['player2'], condition=Q(is_active=True), name='game_active_player2_idx'),
+            # A user's finished games, newest first.
+            models.Index(fields=['player1', '-id'], condition=Q(is_active=False), name='game_finished_player1_idx'),
+            models.Index(fields=['player2', '-id'], condition=Q(is_active=False), name='game_finished_player2_idx'),
+            # Active games that are idle or out of time, for the reaper.
+            models.Index(fields=['last_move_at'], condition=Q(is_active=True), name='game_active_last_move_idx'),
+            models.Index(fields=['clock_deadline'], condition=Q(is_active=True), name='game_active_deadline_idx'),
+            # Finished games the opening explorer has not counted yet.
+            models.Index(
+                fields=['id'], condition=Q(is_active=False, positions_indexed=False), name='game_unindexed_idx',
+            ),
+            # Finished games the ratings have not taken into account yet.
+            models.Index(fields=['id'], condition=Q(is_active=False, rated=False), name='game_unrated_idx'),
+        ]
     
     def __str__(self):
         return f'Game {self.id}: {self.player1.username} vs {self.player2.username if self.player2 else "Waiting"}'
@@ -21,8 +108,91 @@ class GameInvite(models.Model):
     sender = models.ForeignKey(User, related_name="sent_invites", on_delete=models.CASCADE)
     receiver = models.ForeignKey(User, related_name="received_invites", on_delete=models.CASCADE)
     game = models.ForeignKey(ChessGame, on_delete=models.CASCADE, null=True, blank=True)
-    status = models.CharField(max_length=10, choices=[('pending', 'Pending'), ('accepted', 'Accepted'), ('declined', 'Declined')], default='pending')
+    status = models.CharField(max_length=10, choices=[('pending', 'Pending'), ('accepted', 'Accepted'), ('declined', 'Declined'), ('expired', 'Expired')], default='pending')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Time control of the game the invite starts, as on ChessGame.
+    time_base = models.PositiveIntegerField(null=True, blank=True)
+    time_increment = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Pending invites by age, for the reaper.
+            models.Index(fields=['created_at'], condition=Q(status='pending'), name='invite_pending_created_idx'),
+        ]
 
     def __str__(self):
         return f"Invite from {self.sender.username} to {self.receiver.username}"
+
+
+class GameMove(models.Model):
+    game = models.ForeignKey(ChessGame, related_name='moves', on_delete=models.CASCADE)
+    ply = models.IntegerField()
+    uci = models.CharField(max_length=5)
+    played_at = models.DateTimeField(default=timezone.now)
+    # Milliseconds left on the mover's clock after the move, for timed games.
+    clock_ms = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['game', 'ply'], name='unique_game_move_ply'),
+        ]
+
+    def __str__(self):
+        return f"Game {self.game_id} ply {self.ply}: {self.uci}"
+
+
+class PgnImport(models.Model):
+    """How far ``manage.py import_pgn`` has got with a file, so it can resume."""
+    path = models.CharField(max_length=1000, unique=True)
+    size = models.BigIntegerField()
+    # Byte offset of the first game not imported yet.
+    offset = models.BigIntegerField(default=0)
+    games = models.IntegerField(default=0)
+    skipped = models.IntegerField(default=0)
+    finished = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Import of {self.path}: {self.games} games"
+
+
+class PositionMove(models.Model):
+    """
+    How often ``uci`` was played from a position in finished games, and how
+    those games ended. ``position_key`` is the position's Zobrist hash as a
+    signed 64-bit integer, see game/explorer.py.
+    """
+    position_key = models.BigIntegerField()
+    uci = models.CharField(max_length=5)
+    games = models.IntegerField(default=0)
+    white_wins = models.IntegerField(default=0)
+    draws = models.IntegerField(default=0)
+    black_wins = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # Also the index the explorer looks positions up with.
+            models.UniqueConstraint(fields=['position_key', 'uci'], name='unique_position_move'),
+        ]
+
+    def __str__(self):
+        return f"{self.uci} from {self.position_key}: {self.games} games"
+
+
+class PlayerRating(models.Model):
+    """
+    A player's Glicko-2 rating, on the usual Elo-like scale: ``rating`` give
+    or take about twice ``deviation``. ``volatility`` is how erratic the
+    player's results have been. See game/ratings.py.
+    """
+    user = models.OneToOneField(User, related_name='rating', on_delete=models.CASCADE, primary_key=True)
+    rating = models.FloatField()
+    deviation = models.FloatField()
+    volatility = models.FloatField()
+    games = models.IntegerField(default=0)
+    # When the player's last rated game ended; the deviation grows with the
+    # time since.
+    last_game_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.user.username}: {self.rating:.0f} ± {2 * self.deviation:.0f}"
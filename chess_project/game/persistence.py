@@ -0,0 +1,194 @@
+"""
+Write-behind persistence of live games.
+
+``GameConsumer`` broadcasts a move first and then only marks the game's
+session dirty. Dirty games are written together, at most
+``GAME_WRITE_BEHIND_INTERVAL`` seconds later, in one transaction: a
+``bulk_create`` of the new ``GameMove`` rows and an update of each game that
+touches only the columns a move can change. Several moves in the same game
+within that window coalesce into a single row update.
+
+Games that reach a terminal state are written immediately with
+``flush_game`` so a finished game is never lost, and rated in the same
+transaction (game/ratings.py). Anything still pending when
+the process exits is written by an ``atexit`` hook. A crash loses at most
+the moves of one window. The moves and the game row are written in the
+same transaction, so the move log never runs ahead of the row.
+
+Rows are written with ``UPDATE ... WHERE id = %s AND ply = %s AND
+is_active = %s`` using the values the session last saw, without taking row
+locks. If another process moved the game on, or a view ended it, the update
+matches nothing: the session's unsaved moves are dropped, the session is
+discarded and its sockets are told to load the game again.
+"""
+import asyncio
+import atexit
+import copy
+import logging
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+
+from .fanout import send_to_game
+from .live import game_sessions
+from .metrics import timed_sync_to_async
+from .models import NO_RESULT, ChessGame, GameMove
+from .presence import abroadcast, get_presence
+from .ratings import rate_games
+
+logger = logging.getLogger(__name__)
+
+# Columns a move or the end of a game can change. journal_entry and the
+# players are deliberately left out so a flush never overwrites them.
+GAME_STATE_FIELDS = [
+    'fen',
+    'current_turn',
+    'is_active',
+    'game_status',
+    'result',
+    'player1_move_count',
+    'player2_move_count',
+    'ply',
+    'snapshot_fen',
+    'snapshot_ply',
+    'player1_clock_ms',
+    'player2_clock_ms',
+    'clock_deadline',
+    'last_move_at',
+]
+
+
+class GameWriter:
+    def __init__(self, interval=1.0, batch_size=500):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending = {}
+        self._scheduled = None
+
+    def mark_dirty(self, session):
+        session.dirty = True
+        self._pending[session.game_id] = session
+        if self._scheduled is None or self._scheduled.done():
+            self._scheduled = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        await self.flush()
+
+    def _take(self, sessions):
+        batch = []
+        for session in sessions:
+            session.dirty = False
+            # Copy so moves applied while the write runs in the thread pool
+            # do not leak half-applied into this batch.
+            game = copy.copy(session.game)
+            batch.append((session, game, session.unsaved_moves, (session.saved_ply, session.saved_active)))
+            session.unsaved_moves = []
+            # A later batch of this game expects the row this one writes.
+            session.saved_ply = game.ply
+            session.saved_active = game.is_active
+        return batch
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        batch = self._take(pending.values())
+        try:
+            conflicts = await timed_sync_to_async(self.write)(batch)
+        except Exception:
+            logger.exception('Failed to write %d games, will retry', len(batch))
+            self._restore(batch)
+            return
+        await self._reload(conflicts)
+
+    async def flush_game(self, session):
+        """
+        Write one game now. Returns False if the row had been changed
+        elsewhere. If the write fails, the game is queued to be retried like
+        any other and the error is raised.
+        """
+        self._pending.pop(session.game_id, None)
+        batch = self._take([session])
+        try:
+            conflicts = await timed_sync_to_async(self.write)(batch)
+        except Exception:
+            logger.exception('Failed to write game %s, will retry', session.game_id)
+            self._restore(batch)
+            raise
+        await self._reload(conflicts)
+        return not conflicts
+
+    def _restore(self, batch):
+        # Put back what _take took from a batch that failed to write.
+        for session, _, moves, (saved_ply, saved_active) in batch:
+            session.unsaved_moves[:0] = moves
+            session.saved_ply = saved_ply
+            session.saved_active = saved_active
+            self.mark_dirty(session)
+
+    def flush_sync(self):
+        pending, self._pending = self._pending, {}
+        if pending:
+            for session in self.write(self._take(pending.values())):
+                logger.warning('Dropped unsaved moves of game %s, changed by another process', session.game_id)
+
+    async def _reload(self, conflicts):
+        for session in conflicts:
+            logger.warning('Game %s was changed by another process, reloading it', session.game_id)
+            game_sessions.discard(session)
+            await send_to_game(session.game_id, {'type': 'session_stale'})
+
+    def write(self, batch):
+        """Write a batch; returns the sessions whose row was changed by someone else."""
+        conflicts = []
+        moves = []
+        finished = []
+        with transaction.atomic():
+            for session, game, game_moves, (saved_ply, saved_active) in batch:
+                updated = ChessGame.objects.filter(id=game.id, ply=saved_ply, is_active=saved_active).update(**{
+                    field.attname: getattr(game, field.attname)
+                    for field in map(ChessGame._meta.get_field, GAME_STATE_FIELDS)
+                })
+                if updated:
+                    moves.extend(game_moves)
+                    if not game.is_active:
+                        finished.append(game.id)
+                else:
+                    conflicts.append(session)
+            GameMove.objects.bulk_create(moves, batch_size=self.batch_size)
+            if finished:
+                rate_games(finished)
+        return conflicts
+
+
+game_writer = GameWriter(interval=settings.GAME_WRITE_BEHIND_INTERVAL)
+atexit.register(game_writer.flush_sync)
+
+
+async def end_game(session, status, result=NO_RESULT):
+    """
+    End a game off the board, by resignation or on time, with ``result``
+    (see ChessGame.result): write it now, free both players in the lobby
+    and tell the game's sockets. Returns False if the game had been changed
+    elsewhere, in which case its sockets are being resynced instead. If the
+    write fails, the game still ends here and the writer retries it.
+    """
+    game = session.game
+    game.game_status = status
+    game.result = result
+    game.is_active = False
+    game.current_turn = None
+    try:
+        if not await game_writer.flush_game(session):
+            return False
+    except DatabaseError:
+        pass
+    await abroadcast(await get_presence().aset_available(game.player1_id, game.player2_id))
+    await send_to_game(session.game_id, {
+        'type': 'game_status',
+        'message': status,
+        'result': result,
+    })
+    return True
@@ -0,0 +1,211 @@
+"""
+Reading PGN archives for ``manage.py import_pgn``.
+
+``split_games`` cuts a file into games and groups them in chunks without
+parsing them, keeping the byte offset where each chunk ends so an import
+can stop and resume there. ``parse_chunk`` replays the games of a chunk with
+python-chess, which is the slow part, and runs in the processes of a pool.
+This module does not import Django so those processes only need
+python-chess.
+"""
+import io
+import re
+from datetime import datetime
+
+import chess
+import chess.pgn
+
+
+def split_games(stream, start=0, games_per_chunk=200):
+    """
+    Yield ``(end_offset, games)`` for chunks of up to ``games_per_chunk``
+    games, as bytes, read from the binary ``stream`` from byte ``start``,
+    which must be where a game starts. A game starts at a tag line that
+    follows movetext, blank line or not.
+    """
+    stream.seek(start)
+    offset = start
+    chunk, game, in_movetext = [], [], False
+    for line in iter(stream.readline, b''):
+        if line.startswith(b'[') and in_movetext:
+            in_movetext = False
+            chunk.append(b''.join(game))
+            game = []
+            if len(chunk) == games_per_chunk:
+                yield offset, chunk
+                chunk = []
+        elif line.strip() and not line.startswith((b'[', b'%')):
+            in_movetext = True
+        game.append(line)
+        offset += len(line)
+    if any(line.strip() for line in game):
+        chunk.append(b''.join(game))
+    if chunk:
+        yield offset, chunk
+
+
+# Imported players get accounts of their own, never the site's users':
+# "pgn." and their name, or "pgn-" and a random suffix for each player a
+# game does not name. Registration refuses both prefixes.
+IMPORTED_PREFIX = 'pgn.'
+UNNAMED_PREFIX = 'pgn-'
+
+
+def _clean_name(name):
+    return re.sub(r'[^\w.@+-]+', '_', name).strip('_')[:150 - len(IMPORTED_PREFIX)]
+
+
+def username(name):
+    """
+    The username of the imported player ``name``, "Carlsen, Magnus" ->
+    "pgn.Carlsen_Magnus", or None if the game does not name them.
+    """
+    name = _clean_name(name)
+    return IMPORTED_PREFIX + name if name else None
+
+
+def _played_at(headers):
+    date = headers.get('UTCDate') or headers.get('Date') or ''
+    try:
+        return datetime.strptime(date, '%Y.%m.%d')
+    except ValueError:
+        return None
+
+
+def _time_control(headers):
+    match = re.fullmatch(r'(\d+)(?:\+(\d+))?', headers.get('TimeControl', ''))
+    if not match:
+        return None
+    return int(match.group(1)), int(match.group(2) or 0)
+
+
+def _status(result, board, white, black, termination):
+    if result == '1/2-1/2':
+        if board.is_stalemate():
+            return f"Game drawn by stalemate between {white} and {black}"
+        return 'Draw'
+    if result in ('1-0', '0-1'):
+        winner, loser = (white, black) if result == '1-0' else (black, white)
+        if board.is_checkmate():
+            return f"{winner} won by checkmate"
+        if termination.lower() == 'time forfeit':
+            return f"{loser} ran out of time. {winner} wins!"
+        return f"{winner} wins!"
+    return 'ended'
+
+
+CLOCK_REGEX = re.compile(r'\[%clk\s+(\d+):(\d+):(\d+(?:\.\d*)?)\]')
+
+
+class GameReader(chess.pgn.BaseVisitor):
+    """
+    Visitor for ``chess.pgn.read_game`` that keeps the headers, the moves
+    of the mainline with their clocks and the final position, on the
+    parser's own board: building python-chess's game tree and replaying it
+    would cost as much again.
+    """
+
+    def begin_game(self):
+        self.headers = {}
+        self.moves = []
+        self.errors = []
+        self.board = None
+        self.snapshot = None
+        self.snapshot_ply = 0
+        self.irreversible = False
+        self.variation_depth = 0
+
+    def visit_header(self, tagname, tagvalue):
+        self.headers[tagname] = tagvalue
+
+    def begin_variation(self):
+        self.variation_depth += 1
+        return chess.pgn.SKIP
+
+    def end_variation(self):
+        self.variation_depth = max(self.variation_depth - 1, 0)
+
+    def visit_move(self, board, move):
+        if not self.variation_depth:
+            self.irreversible = board.is_irreversible(move)
+            self.moves.append((move.uci(), None))
+
+    def visit_board(self, board):
+        # Called for the starting position and after each move.
+        if self.variation_depth:
+            return
+        self.board = board
+        if self.irreversible:
+            self.irreversible = False
+            self.snapshot = board.copy(stack=False)
+            self.snapshot_ply = len(self.moves)
+
+    def visit_comment(self, comment):
+        match = CLOCK_REGEX.search(comment)
+        if match and self.moves and not self.variation_depth:
+            hours, minutes, seconds = match.groups()
+            ms = round((int(hours) * 3600 + int(minutes) * 60 + float(seconds)) * 1000)
+            self.moves[-1] = (self.moves[-1][0], ms)
+
+    def handle_error(self, error):
+        self.errors.append(error)
+
+    def result(self):
+        return self
+
+
+def parse_game(game):
+    """
+    ``(record, None)`` for a game read with ``GameReader`` that can be
+    imported, ``(None, reason)`` for one that cannot. A record is ``(white,
+    black, result, status, played_at, time_control, fen, snapshot_fen,
+    snapshot_ply, moves)``: usernames or None for unnamed players, the PGN
+    result, the game_status text the site would have written, a datetime or
+    None, ``(base, increment)`` or None, the columns of the same names on
+    ChessGame, and ``[(uci, clock_ms or None)]``.
+    """
+    headers = game.headers
+    if game.errors or game.board is None:
+        return None, 'invalid moves'
+    if headers.get('Variant', 'Standard').lower() not in ('standard', 'chess'):
+        return None, 'not standard chess'
+    if 'FEN' in headers or 'SetUp' in headers:
+        return None, 'custom starting position'
+
+    board = game.board
+    names = headers.get('White', ''), headers.get('Black', '')
+    white, black = map(username, names)
+    result = headers.get('Result', '*')
+    if board.is_checkmate():
+        # The board has the last word over a mistyped Result tag.
+        result = '0-1' if board.turn == chess.WHITE else '1-0'
+    elif board.is_stalemate():
+        result = '1/2-1/2'
+    elif result not in ('1-0', '0-1', '1/2-1/2'):
+        result = '*'
+    fen = board.fen()
+    # The status names the players without the prefix.
+    shown = [_clean_name(name) or 'unknown' for name in names]
+    return (
+        white, black, result,
+        _status(result, board, *shown, headers.get('Termination', '')),
+        _played_at(headers), _time_control(headers),
+        fen, game.snapshot.fen() if game.snapshot else chess.STARTING_FEN, game.snapshot_ply, game.moves,
+    ), None
+
+
+def parse_chunk(games):
+    """
+    The records of ``games``, a chunk from ``split_games``, and a count of
+    the games skipped per reason.
+    """
+    records, skipped = [], {}
+    for data in games:
+        # Broken games come back with their errors rather than raising.
+        game = chess.pgn.read_game(io.StringIO(data.decode('utf-8', errors='replace')), Visitor=GameReader)
+        record, reason = (None, 'no game') if game is None else parse_game(game)
+        if record is None:
+            skipped[reason] = skipped.get(reason, 0) + 1
+        else:
+            records.append(record)
+    return records, skipped
@@ -0,0 +1,105 @@
+"""
+Per-position facts shared by every game that reaches the same position.
+
+Positions are keyed by their Zobrist hash, so the legal moves of a common
+opening position, and whether it is checkmate, stalemate or a dead draw, are
+worked out once per worker no matter how many games pass through it. Entries
+are evicted least recently used first once more than ``POSITION_CACHE_SIZE``
+positions are cached; ``PositionCache.stats`` reports hits and misses so the
+size can be tuned.
+"""
+from collections import OrderedDict
+
+import chess
+import chess.polyglot
+from django.conf import settings
+
+
+def position_key(board):
+    return chess.polyglot.zobrist_hash(board)
+
+
+class Position:
+    __slots__ = ('legal_moves', 'legal_payload', 'is_checkmate', 'is_stalemate', 'is_insufficient_material')
+
+    def __init__(self, board):
+        legal_moves = set()
+        by_square = {}
+        for move in board.legal_moves:
+            legal_moves.add(move.uci())
+            from_square = chess.square_name(move.from_square)
+            to_square = chess.square_name(move.to_square)
+            # Promotions to different pieces share a destination square.
+            if to_square not in by_square.get(from_square, ''):
+                by_square[from_square] = by_square.get(from_square, '') + to_square
+        self.legal_moves = frozenset(legal_moves)
+        # {'e2': 'e3e4', 'g1': 'f3h3'}: origin square -> destination squares.
+        self.legal_payload = by_square
+
+        # The legal moves above are the only move generation these need.
+        in_check = board.is_check()
+        self.is_checkmate = not legal_moves and in_check
+        self.is_stalemate = not legal_moves and not in_check
+        self.is_insufficient_material = board.is_insufficient_material()
+
+
+def game_outcome(board, position):
+    """
+    How the game on ``board`` ends in its current position, or None if it
+    goes on. ``position`` is the cached Position of the board; only the
+    checks that depend on the game's history are computed here.
+    """
+    if position.is_checkmate:
+        return 'checkmate'
+    if position.is_stalemate:
+        return 'stalemate'
+    if position.is_insufficient_material:
+        return 'insufficient_material'
+    if board.is_fivefold_repetition():
+        return 'fivefold_repetition'
+    if board.halfmove_clock >= 150:
+        return 'seventyfive_moves'
+    return None
+
+
+class PositionCache:
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def get(self, board, key=None):
+        if key is None:
+            key = position_key(board)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+
+        self.misses += 1
+        entry = Position(board)
+        self._entries[key] = entry
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+
+position_cache = PositionCache(max_size=settings.POSITION_CACHE_SIZE)
@@ -0,0 +1,491 @@
+"""
+Lobby presence registry.
+
+Tracks which users are online and which of them are in an active game, so the
+lobby can answer "who can I challenge" without scanning ``django_session``.
+The default backend keeps its state in the Redis instance that already backs
+``CHANNEL_LAYERS``:
+
+    presence:online       sorted set  user id -> last heartbeat (unix time)
+    presence:connections  hash        user id -> open lobby sockets
+    presence:names        hash        user id -> username
+    presence:busy         set         user ids with an active game
+    presence:seq          counter     sequence number of the last delta
+
+Every change that is visible to the lobby (``join``, ``leave``, ``busy``,
+``available``) takes the next sequence number and is broadcast to the
+``lobby`` group as a delta. Clients apply deltas on top of the snapshot they
+got on connect and ask for a new snapshot when they notice a gap.
+
+Entries whose heartbeat is older than ``ttl`` seconds are swept by
+``run_sweeper``, so a crashed worker cannot leave ghost users behind for
+longer than that.
+"""
+import asyncio
+import logging
+import time
+import weakref
+
+import redis
+import redis.asyncio
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .metrics import timed_group_send
+
+logger = logging.getLogger(__name__)
+
+ONLINE_KEY = 'presence:online'
+CONNECTIONS_KEY = 'presence:connections'
+NAMES_KEY = 'presence:names'
+BUSY_KEY = 'presence:busy'
+SEQ_KEY = 'presence:seq'
+
+# KEYS: online, connections, names, busy, seq  ARGV: user id, username, now, cutoff
+# Returns {seq, busy} when the user was not online before this socket, else {0, 0}.
+CONNECT_SCRIPT = """
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+local is_new = (not score) or tonumber(score) < tonumber(ARGV[4])
+if is_new then
+    redis.call('HSET', KEYS[2], ARGV[1], 1)
+else
+    redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+if is_new then
+    return {redis.call('INCR', KEYS[5]), redis.call('SISMEMBER', KEYS[4], ARGV[1])}
+end
+return {0, 0}
+"""
+
+# KEYS: online, connections, names, busy, seq  ARGV: user id
+# Returns the delta seq when the last socket of the user went away, else 0.
+DISCONNECT_SCRIPT = """
+local remaining = redis.call('HINCRBY', KEYS[2], ARGV[1], -1)
+if remaining > 0 then return 0 end
+local removed = redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+if removed == 1 then return redis.call('INCR', KEYS[5]) end
+return 0
+"""
+
+# KEYS: online, connections, names, busy, seq  ARGV: user id, username, now, cutoff
+LOGIN_SCRIPT = """
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+if (not score) or tonumber(score) < tonumber(ARGV[4]) then
+    return {redis.call('INCR', KEYS[5]), redis.call('SISMEMBER', KEYS[4], ARGV[1])}
+end
+return {0, 0}
+"""
+
+# KEYS: online, connections, names, busy, seq  ARGV: user id
+LOGOUT_SCRIPT = """
+local removed = redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+if removed == 1 then return redis.call('INCR', KEYS[5]) end
+return 0
+"""
+
+# KEYS: online, connections, names, busy, seq  ARGV: 'busy' or 'available', cutoff, user ids...
+# Returns a flat list of id, username, seq for every online user whose state changed.
+SET_BUSY_SCRIPT = """
+local result = {}
+for i = 3, #ARGV do
+    local user_id = ARGV[i]
+    local changed
+    if ARGV[1] == 'busy' then
+        changed = redis.call('SADD', KEYS[4], user_id)
+    else
+        changed = redis.call('SREM', KEYS[4], user_id)
+    end
+    local score = redis.call('ZSCORE', KEYS[1], user_id)
+    if changed == 1 and score and tonumber(score) >= tonumber(ARGV[2]) then
+        table.insert(result, user_id)
+        table.insert(result, redis.call('HGET', KEYS[3], user_id) or '')
+        table.insert(result, redis.call('INCR', KEYS[5]))
+    end
+end
+return result
+"""
+
+# KEYS: online, connections, names, busy, seq  ARGV: cutoff
+# Removes users whose heartbeat expired; returns id, username, seq for each.
+PRUNE_SCRIPT = """
+local result = {}
+for _, user_id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[1])) do
+    table.insert(result, user_id)
+    table.insert(result, redis.call('HGET', KEYS[3], user_id) or '')
+    table.insert(result, redis.call('INCR', KEYS[5]))
+    redis.call('HDEL', KEYS[2], user_id)
+    redis.call('HDEL', KEYS[3], user_id)
+end
+if #result > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[1])
+end
+return result
+"""
+
+# KEYS: online, connections, names, busy, seq  ARGV: cutoff, excluded user id
+# Returns the current seq followed by id, username pairs for online users not in a game.
+SNAPSHOT_SCRIPT = """
+local result = {tonumber(redis.call('GET', KEYS[5]) or '0')}
+for _, user_id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], '+inf')) do
+    if user_id ~= ARGV[2] and redis.call('SISMEMBER', KEYS[4], user_id) == 0 then
+        table.insert(result, user_id)
+        table.insert(result, redis.call('HGET', KEYS[3], user_id) or '')
+    end
+end
+return result
+"""
+
+PRESENCE_KEYS = [ONLINE_KEY, CONNECTIONS_KEY, NAMES_KEY, BUSY_KEY, SEQ_KEY]
+
+
+def _delta(action, user_id, username, seq, busy=False):
+    return {'action': action, 'user_id': int(user_id), 'username': username, 'seq': int(seq), 'busy': bool(busy)}
+
+
+def _deltas(action, flat):
+    return [_delta(action, flat[i], flat[i + 1], flat[i + 2], action == 'busy') for i in range(0, len(flat), 3)]
+
+
+def _snapshot(flat):
+    users = [
+        {'id': int(flat[i]), 'username': flat[i + 1]}
+        for i in range(1, len(flat), 2)
+    ]
+    return int(flat[0]), users
+
+
+class RedisPresence:
+    """
+    Presence backend storing its state in Redis.
+
+    Methods prefixed with ``a`` are coroutines for use from consumers; the
+    plain ones are for views and signal handlers. Methods that change what
+    the lobby sees return the resulting deltas, ready for ``broadcast``.
+    """
+
+    def __init__(self, url='redis://localhost:6379/0', ttl=90, heartbeat_interval=30):
+        self.url = url
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self._client = None
+        self._scripts = None
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    # Clients
+
+    def client(self):
+        if self._client is None:
+            self._client = redis.Redis.from_url(self.url, decode_responses=True)
+            self._scripts = self._register(self._client)
+        return self._client, self._scripts
+
+    def async_client(self):
+        # redis.asyncio connections are bound to the loop that opened them.
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_clients:
+            client = redis.asyncio.Redis.from_url(self.url, decode_responses=True)
+            self._async_clients[loop] = (client, self._register(client))
+        return self._async_clients[loop]
+
+    @staticmethod
+    def _register(client):
+        return {
+            'connect': client.register_script(CONNECT_SCRIPT),
+            'disconnect': client.register_script(DISCONNECT_SCRIPT),
+            'login': client.register_script(LOGIN_SCRIPT),
+            'logout': client.register_script(LOGOUT_SCRIPT),
+            'set_busy': client.register_script(SET_BUSY_SCRIPT),
+            'prune': client.register_script(PRUNE_SCRIPT),
+            'snapshot': client.register_script(SNAPSHOT_SCRIPT),
+        }
+
+    def _window(self):
+        now = time.time()
+        return now, now - self.ttl
+
+    @staticmethod
+    def _joined(user_id, username, result):
+        seq, busy = result
+        return [_delta('join', user_id, username, seq, busy)] if seq else []
+
+    @staticmethod
+    def _left(user_id, seq):
+        return [_delta('leave', user_id, '', seq)] if seq else []
+
+    @staticmethod
+    def _busy_args(action, cutoff, user_ids):
+        return [action, cutoff] + [user_id for user_id in user_ids if user_id is not None]
+
+    # Sync API
+
+    def mark_online(self, user_id, username):
+        _, scripts = self.client()
+        now, cutoff = self._window()
+        result = scripts['login'](keys=PRESENCE_KEYS, args=[user_id, username, now, cutoff])
+        return self._joined(user_id, username, result)
+
+    def mark_offline(self, user_id):
+        _, scripts = self.client()
+        return self._left(user_id, scripts['logout'](keys=PRESENCE_KEYS, args=[user_id]))
+
+    def set_busy(self, *user_ids):
+        _, scripts = self.client()
+        _, cutoff = self._window()
+        return _deltas('busy', scripts['set_busy'](keys=PRESENCE_KEYS, args=self._busy_args('busy', cutoff, user_ids)))
+
+    def set_available(self, *user_ids):
+        _, scripts = self.client()
+        _, cutoff = self._window()
+        return _deltas('available', scripts['set_busy'](keys=PRESENCE_KEYS, args=self._busy_args('available', cutoff, user_ids)))
+
+    def reset_busy(self, user_ids):
+        client, _ = self.client()
+        pipe = client.pipeline(transaction=True)
+        pipe.delete(BUSY_KEY)
+        if user_ids:
+            pipe.sadd(BUSY_KEY, *user_ids)
+        pipe.incr(SEQ_KEY)
+        pipe.execute()
+
+    def snapshot(self, exclude_id=None):
+        _, scripts = self.client()
+        _, cutoff = self._window()
+        return _snapshot(scripts['snapshot'](
+            keys=PRESENCE_KEYS,
+            args=[cutoff, exclude_id if exclude_id is not None else ''],
+        ))
+
+    def available_users(self, exclude_id=None):
+        return self.snapshot(exclude_id)[1]
+
+    # Async API
+
+    async def aconnect(self, user_id, username):
+        _, scripts = self.async_client()
+        now, cutoff = self._window()
+        result = await scripts['connect'](keys=PRESENCE_KEYS, args=[user_id, username, now, cutoff])
+        return self._joined(user_id, username, result)
+
+    async def adisconnect(self, user_id):
+        _, scripts = self.async_client()
+        return self._left(user_id, await scripts['disconnect'](keys=PRESENCE_KEYS, args=[user_id]))
+
+    async def aheartbeat(self, user_id):
+        client, _ = self.async_client()
+        await client.zadd(ONLINE_KEY, {user_id: time.time()}, xx=True)
+
+    async def aset_busy(self, *user_ids):
+        _, scripts = self.async_client()
+        _, cutoff = self._window()
+        return _deltas('busy', await scripts['set_busy'](keys=PRESENCE_KEYS, args=self._busy_args('busy', cutoff, user_ids)))
+
+    async def aset_available(self, *user_ids):
+        _, scripts = self.async_client()
+        _, cutoff = self._window()
+        return _deltas('available', await scripts['set_busy'](keys=PRESENCE_KEYS, args=self._busy_args('available', cutoff, user_ids)))
+
+    async def aprune(self):
+        _, scripts = self.async_client()
+        _, cutoff = self._window()
+        return _deltas('leave', await scripts['prune'](keys=PRESENCE_KEYS, args=[cutoff]))
+
+    async def asnapshot(self, exclude_id=None):
+        _, scripts = self.async_client()
+        _, cutoff = self._window()
+        return _snapshot(await scripts['snapshot'](
+            keys=PRESENCE_KEYS,
+            args=[cutoff, exclude_id if exclude_id is not None else ''],
+        ))
+
+    async def aavailable_users(self, exclude_id=None):
+        return (await self.asnapshot(exclude_id))[1]
+
+
+class InMemoryPresence:
+    """
+    Presence backend keeping its state in this process.
+
+    Behaves like ``RedisPresence`` but is only correct when a single process
+    serves every lobby socket; meant for development and for
+    ``manage.py loadtest``, which runs without Redis.
+    """
+
+    def __init__(self, ttl=90, heartbeat_interval=30):
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self._online = {}
+        self._connections = {}
+        self._names = {}
+        self._busy = set()
+        self._seq = 0
+
+    def _next_seq(self):
+        self._seq += 1
+        return self._seq
+
+    def _is_online(self, user_id, cutoff):
+        return self._online.get(user_id, cutoff - 1) >= cutoff
+
+    def _login(self, user_id, username, sockets=0):
+        now = time.time()
+        is_new = not self._is_online(user_id, now - self.ttl)
+        self._connections[user_id] = sockets if is_new else self._connections.get(user_id, 0) + sockets
+        self._online[user_id] = now
+        self._names[user_id] = username
+        if is_new:
+            return [_delta('join', user_id, username, self._next_seq(), user_id in self._busy)]
+        return []
+
+    def _logout(self, user_id):
+        self._connections.pop(user_id, None)
+        self._names.pop(user_id, None)
+        if self._online.pop(user_id, None) is not None:
+            return [_delta('leave', user_id, '', self._next_seq())]
+        return []
+
+    def _set_busy(self, action, user_ids):
+        cutoff = time.time() - self.ttl
+        deltas = []
+        for user_id in user_ids:
+            if user_id is None:
+                continue
+            changed = (user_id not in self._busy) if action == 'busy' else (user_id in self._busy)
+            if action == 'busy':
+                self._busy.add(user_id)
+            else:
+                self._busy.discard(user_id)
+            if changed and self._is_online(user_id, cutoff):
+                deltas.append(_delta(action, user_id, self._names.get(user_id, ''), self._next_seq(), action == 'busy'))
+        return deltas
+
+    # Sync API
+
+    def mark_online(self, user_id, username):
+        return self._login(user_id, username)
+
+    def mark_offline(self, user_id):
+        return self._logout(user_id)
+
+    def set_busy(self, *user_ids):
+        return self._set_busy('busy', user_ids)
+
+    def set_available(self, *user_ids):
+        return self._set_busy('available', user_ids)
+
+    def reset_busy(self, user_ids):
+        self._busy = set(user_ids)
+        self._next_seq()
+
+    def snapshot(self, exclude_id=None):
+        cutoff = time.time() - self.ttl
+        users = [
+            {'id': user_id, 'username': self._names.get(user_id, '')}
+            for user_id, seen in sorted(self._online.items(), key=lambda item: item[1])
+            if seen >= cutoff and user_id != exclude_id and user_id not in self._busy
+        ]
+        return self._seq, users
+
+    def available_users(self, exclude_id=None):
+        return self.snapshot(exclude_id)[1]
+
+    # Async API
+
+    async def aconnect(self, user_id, username):
+        return self._login(user_id, username, sockets=1)
+
+    async def adisconnect(self, user_id):
+        remaining = self._connections.get(user_id, 0) - 1
+        if remaining > 0:
+            self._connections[user_id] = remaining
+            return []
+        return self._logout(user_id)
+
+    async def aheartbeat(self, user_id):
+        if user_id in self._online:
+            self._online[user_id] = time.time()
+
+    async def aset_busy(self, *user_ids):
+        return self.set_busy(*user_ids)
+
+    async def aset_available(self, *user_ids):
+        return self.set_available(*user_ids)
+
+    async def aprune(self):
+        cutoff = time.time() - self.ttl
+        expired = [user_id for user_id, seen in self._online.items() if seen < cutoff]
+        deltas = []
+        for user_id in expired:
+            deltas.append(_delta('leave', user_id, self._names.get(user_id, ''), self._next_seq()))
+            del self._online[user_id]
+            self._connections.pop(user_id, None)
+            self._names.pop(user_id, None)
+        return deltas
+
+    async def asnapshot(self, exclude_id=None):
+        return self.snapshot(exclude_id)
+
+    async def aavailable_users(self, exclude_id=None):
+        return self.available_users(exclude_id)
+
+
+_presence = None
+
+
+def get_presence():
+    global _presence
+    if _presence is None:
+        config = settings.PRESENCE
+        backend = import_string(config['BACKEND'])
+        _presence = backend(**config.get('CONFIG', {}))
+    return _presence
+
+
+@receiver(setting_changed)
+def reset_presence(setting, **kwargs):
+    global _presence
+    if setting == 'PRESENCE':
+        _presence = None
+
+
+async def abroadcast(deltas):
+    channel_layer = get_channel_layer()
+    for delta in deltas:
+        await timed_group_send(channel_layer, 'lobby', {'type': 'user_update', **delta})
+
+
+def broadcast(deltas):
+    if deltas:
+        async_to_sync(abroadcast)(deltas)
+
+
+_sweepers = weakref.WeakKeyDictionary()
+
+
+def ensure_sweeper():
+    """Start the per-worker task that expires users with a stale heartbeat."""
+    loop = asyncio.get_running_loop()
+    task = _sweepers.get(loop)
+    if task is None or task.done():
+        _sweepers[loop] = loop.create_task(run_sweeper())
+
+
+async def run_sweeper():
+    presence = get_presence()
+    while True:
+        await asyncio.sleep(presence.heartbeat_interval)
+        try:
+            await abroadcast(await presence.aprune())
+        except Exception:
+            logger.exception('Presence sweep failed')
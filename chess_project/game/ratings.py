@@ -0,0 +1,233 @@
+"""
+Glicko-2 ratings, as described in Glickman's "Example of the Glicko-2
+system" (2013).
+
+Ratings are updated as games end. The game writer (game/persistence.py)
+calls ``rate_games`` in the transaction that writes a finished game, which
+treats each game as a rating period of its own for its two players, after
+widening their deviations for the ``RATINGS['PERIOD']`` seconds periods that
+passed since their previous game. ChessGame.rated makes sure a game counts
+once; the reaper rates the finished games nothing else did, such as those
+ended from a page or by the reaper itself.
+
+``manage.py recompute_ratings`` replays the whole archive instead, e.g.
+after changing ``TAU``: games are grouped in rating periods of ``PERIOD``
+seconds, as Glicko-2 intends, and ``replay`` updates every player of a
+period at once with NumPy.
+"""
+import math
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import BLACK_WINS, DRAW, WHITE_WINS, ChessGame, PlayerRating
+
+# Glicko-2 works on a scale where 1500 is 0 and this many points are 1.
+SCALE = 173.7178
+
+# Convergence tolerance of the volatility iteration.
+EPSILON = 1e-6
+
+# White's score for each result.
+SCORES = {WHITE_WINS: 1.0, DRAW: 0.5, BLACK_WINS: 0.0}
+
+
+def _g(phi):
+    return 1 / math.sqrt(1 + 3 * phi ** 2 / math.pi ** 2)
+
+
+def _volatility(phi, sigma, delta, v, tau):
+    # Step 5 of the paper: the new volatility by the Illinois algorithm.
+    a = math.log(sigma ** 2)
+
+    def f(x):
+        ex = math.exp(x)
+        return ex * (delta ** 2 - phi ** 2 - v - ex) / (2 * (phi ** 2 + v + ex) ** 2) - (x - a) / tau ** 2
+
+    A = a
+    if delta ** 2 > phi ** 2 + v:
+        B = math.log(delta ** 2 - phi ** 2 - v)
+    else:
+        k = 1
+        while f(a - k * tau) < 0:
+            k += 1
+        B = a - k * tau
+    fA, fB = f(A), f(B)
+    while abs(B - A) > EPSILON:
+        C = A + (A - B) * fA / (fB - fA)
+        fC = f(C)
+        if fC * fB <= 0:
+            A, fA = B, fB
+        else:
+            fA /= 2
+        B, fB = C, fC
+    return math.exp(A / 2)
+
+
+def glicko2(rating, deviation, volatility, results, tau):
+    """
+    The new ``(rating, deviation, volatility)`` of a player after a rating
+    period with ``results``, ``[(opponent rating, opponent deviation,
+    score)]`` with a score of 1, 0.5 or 0.
+    """
+    mu, phi = (rating - 1500) / SCALE, deviation / SCALE
+    v_inverse = improvement = 0.0
+    for opponent_rating, opponent_deviation, score in results:
+        mu_j, phi_j = (opponent_rating - 1500) / SCALE, opponent_deviation / SCALE
+        g = _g(phi_j)
+        expected = 1 / (1 + math.exp(-g * (mu - mu_j)))
+        v_inverse += g ** 2 * expected * (1 - expected)
+        improvement += g * (score - expected)
+    v = 1 / v_inverse
+    sigma = _volatility(phi, volatility, v * improvement, v, tau)
+    phi_star = math.sqrt(phi ** 2 + sigma ** 2)
+    phi = 1 / math.sqrt(1 / phi_star ** 2 + 1 / v)
+    mu += phi ** 2 * improvement
+    return 1500 + SCALE * mu, SCALE * phi, sigma
+
+
+def idle_deviation(deviation, volatility, periods):
+    """The deviation of a player after ``periods`` rating periods without a game."""
+    phi = math.sqrt((deviation / SCALE) ** 2 + periods * volatility ** 2)
+    return min(SCALE * phi, settings.RATINGS['INITIAL_DEVIATION'])
+
+
+def new_rating(user_id):
+    return PlayerRating(
+        user_id=user_id,
+        rating=settings.RATINGS['INITIAL_RATING'],
+        deviation=settings.RATINGS['INITIAL_DEVIATION'],
+        volatility=settings.RATINGS['INITIAL_VOLATILITY'],
+    )
+
+
+def rate_games(game_ids):
+    """
+    Take the finished games ``game_ids`` into account, in id order, unless
+    they already have been. Games without a result or an opponent are only
+    marked as done. Returns how many games were taken.
+    """
+    with transaction.atomic():
+        games = list(
+            ChessGame.objects.filter(id__in=game_ids, is_active=False, rated=False)
+            .order_by('id')
+            .only('id', 'player1_id', 'player2_id', 'result', 'last_move_at')
+            .select_for_update(skip_locked=True)
+        )
+        if not games:
+            return 0
+        ChessGame.objects.filter(id__in=[game.id for game in games]).update(rated=True)
+        taken = len(games)
+        games = [game for game in games if game.result in SCORES and game.player2_id is not None]
+        user_ids = {user_id for game in games for user_id in (game.player1_id, game.player2_id)}
+        if not user_ids:
+            return taken
+
+        PlayerRating.objects.bulk_create([new_rating(user_id) for user_id in user_ids], ignore_conflicts=True)
+        # Locked in a fixed order, so two writers rating games of the same
+        # players cannot deadlock.
+        ratings = {
+            rating.user_id: rating
+            for rating in PlayerRating.objects.filter(user_id__in=user_ids).order_by('user_id').select_for_update()
+        }
+        tau, period = settings.RATINGS['TAU'], settings.RATINGS['PERIOD']
+        for game in games:
+            white, black = ratings[game.player1_id], ratings[game.player2_id]
+            for player in (white, black):
+                if player.last_game_at is not None:
+                    periods = max(0.0, (game.last_move_at - player.last_game_at).total_seconds() / period)
+                    player.deviation = idle_deviation(player.deviation, player.volatility, periods)
+            score = SCORES[game.result]
+            white_after = glicko2(white.rating, white.deviation, white.volatility, [(black.rating, black.deviation, score)], tau)
+            black_after = glicko2(black.rating, black.deviation, black.volatility, [(white.rating, white.deviation, 1 - score)], tau)
+            for player, (player.rating, player.deviation, player.volatility) in ((white, white_after), (black, black_after)):
+                player.games += 1
+                player.last_game_at = game.last_move_at
+        PlayerRating.objects.bulk_update(
+            ratings.values(), ['rating', 'deviation', 'volatility', 'games', 'last_game_at'],
+        )
+    return taken
+
+
+def unrated_game_ids(batch_size):
+    return list(
+        ChessGame.objects.filter(is_active=False, rated=False).order_by('id').values_list('id', flat=True)[:batch_size]
+    )
+
+
+def replay(white, black, score, period, ratings, tau, max_deviation):
+    """
+    Replay games in Glicko-2 rating periods with NumPy. ``white`` and
+    ``black`` are the players of each game as indices into ``ratings``,
+    ``score`` white's scores and ``period`` each game's rating period, in
+    ascending order. ``ratings`` is ``(rating, deviation, volatility, last
+    period)``, arrays holding every player's starting values, with a last
+    period of -1 for players who have not played yet; they are updated in
+    place.
+
+    A player's deviation only grows while they do not play, so rather than
+    visiting every player in every period, it is widened for the periods
+    missed when they play again.
+    """
+    import numpy as np
+
+    rating, deviation, volatility, last_period = ratings
+    mu, phi = (rating - 1500) / SCALE, deviation / SCALE
+    max_phi = max_deviation / SCALE
+    boundaries = np.flatnonzero(np.diff(period)) + 1
+    for start, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(period)]):
+        current = period[start]
+        players = np.r_[white[start:end], black[start:end]]
+        opponents = np.r_[black[start:end], white[start:end]]
+        scores = np.r_[score[start:end], 1 - score[start:end]]
+        active = np.unique(players)
+
+        idle = np.where(last_period[active] >= 0, current - last_period[active] - 1, 0)
+        phi[active] = np.minimum(np.sqrt(phi[active] ** 2 + idle * volatility[active] ** 2), max_phi)
+
+        g = 1 / np.sqrt(1 + 3 * phi[opponents] ** 2 / np.pi ** 2)
+        expected = 1 / (1 + np.exp(-g * (mu[players] - mu[opponents])))
+        v = 1 / np.bincount(players, g ** 2 * expected * (1 - expected), minlength=len(mu))[active]
+        improvement = np.bincount(players, g * (scores - expected), minlength=len(mu))[active]
+
+        sigma = _volatilities(phi[active], volatility[active], v * improvement, v, tau)
+        phi_star = np.sqrt(phi[active] ** 2 + sigma ** 2)
+        new_phi = 1 / np.sqrt(1 / phi_star ** 2 + 1 / v)
+        mu[active] += new_phi ** 2 * improvement
+        phi[active] = new_phi
+        volatility[active] = sigma
+        last_period[active] = current
+    rating[:] = 1500 + SCALE * mu
+    deviation[:] = SCALE * phi
+
+
+def _volatilities(phi, sigma, delta, v, tau):
+    # _volatility over arrays, iterating until every entry has converged.
+    import numpy as np
+
+    a = np.log(sigma ** 2)
+
+    def f(x):
+        ex = np.exp(x)
+        return ex * (delta ** 2 - phi ** 2 - v - ex) / (2 * (phi ** 2 + v + ex) ** 2) - (x - a) / tau ** 2
+
+    A = a.copy()
+    big = delta ** 2 > phi ** 2 + v
+    B = np.where(big, np.log(np.where(big, delta ** 2 - phi ** 2 - v, 1)), a - tau)
+    k = np.ones_like(a)
+    searching = ~big & (f(B) < 0)
+    while searching.any():
+        k[searching] += 1
+        B[searching] = a[searching] - k[searching] * tau
+        searching &= f(B) < 0
+    fA, fB = f(A), f(B)
+    converging = np.abs(B - A) > EPSILON
+    while converging.any():
+        C = A + (A - B) * fA / np.where(converging, fB - fA, 1)
+        fC = f(C)
+        flip = converging & (fC * fB <= 0)
+        halve = converging & ~flip
+        A, fA = np.where(flip, B, A), np.where(flip, fB, np.where(halve, fA / 2, fA))
+        B, fB = np.where(converging, C, B), np.where(converging, fC, fB)
+        converging &= np.abs(B - A) > EPSILON
+    return np.exp(A / 2)
@@ -0,0 +1,167 @@
+"""
+Background clean-up of rows nothing else ever removes, run by
+``manage.py reap``:
+
+* pending invites older than ``INVITE_TTL`` are marked expired, and declined
+  or expired ones are deleted after ``INVITE_RETENTION``;
+* timed games whose deadline passed ``FLAG_GRACE`` seconds ago are lost on
+  time. A worker with the game's sockets flags it itself (game/clocks.py);
+  these are games abandoned on a worker that has since restarted;
+* active games without a move for ``GAME_IDLE_TIMEOUT`` are ended as
+  abandoned;
+* expired rows of ``django_session`` are deleted;
+* finished games are added to the opening explorer's position index
+  (game/explorer.py);
+* finished games that were not rated as they ended, e.g. games ended from a
+  page or by the tasks above, are rated (game/ratings.py).
+
+Every task works ``batch_size`` rows at a time and sleeps ``pause`` seconds
+between batches, so a backlog is worked off slowly rather than in one long
+statement that holds locks during peak hours.
+
+Games are ended with the conditional update of game/persistence.py: the
+row is only changed if its ply is the one read, and a worker still holding
+the game finds its next write rejected and reloads it.
+"""
+import logging
+import time
+from datetime import timedelta
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore as DatabaseSessionStore
+from django.utils import timezone
+
+from .explorer import index_games
+from .fanout import send_to_game_sync
+from .models import BLACK_WINS, NO_RESULT, WHITE_WINS, ChessGame, GameInvite
+from .presence import broadcast, get_presence
+from .ratings import rate_games, unrated_game_ids
+
+logger = logging.getLogger(__name__)
+
+
+class Reaper:
+    def __init__(self, batch_size=500, pause=0.5, invite_ttl=600, invite_retention=7 * 24 * 60 * 60,
+                 game_idle_timeout=24 * 60 * 60, flag_grace=30):
+        self.batch_size = batch_size
+        self.pause = pause
+        self.invite_ttl = timedelta(seconds=invite_ttl)
+        self.invite_retention = timedelta(seconds=invite_retention)
+        self.game_idle_timeout = timedelta(seconds=game_idle_timeout)
+        self.flag_grace = timedelta(seconds=flag_grace)
+
+    @classmethod
+    def from_settings(cls, **overrides):
+        options = {
+            'batch_size': settings.REAPER['BATCH_SIZE'],
+            'pause': settings.REAPER['BATCH_PAUSE'],
+            'invite_ttl': settings.INVITE_TTL,
+            'invite_retention': settings.REAPER['INVITE_RETENTION'],
+            'game_idle_timeout': settings.REAPER['GAME_IDLE_TIMEOUT'],
+            'flag_grace': settings.REAPER['FLAG_GRACE'],
+        }
+        options.update((key, value) for key, value in overrides.items() if value is not None)
+        return cls(**options)
+
+    def run(self):
+        """One pass over every task. Returns the rows handled per task."""
+        tasks = [
+            ('expired invites', self.expire_invites),
+            ('deleted invites', self.delete_invites),
+            ('games lost on time', self.flag_games),
+            ('abandoned games', self.abandon_games),
+            ('expired sessions', self.clear_sessions),
+            ('indexed games', self.index_games),
+            ('rated games', self.rate_games),
+        ]
+        return {name: self._in_batches(task) for name, task in tasks}
+
+    def _in_batches(self, task):
+        total = 0
+        while True:
+            count = task()
+            total += count
+            if count < self.batch_size:
+                return total
+            time.sleep(self.pause)
+
+    def expire_invites(self):
+        cutoff = timezone.now() - self.invite_ttl
+        ids = list(
+            GameInvite.objects.filter(status='pending', created_at__lt=cutoff)
+            .values_list('id', flat=True)[:self.batch_size]
+        )
+        # Re-checked so an invite answered in between is left alone.
+        GameInvite.objects.filter(id__in=ids, status='pending').update(status='expired')
+        return len(ids)
+
+    def delete_invites(self):
+        cutoff = timezone.now() - self.invite_retention
+        ids = list(
+            GameInvite.objects.filter(status__in=['declined', 'expired'], created_at__lt=cutoff)
+            .values_list('id', flat=True)[:self.batch_size]
+        )
+        GameInvite.objects.filter(id__in=ids).delete()
+        return len(ids)
+
+    def flag_games(self):
+        cutoff = timezone.now() - self.flag_grace
+        games = list(
+            ChessGame.objects.filter(is_active=True, clock_deadline__lt=cutoff)
+            .select_related('player1', 'player2')
+            .only('id', 'ply', 'player1', 'player2', 'player1__username', 'player2__username')[:self.batch_size]
+        )
+        for game in games:
+            if game.ply % 2 == 0:
+                loser, winner, clock, result = game.player1, game.player2, 'player1_clock_ms', BLACK_WINS
+            else:
+                loser, winner, clock, result = game.player2, game.player1, 'player2_clock_ms', WHITE_WINS
+            self._end_game(
+                game, f"{loser.username} ran out of time. {winner.username} wins!", result,
+                clock_deadline=None, **{clock: 0},
+            )
+        return len(games)
+
+    def abandon_games(self):
+        cutoff = timezone.now() - self.game_idle_timeout
+        games = list(
+            ChessGame.objects.filter(is_active=True, last_move_at__lt=cutoff)
+            .only('id', 'ply', 'player1_id', 'player2_id')[:self.batch_size]
+        )
+        hours = self.game_idle_timeout.total_seconds() / 3600
+        for game in games:
+            self._end_game(game, f'Game abandoned after {hours:g} hours without a move.', NO_RESULT, clock_deadline=None)
+        return len(games)
+
+    def _end_game(self, game, status, result, **fields):
+        ended = ChessGame.objects.filter(id=game.id, ply=game.ply, is_active=True).update(
+            is_active=False, current_turn=None, game_status=status, result=result, **fields,
+        )
+        if not ended:
+            # Moved on or ended since it was read; the next pass looks again.
+            return
+        try:
+            broadcast(get_presence().set_available(game.player1_id, game.player2_id))
+            send_to_game_sync(game.id, {'type': 'game_status', 'message': status, 'result': result})
+        except Exception:
+            logger.exception('Failed to announce the end of game %s', game.id)
+
+    def clear_sessions(self):
+        store = import_module(settings.SESSION_ENGINE).SessionStore
+        if not issubclass(store, DatabaseSessionStore):
+            # Cache and cookie sessions expire by themselves.
+            return 0
+        model = store.get_model_class()
+        keys = list(
+            model.objects.filter(expire_date__lt=timezone.now())
+            .values_list('session_key', flat=True)[:self.batch_size]
+        )
+        model.objects.filter(session_key__in=keys).delete()
+        return len(keys)
+
+    def index_games(self):
+        return index_games(self.batch_size)
+
+    def rate_games(self):
+        return rate_games(unrated_game_ids(self.batch_size))
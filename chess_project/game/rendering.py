@@ -0,0 +1,52 @@
+"""
+Server-side board images.
+
+Rendered SVGs are stored in the ``BOARD_SVG_CACHE`` cache under a key derived
+from everything that goes into the image: the FEN, the orientation, the
+highlighted squares and the python-chess version doing the rendering. The same
+position is therefore rendered once no matter how many games or viewers ask
+for it, and the key doubles as a strong ETag, so a client that already has the
+image gets a 304 without the board being rendered or even read from the
+cache. How many images are kept is bounded by the cache's ``MAX_ENTRIES``.
+"""
+import hashlib
+
+import chess
+import chess.svg
+from django.conf import settings
+from django.core.cache import caches
+
+HIGHLIGHT_COLOR = '#cdd16a80'
+
+
+def render_key(fen, orientation=chess.WHITE, highlight=()):
+    squares = ','.join(chess.square_name(square) for square in sorted(set(highlight)))
+    side = 'white' if orientation == chess.WHITE else 'black'
+    source = f'{chess.__version__}|{fen}|{side}|{squares}'
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
+def render_etag(key):
+    return f'"{key[:32]}"'
+
+
+def render_board(fen, orientation=chess.WHITE, highlight=()):
+    board = chess.Board(fen)
+    return chess.svg.board(
+        board,
+        orientation=orientation,
+        fill=dict.fromkeys(highlight, HIGHLIGHT_COLOR),
+        check=board.king(board.turn) if board.is_check() else None,
+    )
+
+
+def board_svg(fen, orientation=chess.WHITE, highlight=(), key=None):
+    """The SVG of the position, rendered only if no cached copy exists."""
+    if key is None:
+        key = render_key(fen, orientation, highlight)
+    cache = caches[settings.BOARD_SVG_CACHE]
+    svg = cache.get(key)
+    if svg is None:
+        svg = render_board(fen, orientation, highlight)
+        cache.set(key, svg)
+    return svg
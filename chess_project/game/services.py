@@ -0,0 +1,156 @@
+"""
+Database work of the lobby socket.
+
+Each coroutine here does all the reads and writes of one ``LobbyConsumer``
+action in a single ``sync_to_async`` call, so an action costs one hop to the
+sync thread rather than one per query. Like the consumer code they replace,
+they return ``(result, error)`` where ``error`` is the message to send back.
+
+Single queries use Django's async ORM instead. In Django 4.2 that still
+runs the query through ``sync_to_async``, so it does not save a hop; it only
+saves wrapping the queryset by hand.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .clocks import start_clocks
+from .metrics import timed_sync_to_async
+from .models import ChessGame, GameInvite
+
+
+def parse_time_control(time_control):
+    """``[base seconds, increment seconds]`` or None for an untimed game."""
+    if time_control is None:
+        return (None, 0), None
+    try:
+        base, increment = (int(value) for value in time_control)
+    except (TypeError, ValueError):
+        return None, 'Invalid time control'
+    if not 0 < base <= 3 * 60 * 60 or not 0 <= increment <= 60:
+        return None, 'Invalid time control'
+    return (base, increment), None
+
+
+def _create_invite(sender, receiver_id, time_control):
+    time_control, error = parse_time_control(time_control)
+    if error:
+        return None, error
+    try:
+        receiver = User.objects.only('id', 'username').get(id=receiver_id)
+    except (User.DoesNotExist, ValueError):
+        return None, 'User does not exist'
+
+    if ChessGame.objects.active_between(sender, receiver).exists():
+        return None, 'You are already playing a game with this user.'
+
+    invite = GameInvite.objects.create(
+        sender=sender, receiver=receiver, time_base=time_control[0], time_increment=time_control[1],
+    )
+    return invite, None
+
+
+async def create_invite(sender, receiver_id, time_control=None):
+    """
+    Invite ``receiver_id`` to a game with ``time_control``, see
+    ``parse_time_control``. The invite's receiver is loaded.
+    """
+    return await timed_sync_to_async(_create_invite)(sender, receiver_id, time_control)
+
+
+def _answer_invite(receiver, invite_id, accept):
+    with transaction.atomic():
+        try:
+            invite = GameInvite.objects.select_for_update().get(id=invite_id)
+        except (GameInvite.DoesNotExist, ValueError):
+            return None, 'Invite does not exist'
+        if invite.receiver_id != receiver.id:
+            return None, 'Invalid invite'
+        if invite.status == 'expired':
+            return None, 'This invite has expired.'
+        if invite.status != 'pending':
+            return None, 'This invite has already been answered.'
+        if invite.created_at < timezone.now() - timedelta(seconds=settings.INVITE_TTL):
+            # Not reaped yet, see game/reaper.py.
+            invite.status = 'expired'
+            invite.save(update_fields=['status'])
+            return None, 'This invite has expired.'
+
+        if accept:
+            if _lock_players(invite.sender_id, receiver.id):
+                return None, 'One of you already has a game in progress.'
+            game = ChessGame(
+                player1_id=invite.sender_id,
+                player2_id=receiver.id,
+                is_active=True,
+                time_base=invite.time_base,
+                time_increment=invite.time_increment,
+            )
+            start_clocks(game)
+            game.save(force_insert=True)
+            invite.game = game
+            invite.status = 'accepted'
+            invite.save(update_fields=['game', 'status'])
+        else:
+            invite.status = 'declined'
+            invite.save(update_fields=['status'])
+    return invite, None
+
+
+async def answer_invite(receiver, invite_id, accept):
+    """
+    Accept or decline an invite sent to ``receiver``. Accepting creates the
+    game, which is then ``invite.game``.
+    """
+    return await timed_sync_to_async(_answer_invite)(receiver, invite_id, accept)
+
+
+def _lock_players(*user_ids):
+    """
+    Lock the users' rows until the transaction ends, in id order so that
+    two callers cannot deadlock, and return the ids of those already in an
+    active game. Whoever holds the locks is the only one who can start a
+    game for these players, so the answer stays true until it commits.
+    """
+    user_ids = sorted(set(user_ids))
+    list(User.objects.select_for_update().filter(id__in=user_ids).order_by('id').values_list('id', flat=True))
+    busy = set()
+    for player1_id, player2_id in ChessGame.objects.filter(
+        Q(player1_id__in=user_ids, is_active=True) | Q(player2_id__in=user_ids, is_active=True)
+    ).values_list('player1_id', 'player2_id'):
+        busy.update({player1_id, player2_id} & set(user_ids))
+    return busy
+
+
+def _create_match(white_id, black_id, time_control):
+    with transaction.atomic():
+        busy = _lock_players(white_id, black_id)
+        if busy:
+            return None, busy
+        game = ChessGame(
+            player1_id=white_id,
+            player2_id=black_id,
+            is_active=True,
+            time_base=time_control[0],
+            time_increment=time_control[1],
+        )
+        start_clocks(game)
+        game.save(force_insert=True)
+    return game, None
+
+
+async def create_match(white_id, black_id, time_control):
+    """
+    Start the game of two players paired by matchmaking (game/matchmaking.py).
+    Instead of an error message, fails with the ids of the players who have
+    an active game already.
+    """
+    return await timed_sync_to_async(_create_match)(white_id, black_id, time_control)
+
+
+async def active_game_id(user):
+    return await ChessGame.objects.active_for(user).values_list('id', flat=True).afirst()
@@ -0,0 +1,37 @@
+import logging
+
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from redis.exceptions import RedisError
+
+from .metrics import install_query_counter
+from .presence import broadcast, get_presence
+
+logger = logging.getLogger(__name__)
+
+
+# Logging in and out must not fail because Redis does; the lobby socket
+# registers the user again when it connects.
+
+@receiver(user_logged_in)
+def mark_user_online(sender, request, user, **kwargs):
+    try:
+        broadcast(get_presence().mark_online(user.id, user.username))
+    except (RedisError, OSError):
+        logger.exception('Failed to mark user %s online', user.id)
+
+
+@receiver(user_logged_out)
+def mark_user_offline(sender, request, user, **kwargs):
+    if user is None:
+        return
+    try:
+        broadcast(get_presence().mark_offline(user.id))
+    except (RedisError, OSError):
+        logger.exception('Failed to mark user %s offline', user.id)
+
+
+@receiver(connection_created)
+def count_queries(sender, connection, **kwargs):
+    install_query_counter(connection)
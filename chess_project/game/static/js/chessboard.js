@@ -1,71 +1,241 @@
 (function() {
 const wsScheme = window.location.protocol === "https:" ? "wss" : "ws";
 console.log('gameId:', gameId);
-const socket = new WebSocket(`${wsScheme}://${window.location.host}/ws/game/${gameId}/`);
+// 'delta' makes the server send only the UCI move of each turn, which is
+// applied to the local board below.
+const socketUrl = `${wsScheme}://${window.location.host}/ws/game/${gameId}/?encoding=delta`;
+// Close code of a worker that is shutting down; the game continues on
+// another one, so reconnect at once.
+const CLOSE_RECONNECT = 4000;
+let socket = null;
+let reconnectDelay = 500;
+let leaving = false;
 
-socket.onmessage = function(event) {
+const pieces = {
+    'r': '&#9820;', 'n': '&#9822;', 'b': '&#9821;', 'q': '&#9819;', 'k': '&#9818;', 'p': '&#9823;',
+    'R': '&#9814;', 'N': '&#9816;', 'B': '&#9815;', 'Q': '&#9813;', 'K': '&#9812;', 'P': '&#9817;'
+};
+
+// Square name -> FEN piece letter (or null), and the ply it reflects.
+let position = {};
+let ply = null;
+// Legal moves of the side to move, origin square -> destination squares
+// ({'e2': 'e3e4'}), and the username of the player to move.
+let legal = null;
+let turnUsername = null;
+let selectedSquare = null;
+// Milliseconds on each clock as of clockAt, and the side whose clock runs;
+// null for untimed games.
+let clock = null;
+let clockAt = 0;
+
+function connect() {
+    socket = new WebSocket(socketUrl);
+    socket.onopen = onOpen;
+    socket.onmessage = onMessage;
+    socket.onclose = onClose;
+}
+
+function onOpen() {
+    reconnectDelay = 500;
+    socket.send(JSON.stringify({action: 'sync'}));
+}
+
+function onMessage(event) {
     const data = JSON.parse(event.data);
 
-    if (data.action === 'move') {
-        updateBoard(data.fen);
+    if (data.action === 'role') {
+        if (data.role === 'spectator') {
+            // Spectators only watch; the server rejects their moves anyway.
+            document.getElementById('move-controls').style.display = 'none';
+        }
+        updateSpectators(data.spectators);
+    } else if (data.action === 'spectators') {
+        updateSpectators(data.count);
+    } else if (data.action === 'sync') {
+        position = parseFEN(data.fen);
+        ply = data.ply;
+        legal = data.legal || null;
+        renderBoard();
+        showBoard();
+        updateTurn(data);
+        updateClock(data.clock);
+    } else if (data.action === 'move') {
+        legal = data.legal || null;
+        clearSelection();
+        if (data.fen) {
+            position = parseFEN(data.fen);
+            ply = data.ply;
+            renderBoard();
+        } else if (ply !== null && data.ply === ply + 1) {
+            applyMove(data.move);
+            ply = data.ply;
+            renderBoard();
+        } else {
+            // Missed a move; fetch the full position.
+            ply = null;
+            socket.send(JSON.stringify({action: 'sync'}));
+        }
         updateTurn(data);
+        updateClock(data.clock);
 
         if (data.game_status && data.game_status !== 'active') {
-            alert(data.game_status); 
-            window.location.href = '/'; 
+            leaveGame(data.game_status);
         }
 
     } else if (data.action === 'error') {
+        // With resync set, the full position follows in a sync message.
         alert(data.message); 
     } else if (data.action === 'exit') {
-        alert('Your opponent has exited the game.');
-        window.location.href = '/';
+        leaveGame('Your opponent has exited the game.');
     } else if (data.action === 'game_status') {
-        alert(data.message);
-        window.location.href = '/';
+        leaveGame(data.message);
     }
-};
+}
 
-socket.onclose = function() {
-    console.error("WebSocket connection closed unexpectedly.");
-    alert("WebSocket connection lost. Please refresh the page manually.");
-};
+function leaveGame(message) {
+    leaving = true;
+    alert(message);
+    window.location.href = '/';
+}
+
+function onClose(event) {
+    if (leaving) {
+        return;
+    }
+    // The board is brought up to date by the sync sent once reconnected.
+    const delay = event.code === CLOSE_RECONNECT ? 0 : reconnectDelay;
+    reconnectDelay = Math.min(reconnectDelay * 2, 10000);
+    console.warn(`WebSocket closed (${event.code}), reconnecting in ${delay}ms.`);
+    setTimeout(connect, delay);
+}
+
+connect();
 
 function sendMove(move) {
     if (socket.readyState === WebSocket.OPEN) {
         const payload = {
             action: 'move',
             move: move,
+            // Lets the server reject the move if the board has moved on.
+            ply: ply,
         };
         socket.send(JSON.stringify(payload));
     } else {
-        alert('WebSocket connection is not open. Please refresh the page.');
+        alert('Reconnecting to the game, please try again in a moment.');
     }
 }
 
 function movePiece() {
     const move = document.getElementById('move-input').value.toLowerCase();
     if (/^[a-h][1-8][a-h][1-8][qrbn]?$/.test(move)) { 
-        sendMove(move);
+        const error = checkMove(move);
+        if (error) {
+            alert(error);
+        } else {
+            sendMove(move);
+        }
     } else {
         alert('Invalid move format. Please use the UCI format (e.g., e2e4).');
     }
 }
 
-function updateBoard(fen) {
-    const board = parseFEN(fen);
+// Catches illegal moves locally, without a round trip; the server still
+// validates every move it receives.
+function checkMove(move) {
+    if (legal === null) {
+        return null;
+    }
+    if (turnUsername !== currentUser) {
+        return 'It is not your turn.';
+    }
+    const targets = legal[move.slice(0, 2)] || '';
+    for (let i = 0; i < targets.length; i += 2) {
+        if (targets.slice(i, i + 2) === move.slice(2, 4)) {
+            return null;
+        }
+    }
+    return 'Invalid move';
+}
 
-    for (const [square, piece] of Object.entries(board)) {
+function clearSelection() {
+    selectedSquare = null;
+    document.querySelectorAll('#chessboard td.legal-target, #chessboard td.selected').forEach(cell => {
+        cell.classList.remove('legal-target', 'selected');
+    });
+}
+
+// Clicking one of your pieces highlights where it can go; clicking a
+// highlighted square fills in the move.
+function selectSquare(square) {
+    if (selectedSquare && document.getElementById(square).classList.contains('legal-target')) {
+        let move = selectedSquare + square;
+        const piece = position[selectedSquare];
+        if (piece && piece.toLowerCase() === 'p' && (square[1] === '8' || square[1] === '1')) {
+            move += 'q';
+        }
+        document.getElementById('move-input').value = move;
+        clearSelection();
+        return;
+    }
+
+    clearSelection();
+    if (legal === null || turnUsername !== currentUser || !legal[square]) {
+        return;
+    }
+    selectedSquare = square;
+    document.getElementById(square).classList.add('selected');
+    const targets = legal[square];
+    for (let i = 0; i < targets.length; i += 2) {
+        document.getElementById(targets.slice(i, i + 2)).classList.add('legal-target');
+    }
+}
+
+function showBoard() {
+    document.getElementById('board-image').style.display = 'none';
+    document.getElementById('chessboard').style.display = '';
+}
+
+function renderBoard() {
+    for (const [square, piece] of Object.entries(position)) {
         const squareElement = document.getElementById(square);
         if (squareElement) {
-            squareElement.innerHTML = piece ? piece : '&nbsp;';
+            squareElement.innerHTML = piece ? pieces[piece] : '&nbsp;';
         }
     }
 }
 
+function applyMove(uci) {
+    const from = uci.slice(0, 2);
+    const to = uci.slice(2, 4);
+    const piece = position[from];
+    const isWhite = piece === piece.toUpperCase();
+
+    if (piece.toLowerCase() === 'k' && Math.abs(from.charCodeAt(0) - to.charCodeAt(0)) === 2) {
+        // Castling: bring the rook to the other side of the king.
+        const rank = from[1];
+        const kingside = to[0] === 'g';
+        const rookFrom = (kingside ? 'h' : 'a') + rank;
+        const rookTo = (kingside ? 'f' : 'd') + rank;
+        position[rookTo] = position[rookFrom];
+        position[rookFrom] = null;
+    } else if (piece.toLowerCase() === 'p' && from[0] !== to[0] && !position[to]) {
+        // En passant: the captured pawn is beside the destination square.
+        position[to[0] + from[1]] = null;
+    }
+
+    position[from] = null;
+    if (uci.length === 5) {
+        position[to] = isWhite ? uci[4].toUpperCase() : uci[4];
+    } else {
+        position[to] = piece;
+    }
+}
+
 function updateTurn(response) {
     const gameStatus = response.game_status || "";
     const currentTurnUsername = response.current_turn_username || "unkown";
+    turnUsername = currentTurnUsername;
 
     if (gameStatus.includes('Checkmate') || gameStatus.includes('Stalemate')) {
         document.getElementById('current-turn').textContent = gameStatus;
@@ -74,13 +244,39 @@ function updateTurn(response) {
     }
 }
 
+function updateClock(data) {
+    clock = data || null;
+    clockAt = performance.now();
+    document.getElementById('clocks').style.display = clock ? '' : 'none';
+    renderClock();
+}
+
+function formatClock(ms) {
+    const seconds = Math.max(0, Math.ceil(ms / 1000));
+    return `${Math.floor(seconds / 60)}:${String(seconds % 60).padStart(2, '0')}`;
+}
+
+function renderClock() {
+    if (!clock) {
+        return;
+    }
+    // The server decides when a flag falls; this only counts down locally.
+    const elapsed = performance.now() - clockAt;
+    for (const side of ['white', 'black']) {
+        const ms = clock.running === side ? clock[side] - elapsed : clock[side];
+        document.getElementById(`clock-${side}`).textContent = formatClock(ms);
+    }
+}
+
+setInterval(renderClock, 200);
+
+function updateSpectators(count) {
+    document.getElementById('spectator-count').textContent = count;
+}
+
 function parseFEN(fen) {
     const board = {};
     const rows = fen.split(' ')[0].split('/');
-    const pieces = {
-        'r': '&#9820;', 'n': '&#9822;', 'b': '&#9821;', 'q': '&#9819;', 'k': '&#9818;', 'p': '&#9823;',
-        'R': '&#9814;', 'N': '&#9816;', 'B': '&#9815;', 'Q': '&#9813;', 'K': '&#9812;', 'P': '&#9817;'
-    };
 
     let rank = 8;
     for (let row of rows) {
@@ -93,7 +289,7 @@ function parseFEN(fen) {
                     file = String.fromCharCode(file.charCodeAt(0) + 1);
                 }
             } else {
-                board[`${file}${rank}`] = pieces[char];
+                board[`${file}${rank}`] = char;
                 file = String.fromCharCode(file.charCodeAt(0) + 1);
             }
         }
@@ -109,7 +305,7 @@ function exitGame() {
         };
         socket.send(JSON.stringify(payload));
     } else {
-        alert('WebSocket connection is already closed.');
+        alert('Reconnecting to the game, please try again in a moment.');
     }
 }
 
@@ -119,6 +315,9 @@ function resetBoard() {
 
 
 document.getElementById('moveBtn').addEventListener('click', movePiece);
+document.querySelectorAll('#chessboard td').forEach(cell => {
+    cell.addEventListener('click', () => selectSquare(cell.id));
+});
 document.getElementById('exitBtn').addEventListener('click', exitGame);
 
 })();
\ No newline at end of file
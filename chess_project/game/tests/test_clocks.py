@@ -0,0 +1,89 @@
+import asyncio
+from datetime import timedelta
+from unittest import mock
+
+from django.test import SimpleTestCase
+from django.utils import timezone
+
+from game.clocks import TimerWheel, clock_payload, press_clock, start_clocks, stop_clocks, time_left_ms
+from game.live import GameSession
+from game.models import ChessGame
+
+
+@mock.patch('game.clocks.watch')
+class ClockTests(SimpleTestCase):
+    def session(self, time_base=60, time_increment=2):
+        game = ChessGame(id=1, is_active=True, time_base=time_base, time_increment=time_increment)
+        start_clocks(game)
+        return GameSession(game)
+
+    def move(self, session, uci, now):
+        session.push(uci)
+        return press_clock(session, now)
+
+    def test_untimed_games_have_no_clocks(self, watch):
+        session = self.session(time_base=None)
+        self.assertIsNone(session.game.player1_clock_ms)
+        self.assertIsNone(self.move(session, 'e2e4', timezone.now()))
+        self.assertIsNone(clock_payload(session.game))
+
+    def test_no_clock_runs_before_the_first_move(self, watch):
+        game = self.session().game
+        self.assertEqual((game.player1_clock_ms, game.player2_clock_ms), (60000, 60000))
+        self.assertIsNone(game.clock_deadline)
+        self.assertIsNone(time_left_ms(game))
+        self.assertEqual(clock_payload(game), {'white': 60000, 'black': 60000, 'running': None})
+
+    def test_the_first_move_is_free_and_starts_blacks_clock(self, watch):
+        session = self.session()
+        now = timezone.now()
+        self.assertEqual(self.move(session, 'e2e4', now), 60000)
+        self.assertEqual(session.unsaved_moves[-1].clock_ms, 60000)
+        self.assertEqual(session.game.clock_deadline, now + timedelta(seconds=60))
+        self.assertEqual(clock_payload(session.game, now)['running'], 'black')
+
+    def test_a_move_charges_the_mover_and_adds_the_increment(self, watch):
+        session = self.session()
+        start = timezone.now()
+        self.move(session, 'e2e4', start)
+        self.assertEqual(self.move(session, 'e7e5', start + timedelta(seconds=10)), 52000)
+        game = session.game
+        self.assertEqual((game.player1_clock_ms, game.player2_clock_ms), (60000, 52000))
+        self.assertEqual(game.clock_deadline, start + timedelta(seconds=70))
+        self.assertEqual(clock_payload(game, start + timedelta(seconds=15))['white'], 55000)
+
+    def test_the_clock_stops_when_the_game_ends(self, watch):
+        session = self.session()
+        start = timezone.now()
+        self.move(session, 'e2e4', start)
+        session.game.is_active = False
+        self.move(session, 'e7e5', start + timedelta(seconds=1))
+        self.assertIsNone(session.game.clock_deadline)
+
+    def test_stop_clocks_keeps_what_was_left(self, watch):
+        session = self.session()
+        start = timezone.now()
+        self.move(session, 'e2e4', start)
+        stop_clocks(session, start + timedelta(seconds=5))
+        self.assertEqual(session.game.player2_clock_ms, 55000)
+        self.assertIsNone(session.game.clock_deadline)
+
+
+class TimerWheelTests(SimpleTestCase):
+    async def test_timers_fire_once_unless_cancelled_or_replaced(self):
+        wheel = TimerWheel(tick=0.01, slots=8)
+        fired = []
+
+        async def callback(value):
+            fired.append(value)
+
+        wheel.schedule('a', 0.02, callback, 'a')
+        wheel.schedule('b', 0.05, callback, 'b')
+        wheel.schedule('c', 0.01, callback, 'c')
+        wheel.cancel('c')
+        # Longer than a turn of the wheel, and replacing the first timer.
+        wheel.schedule('b', 0.15, callback, 'b2')
+        self.assertEqual(len(wheel), 2)
+        await asyncio.sleep(0.3)
+        self.assertEqual(fired, ['a', 'b2'])
+        self.assertEqual(len(wheel), 0)
@@ -0,0 +1,317 @@
+import asyncio
+from unittest import mock
+
+import chess
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser, User
+from django.test import TestCase, override_settings
+
+from game.encoding import pack_board_b64, position_hash
+from game.fanout import SpectatorHub, spectator_group, spectator_hub
+from game.live import game_sessions
+from game.models import DRAW, ChessGame
+from game.persistence import game_writer
+from game.routing import websocket_urlpatterns
+from game.tests.test_presence import FakeRedisPresence
+
+application = URLRouter(websocket_urlpatterns)
+
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+IN_MEMORY_PRESENCE = {'BACKEND': 'game.presence.InMemoryPresence'}
+IN_MEMORY_MATCHMAKING = {'BACKEND': 'game.matchmaking.InMemoryMatchmaker'}
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class GameConsumerTestCase(TestCase):
+    def setUp(self):
+        # Game ids are reused once a test's rows are rolled back.
+        game_sessions._sessions.clear()
+        self.white = User.objects.create_user('white')
+        self.black = User.objects.create_user('black')
+        self.game = ChessGame.objects.create(
+            player1=self.white, player2=self.black, current_turn=self.white, is_active=True,
+        )
+
+    def tearDown(self):
+        # Written here rather than by the atexit hook, after the test
+        # database is gone.
+        game_writer.flush_sync()
+
+    async def connect(self, user, query='', role='player'):
+        communicator = WebsocketCommunicator(application, f'/ws/game/{self.game.id}/?{query}')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual((await communicator.receive_json_from())['role'], role)
+        return communicator
+
+    async def receive(self, communicator, action):
+        """The next message with ``action``, skipping any others."""
+        while True:
+            message = await communicator.receive_json_from()
+            if message['action'] == action:
+                return message
+
+    async def move(self, communicator, uci, **extra):
+        await communicator.send_json_to({'action': 'move', 'move': uci, **extra})
+        return await communicator.receive_json_from()
+
+
+class EncodingTests(GameConsumerTestCase):
+    async def test_each_socket_gets_its_own_encoding(self):
+        sockets = {
+            encoding: await self.connect(self.white, f'encoding={encoding}')
+            for encoding in ('fen', 'packed', 'delta', 'unknown')
+        }
+        update = await self.move(sockets['fen'], 'e2e4')
+        board = chess.Board()
+        board.push_uci('e2e4')
+        self.assertEqual((update['action'], update['fen'], update['ply']), ('move', board.fen(), 1))
+        self.assertEqual((await sockets['packed'].receive_json_from())['board'], pack_board_b64(board))
+        delta = await sockets['delta'].receive_json_from()
+        self.assertEqual((delta['move'], delta['hash']), ('e2e4', position_hash(board)))
+        self.assertNotIn('fen', delta)
+        self.assertEqual((await sockets['unknown'].receive_json_from())['fen'], board.fen())
+        for communicator in sockets.values():
+            await communicator.disconnect()
+
+    async def test_sync_sends_the_whole_position(self):
+        communicator = await self.connect(self.white, 'encoding=delta')
+        await self.move(communicator, 'e2e4')
+        await communicator.send_json_to({'action': 'sync'})
+        sync = await communicator.receive_json_from()
+        self.assertEqual((sync['action'], sync['ply'], sync['current_turn_username']), ('sync', 1, 'black'))
+        self.assertIn('fen', sync)
+        await communicator.disconnect()
+
+
+class MoveTests(GameConsumerTestCase):
+    async def test_players_get_the_legal_moves_of_the_new_position(self):
+        white = await self.connect(self.white)
+        update = await self.move(white, 'e2e4')
+        self.assertIn(update['legal']['e7'], ('e6e5', 'e5e6'))
+        self.assertNotIn('e2', update['legal'])
+        await white.disconnect()
+
+    async def test_checkmate_ends_the_game(self):
+        presence = FakeRedisPresence()
+        presence.set_busy(self.white.id, self.black.id)
+        white, black = await self.connect(self.white), await self.connect(self.black)
+        with mock.patch('game.presence._presence', presence):
+            for player, uci in ((white, 'f2f3'), (black, 'e7e5'), (white, 'g2g4'), (black, 'd8h4')):
+                update = await self.move(player, uci)
+                await self.receive(white if player is black else black, 'move')
+        self.assertEqual((update['game_status'], update['legal']), ('black won by checkmate', {}))
+
+        game = await ChessGame.objects.aget(id=self.game.id)
+        self.assertEqual((game.is_active, game.ply, game.current_turn_id), (False, 4, None))
+        self.assertEqual(presence.client()[0].smembers('presence:busy'), set())
+        self.assertEqual(await self.move(white, 'e2e4'), {'action': 'error', 'message': 'This game is over.'})
+        await white.disconnect()
+        await black.disconnect()
+
+    async def test_draws_leave_no_one_to_move(self):
+        fen = '4k3/8/8/8/8/8/3p4/2B1K3 w - - 0 1'
+        await ChessGame.objects.filter(id=self.game.id).aupdate(fen=fen, snapshot_fen=fen)
+        white = await self.connect(self.white)
+        with mock.patch('game.presence._presence', FakeRedisPresence()):
+            update = await self.move(white, 'c1d2')
+        self.assertEqual((update['game_status'], update['current_turn_username']), ('Draw by insufficient material', 'unknown'))
+
+        game = await ChessGame.objects.aget(id=self.game.id)
+        self.assertEqual((game.is_active, game.result, game.current_turn_id), (False, DRAW, None))
+        await white.disconnect()
+
+    async def test_illegal_moves_are_rejected(self):
+        white = await self.connect(self.white)
+        for uci in ('e2e5', 'nonsense', None):
+            self.assertEqual(await self.move(white, uci), {'action': 'error', 'message': 'Invalid move'})
+        self.assertEqual(self.game.ply, 0)
+        await white.disconnect()
+
+    async def test_errors_after_the_move_are_not_reported_as_invalid_moves(self):
+        white = await self.connect(self.white)
+        with mock.patch('game.consumers.send_to_game', side_effect=ValueError('broken')), \
+                self.assertRaises(ValueError):
+            await self.move(white, 'e2e4')
+        self.assertEqual(game_sessions.peek(self.game.id).game.ply, 1)
+
+    async def test_only_the_side_to_move_may_move(self):
+        black = await self.connect(self.black)
+        self.assertEqual(await self.move(black, 'e7e5'), {'action': 'error', 'message': 'It is not your turn.'})
+        await black.disconnect()
+
+    async def test_moves_from_an_outdated_board_are_rejected(self):
+        white = await self.connect(self.white)
+        self.assertEqual(await self.move(white, 'e2e4', ply=3), {
+            'action': 'error', 'message': 'The game has moved on since your board was last updated.', 'resync': True,
+        })
+        sync = await white.receive_json_from()
+        self.assertEqual((sync['action'], sync['ply']), ('sync', 0))
+        self.assertEqual((await self.move(white, 'e2e4', ply=0))['ply'], 1)
+        await white.disconnect()
+
+
+class ConnectTests(GameConsumerTestCase):
+    async def test_anonymous_sockets_are_refused(self):
+        communicator = WebsocketCommunicator(application, f'/ws/game/{self.game.id}/')
+        communicator.scope['user'] = AnonymousUser()
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertIsNone(game_sessions.peek(self.game.id))
+
+
+@override_settings(SPECTATOR_COUNT_INTERVAL=0.05)
+class SpectatorTests(GameConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.watchers = [User.objects.create_user(f'watcher{i}') for i in range(2)]
+
+    async def test_spectators_share_one_relay(self):
+        player = await self.connect(self.white)
+        first = await self.connect(self.watchers[0], role='spectator')
+        second = await self.connect(self.watchers[1], role='spectator')
+        # Both joins in one announcement.
+        for communicator in (player, first, second):
+            self.assertEqual(await communicator.receive_json_from(), {'action': 'spectators', 'count': 2})
+        self.assertTrue(await player.receive_nothing(0.1))
+        self.assertEqual(len(get_channel_layer().groups[spectator_group(self.game.id)]), 1)
+
+        await self.move(player, 'e2e4')
+        for spectator in (first, second):
+            update = await self.receive(spectator, 'move')
+            self.assertEqual(update['ply'], 1)
+            self.assertNotIn('legal', update)
+
+        await first.disconnect()
+        await second.disconnect()
+        self.assertEqual(spectator_hub.count(self.game.id), 0)
+        self.assertNotIn(spectator_group(self.game.id), get_channel_layer().groups)
+        # The last one leaving is announced at once.
+        while (await self.receive(player, 'spectators'))['count']:
+            pass
+        await player.disconnect()
+
+    async def test_spectators_cannot_move(self):
+        spectator = await self.connect(self.watchers[0], role='spectator')
+        await spectator.send_json_to({'action': 'move', 'move': 'e2e4'})
+        self.assertEqual(
+            await self.receive(spectator, 'error'),
+            {'action': 'error', 'message': 'Spectators cannot make moves.'},
+        )
+        await spectator.send_json_to({'action': 'exit'})
+        await self.receive(spectator, 'error')
+        self.assertEqual(self.game.ply, 0)
+        await spectator.disconnect()
+
+    async def test_spectators_arriving_together_share_one_relay(self):
+        hub = SpectatorHub()
+        channel_layer = get_channel_layer()
+        watchers = [mock.AsyncMock(channel_layer=channel_layer) for _ in range(2)]
+        new_channel = channel_layer.new_channel
+
+        async def slow_new_channel():
+            await asyncio.sleep(0)
+            return await new_channel()
+
+        with mock.patch.object(channel_layer, 'new_channel', slow_new_channel):
+            await asyncio.gather(*(hub.add(self.game.id, watcher) for watcher in watchers))
+        self.assertEqual(hub.count(self.game.id), 2)
+        self.assertEqual(len(channel_layer.groups[spectator_group(self.game.id)]), 1)
+        await asyncio.gather(*(hub.remove(self.game.id, watcher) for watcher in watchers))
+        self.assertNotIn(spectator_group(self.game.id), channel_layer.groups)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class LobbyConsumerTests(TestCase):
+    def setUp(self):
+        # Overridden per test so each starts with no one online or queued.
+        self.enterContext(override_settings(PRESENCE=IN_MEMORY_PRESENCE, MATCHMAKING=IN_MEMORY_MATCHMAKING))
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(application, '/ws/lobby/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_a_snapshot_then_deltas_in_seq_order(self):
+        alice = await self.connect(self.alice)
+        self.assertEqual(await alice.receive_json_from(), {'action': 'active_users', 'active_users': [], 'seq': 1})
+        # Its own join, which the snapshot already covers.
+        self.assertEqual(await alice.receive_json_from(), {
+            'action': 'user_update', 'change': 'join', 'user_id': self.alice.id, 'username': 'alice', 'busy': False, 'seq': 1,
+        })
+
+        bob = await self.connect(self.bob)
+        self.assertEqual(
+            await bob.receive_json_from(),
+            {'action': 'active_users', 'active_users': [{'id': self.alice.id, 'username': 'alice'}], 'seq': 2},
+        )
+        joined = await alice.receive_json_from()
+        self.assertEqual((joined['change'], joined['user_id'], joined['seq']), ('join', self.bob.id, 2))
+
+        await bob.disconnect()
+        left = await alice.receive_json_from()
+        self.assertEqual((left['change'], left['user_id'], left['seq']), ('leave', self.bob.id, 3))
+        await alice.disconnect()
+
+    async def test_an_accepted_invite_starts_the_game_for_both(self):
+        alice, bob = await self.connect(self.alice), await self.connect(self.bob)
+        for communicator in (alice, bob):
+            while not await communicator.receive_nothing():
+                await communicator.receive_json_from()
+
+        await alice.send_json_to({'action': 'send_invite', 'user_id': self.bob.id})
+        self.assertEqual((await alice.receive_json_from())['action'], 'invite_sent')
+        invite = await bob.receive_json_from()
+        self.assertEqual((invite['action'], invite['sender']), ('receive_invite', 'alice'))
+
+        await bob.send_json_to({'action': 'respond_invite', 'invite_id': invite['invite_id'], 'response': 'accept'})
+        started = []
+        for communicator in (alice, bob):
+            messages = [await communicator.receive_json_from() for _ in range(3)]
+            self.assertEqual({message.get('change') for message in messages[:2]}, {'busy'})
+            self.assertEqual(messages[-1]['action'], 'start_game')
+            started.append(messages[-1]['game_id'])
+        game = await ChessGame.objects.aget(player1=self.alice, player2=self.bob)
+        self.assertEqual(started, [game.id, game.id])
+
+        await bob.send_json_to({'action': 'respond_invite', 'invite_id': invite['invite_id'], 'response': 'accept'})
+        self.assertEqual(await bob.receive_json_from(), {'error': 'This invite has already been answered.'})
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_players_looking_for_a_game_are_matched(self):
+        alice, bob = await self.connect(self.alice), await self.connect(self.bob)
+        for communicator in (alice, bob):
+            while not await communicator.receive_nothing():
+                await communicator.receive_json_from()
+
+        await alice.send_json_to({'action': 'find_match', 'time_control': [180, 2]})
+        self.assertEqual(await alice.receive_json_from(), {'action': 'match_searching', 'time_control': [180, 2]})
+        await bob.send_json_to({'action': 'find_match', 'time_control': [180, 2]})
+        started = []
+        for communicator in (alice, bob):
+            messages = [await communicator.receive_json_from() for _ in range(3)]
+            self.assertEqual(messages[-1]['action'], 'start_game')
+            started.append(messages[-1]['game_id'])
+        game = await ChessGame.objects.aget(id=started[0])
+        self.assertEqual(started[1], game.id)
+        self.assertEqual({game.player1_id, game.player2_id}, {self.alice.id, self.bob.id})
+        self.assertEqual((game.time_base, game.time_increment), (180, 2))
+
+        await alice.send_json_to({'action': 'find_match', 'time_control': [180, 2]})
+        self.assertEqual(await alice.receive_json_from(), {'error': 'You already have a game in progress.'})
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_anonymous_sockets_are_refused(self):
+        communicator = WebsocketCommunicator(application, '/ws/lobby/')
+        communicator.scope['user'] = AnonymousUser()
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
@@ -0,0 +1,53 @@
+import chess
+from django.test import SimpleTestCase
+
+from game.encoding import (
+    PACKED_SIZE, encode_position, pack_board, pack_board_b64, position_hash, position_payload, unpack_board,
+)
+
+
+class PackBoardTests(SimpleTestCase):
+    def assertRoundTrip(self, board):
+        data = pack_board(board)
+        self.assertEqual(len(data), PACKED_SIZE)
+        self.assertEqual(unpack_board(data).fen(), board.fen())
+
+    def test_size(self):
+        self.assertEqual(PACKED_SIZE, 38)
+
+    def test_starting_position(self):
+        self.assertRoundTrip(chess.Board())
+
+    def test_en_passant_and_castling_rights(self):
+        board = chess.Board('rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQK2R w Kq f6 0 3')
+        self.assertEqual(unpack_board(pack_board(board)).ep_square, chess.F6)
+        self.assertRoundTrip(board)
+
+    def test_black_to_move(self):
+        self.assertRoundTrip(chess.Board('rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1'))
+
+    def test_clocks_are_kept(self):
+        self.assertRoundTrip(chess.Board('8/8/8/4k3/8/8/8/4K3 b - - 57 130'))
+
+
+class EncodePositionTests(SimpleTestCase):
+    def setUp(self):
+        self.board = chess.Board()
+        self.board.push_uci('e2e4')
+        self.payload = position_payload(self.board, 1, 'e2e4')
+
+    def test_fen(self):
+        self.assertEqual(encode_position(self.payload, 'fen'), {'fen': self.board.fen(), 'ply': 1})
+
+    def test_packed(self):
+        self.assertEqual(encode_position(self.payload, 'packed'), {'board': pack_board_b64(self.board), 'ply': 1})
+
+    def test_delta(self):
+        self.assertEqual(
+            encode_position(self.payload, 'delta'),
+            {'move': 'e2e4', 'ply': 1, 'hash': position_hash(self.board)},
+        )
+
+    def test_delta_without_a_move_sends_the_fen(self):
+        payload = position_payload(self.board, 1)
+        self.assertEqual(encode_position(payload, 'delta'), {'fen': self.board.fen(), 'ply': 1})
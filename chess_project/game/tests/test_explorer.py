@@ -0,0 +1,57 @@
+import chess
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from game.explorer import explore, index_games
+from game.models import BLACK_WINS, DRAW, WHITE_WINS, ChessGame, GameMove
+
+
+class IndexGamesTests(TestCase):
+    def setUp(self):
+        self.white = User.objects.create_user('white')
+        self.black = User.objects.create_user('black')
+
+    def finished_game(self, moves, result):
+        game = ChessGame.objects.create(
+            player1=self.white, player2=self.black, is_active=False, result=result, ply=len(moves),
+        )
+        GameMove.objects.bulk_create(GameMove(game=game, ply=ply, uci=uci) for ply, uci in enumerate(moves, 1))
+        return game
+
+    def counts(self, *moves):
+        board = chess.Board()
+        for uci in moves:
+            board.push_uci(uci)
+        return {move['uci']: (move['games'], move['white'], move['draws'], move['black']) for move in explore(board)}
+
+    def test_counts_add_up_across_batches(self):
+        self.finished_game(['e2e4', 'e7e5'], WHITE_WINS)
+        self.finished_game(['e2e4', 'c7c5'], DRAW)
+        self.assertEqual(index_games(), 2)
+        self.assertEqual(index_games(), 0)
+
+        self.finished_game(['d2d4', 'd7d5'], BLACK_WINS)
+        self.finished_game(['e2e4', 'e7e5'], BLACK_WINS)
+        self.assertEqual(index_games(), 2)
+
+        self.assertEqual(self.counts(), {'e2e4': (3, 1, 1, 1), 'd2d4': (1, 0, 0, 1)})
+        self.assertEqual(self.counts('e2e4'), {'e7e5': (2, 1, 0, 1), 'c7c5': (1, 0, 1, 0)})
+        self.assertFalse(ChessGame.objects.filter(positions_indexed=False).exists())
+
+    def test_transpositions_share_a_position(self):
+        self.finished_game(['g1f3', 'g8f6', 'b1c3', 'd7d5'], WHITE_WINS)
+        self.finished_game(['b1c3', 'g8f6', 'g1f3', 'e7e5'], WHITE_WINS)
+        index_games()
+        self.assertEqual(self.counts('g1f3', 'g8f6', 'b1c3'), {'d7d5': (1, 1, 0, 0), 'e7e5': (1, 1, 0, 0)})
+
+    def test_games_with_gaps_in_the_move_log_are_skipped(self):
+        game = self.finished_game(['e2e4', 'e7e5'], WHITE_WINS)
+        GameMove.objects.filter(game=game, ply=1).delete()
+        self.assertEqual(index_games(), 1)
+        self.assertEqual(self.counts(), {})
+
+    def test_plies_past_max_ply_are_not_indexed(self):
+        self.finished_game(['e2e4', 'e7e5', 'g1f3'], WHITE_WINS)
+        index_games(max_ply=2)
+        self.assertEqual(self.counts('e2e4', 'e7e5'), {})
+        self.assertEqual(self.counts('e2e4'), {'e7e5': (1, 1, 0, 0)})
@@ -0,0 +1,62 @@
+import json
+
+from django.test import override_settings
+from django.urls import reverse
+
+from game.exports import game_result, iter_games
+from game.models import BLACK_WINS, DRAW, NO_RESULT, WHITE_WINS, ChessGame
+from game.tests.test_views import ViewTestCase
+
+
+class ExportTests(ViewTestCase):
+    def setUp(self):
+        super().setUp()
+        self.play('e2e4', 'e7e5', 'g1f3')
+        self.url = reverse('export_games')
+        self.async_client.force_login(self.white)
+
+    async def export(self, **params):
+        response = await self.async_client.get(self.url, params)
+        self.assertTrue(response.streaming)
+        return b''.join([chunk async for chunk in response.streaming_content]).decode()
+
+    async def test_pgn(self):
+        pgn = await self.export()
+        self.assertIn('[White "white"]\n[Black "black"]\n[Result "*"]\n', pgn)
+        self.assertIn(f'[Site "http://testserver/game/{self.game.id}/"]', pgn)
+        self.assertTrue(pgn.endswith('\n\n1. e4 e5 2. Nf3 *\n\n'))
+
+    @override_settings(GAME_EXPORT_CHUNK_SIZE=1)
+    async def test_ndjson_in_chunks(self):
+        other = await ChessGame.objects.acreate(
+            player1=self.black, player2=self.white, is_active=False, ply=2, game_status='Game drawn by agreement', result=DRAW,
+        )
+        lines = (await self.export(format='ndjson')).splitlines()
+        records = [json.loads(line) for line in lines]
+        self.assertEqual([record['id'] for record in records], [self.game.id, other.id])
+        self.assertEqual((records[0]['moves'], records[0]['result']), ('e2e4 e7e5 g1f3', '*'))
+        # The second game has plies but no moves logged.
+        self.assertEqual((records[1]['moves'], records[1]['result']), (None, '1/2-1/2'))
+
+    async def test_players_only_get_their_own_games(self):
+        await ChessGame.objects.acreate(player1=self.black, player2=self.black)
+        self.assertEqual(len((await self.export(format='ndjson')).splitlines()), 1)
+
+    def test_bad_parameters_are_rejected(self):
+        for params in ({'format': 'csv'}, {'since': 'yesterday'}, {'until': '2024-02-30'}):
+            self.assertEqual(self.client.get(self.url, params).status_code, 400)
+
+    def test_games_after_a_chunk_keep_their_own_moves(self):
+        other = ChessGame.objects.create(player1=self.black, player2=self.white)
+        exported = [(game.id, [move[1] for move in moves]) for game, moves in iter_games(ChessGame.objects.all(), 1)]
+        self.assertEqual(exported, [(self.game.id, ['e2e4', 'e7e5', 'g1f3']), (other.id, [])])
+
+    def test_results(self):
+        for is_active, result, expected in (
+            (False, WHITE_WINS, '1-0'),
+            (False, BLACK_WINS, '0-1'),
+            (False, DRAW, '1/2-1/2'),
+            (False, NO_RESULT, '*'),
+            (True, WHITE_WINS, '*'),
+        ):
+            self.assertEqual(game_result(ChessGame(is_active=is_active, result=result)), expected)
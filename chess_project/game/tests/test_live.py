@@ -0,0 +1,126 @@
+import asyncio
+from unittest import mock
+
+import chess
+from django.contrib.auth.models import AnonymousUser, User
+from django.test import TestCase
+
+from game.live import GameSession, GameSessionCache
+from game.models import ChessGame, GameMove
+
+
+class GameSessionCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.white = User.objects.create_user('white')
+        cls.black = User.objects.create_user('black')
+        cls.games = [
+            ChessGame.objects.create(player1=cls.white, player2=cls.black, current_turn=cls.white, is_active=True)
+            for _ in range(3)
+        ]
+
+    def setUp(self):
+        self.cache = GameSessionCache(max_size=2, idle_timeout=300)
+
+    async def test_sockets_connecting_together_share_one_load(self):
+        game_id = self.games[0].id
+        with mock.patch.object(self.cache, '_load', wraps=self.cache._load) as load:
+            first, second = await asyncio.gather(self.cache.acquire(game_id), self.cache.acquire(game_id))
+        self.assertIs(first, second)
+        self.assertEqual(first.connections, 2)
+        self.assertEqual(load.call_count, 1)
+        self.assertIs(await self.cache.acquire(game_id), first)
+
+    async def test_unknown_games_raise(self):
+        with self.assertRaises(ChessGame.DoesNotExist):
+            await self.cache.acquire(0)
+
+    async def test_only_sessions_without_sockets_are_evicted(self):
+        sessions = [await self.cache.acquire(game.id) for game in self.games]
+        self.assertEqual(len(self.cache), 3)
+        self.cache.release(sessions[0])
+        self.assertEqual(len(self.cache), 2)
+        self.assertIsNone(self.cache.get(self.games[0].id))
+
+    async def test_sessions_with_unwritten_changes_are_kept(self):
+        session = await self.cache.acquire(self.games[0].id)
+        session.dirty = True
+        self.cache.release(session)
+        with mock.patch('game.live.time.monotonic', return_value=session.last_used + 301):
+            self.cache.evict()
+        self.assertIs(self.cache.get(self.games[0].id), session)
+
+    async def test_idle_sessions_are_evicted(self):
+        session = await self.cache.acquire(self.games[0].id)
+        self.cache.release(session)
+        self.assertEqual(len(self.cache), 1)
+        with mock.patch('game.live.time.monotonic', return_value=session.last_used + 301):
+            self.cache.evict()
+        self.assertEqual(len(self.cache), 0)
+
+    async def test_players(self):
+        session = await self.cache.acquire(self.games[0].id)
+        self.assertTrue(session.is_player(self.black))
+        self.assertFalse(session.is_player(User(id=0)))
+        self.assertEqual(session.player_to_move(), self.white)
+
+    def test_anonymous_users_are_not_the_missing_player(self):
+        session = GameSession(ChessGame(player1=self.white, player2=None))
+        self.assertFalse(session.is_player(AnonymousUser()))
+
+
+class GameSessionTests(TestCase):
+    def setUp(self):
+        self.white = User.objects.create_user('white')
+        self.black = User.objects.create_user('black')
+        self.game = ChessGame.objects.create(player1=self.white, player2=self.black, current_turn=self.white)
+
+    def test_irreversible_moves_start_a_new_snapshot(self):
+        session = GameSession(self.game)
+        session.push('g1f3')
+        self.assertEqual((self.game.snapshot_ply, len(session.board.move_stack)), (0, 1))
+        session.push('e7e5')
+        self.assertEqual((self.game.ply, self.game.snapshot_ply, self.game.snapshot_fen), (2, 2, self.game.fen))
+        self.assertEqual(session.board.move_stack, [])
+        self.assertEqual((self.game.player1_move_count, self.game.player2_move_count), (1, 1))
+        self.assertEqual([move.uci for move in session.unsaved_moves], ['g1f3', 'e7e5'])
+
+    def test_illegal_moves_raise_value_error(self):
+        session = GameSession(self.game)
+        for uci in ('e2e5', 'nonsense'):
+            with self.assertRaises(ValueError):
+                session.push(uci)
+        self.assertEqual(self.game.ply, 0)
+
+    def test_the_board_is_rebuilt_from_the_snapshot_and_later_moves(self):
+        moves = ['g1f3', 'g8f6', 'f3g1', 'f6g8'] * 2
+        session = GameSession(self.game)
+        for uci in moves:
+            session.push(uci)
+        GameMove.objects.bulk_create(session.unsaved_moves)
+        ChessGame.objects.filter(id=self.game.id).update(ply=8, fen=self.game.fen)
+
+        game, logged = GameSessionCache._fetch(self.game.id)
+        rebuilt = GameSession(game, logged)
+        self.assertEqual(rebuilt.board.fen(), session.board.fen())
+        # The start position has been on the board three times; two more
+        # rounds make five.
+        for uci in moves[:4]:
+            rebuilt.push(uci)
+        self.assertFalse(rebuilt.board.is_fivefold_repetition())
+        for uci in moves[:4]:
+            rebuilt.push(uci)
+        self.assertTrue(rebuilt.board.is_fivefold_repetition())
+
+    def test_moves_past_the_row_are_not_replayed(self):
+        GameMove.objects.bulk_create([
+            GameMove(game=self.game, ply=1, uci='e2e4'),
+            GameMove(game=self.game, ply=2, uci='e7e5'),
+        ])
+        board = chess.Board()
+        board.push_uci('e2e4')
+        ChessGame.objects.filter(id=self.game.id).update(ply=1, fen=board.fen())
+        game, logged = GameSessionCache._fetch(self.game.id)
+        self.assertEqual(logged, ['e2e4'])
+        session = GameSession(game, logged)
+        self.assertEqual((session.board.fen(), session.dirty), (game.fen, False))
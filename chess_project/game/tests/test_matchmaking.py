@@ -0,0 +1,52 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from game.matchmaking import InMemoryMatchmaker, parse_time_control_key, time_control_key
+
+BLITZ = (180, 2)
+UNTIMED = (None, 0)
+
+
+@mock.patch('game.matchmaking.time.time', return_value=1000.0)
+class InMemoryMatchmakerTests(SimpleTestCase):
+    def setUp(self):
+        self.matchmaker = InMemoryMatchmaker(rating_window=100, window_growth=10, max_rating_window=400)
+
+    async def test_joining_pairs_with_the_closest_player_in_the_window(self, time):
+        self.assertIsNone(await self.matchmaker.aenqueue(1, 1500, BLITZ))
+        self.assertIsNone(await self.matchmaker.aenqueue(2, 1620, BLITZ))
+        self.assertIsNone(await self.matchmaker.aenqueue(3, 1800, BLITZ))
+        self.assertEqual(await self.matchmaker.aenqueue(4, 1590, BLITZ), (2, 1620))
+        self.assertEqual(await self.matchmaker.apair(), [])
+
+    async def test_time_controls_are_kept_apart(self, time):
+        await self.matchmaker.aenqueue(1, 1500, BLITZ)
+        self.assertIsNone(await self.matchmaker.aenqueue(2, 1500, UNTIMED))
+
+    async def test_windows_widen_while_waiting(self, time):
+        await self.matchmaker.aenqueue(1, 1500, BLITZ)
+        await self.matchmaker.aenqueue(2, 1650, BLITZ)
+        self.assertEqual(await self.matchmaker.apair(), [])
+        time.return_value = 1005.0
+        self.assertEqual(await self.matchmaker.apair(), [((1, 1500), (2, 1650), BLITZ)])
+        self.assertEqual(await self.matchmaker.apair(), [])
+
+    async def test_cancelled_players_are_not_paired(self, time):
+        await self.matchmaker.aenqueue(1, 1500, BLITZ)
+        self.assertTrue(await self.matchmaker.acancel(1))
+        self.assertFalse(await self.matchmaker.acancel(1))
+        self.assertIsNone(await self.matchmaker.aenqueue(2, 1500, BLITZ))
+
+    async def test_joining_again_replaces_the_earlier_search(self, time):
+        await self.matchmaker.aenqueue(1, 1500, BLITZ)
+        self.assertIsNone(await self.matchmaker.aenqueue(1, 1500, UNTIMED))
+        self.assertIsNone(await self.matchmaker.aenqueue(2, 1500, BLITZ))
+        self.assertEqual(await self.matchmaker.aenqueue(3, 1500, UNTIMED), (1, 1500))
+
+
+class TimeControlKeyTests(SimpleTestCase):
+    def test_round_trip(self):
+        for time_control in (BLITZ, UNTIMED):
+            self.assertEqual(parse_time_control_key(time_control_key(time_control)), time_control)
+        self.assertEqual(time_control_key(BLITZ), '180+2')
@@ -0,0 +1,72 @@
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase
+from django.urls import reverse
+
+from game.metrics import Counter, Histogram, handler_seconds
+from game.tests.test_consumers import GameConsumerTestCase
+from game.tests.test_views import ViewTestCase
+
+
+class MetricTests(SimpleTestCase):
+    def test_counter(self):
+        counter = Counter('requests_total', 'Requests.', labels=('path',))
+        counter.inc('/a"b')
+        counter.inc('/a"b', amount=2)
+        self.assertEqual(counter.render(), [
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{path="/a\\"b"} 3',
+        ])
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.7, 3.0):
+            histogram.observe(value=value)
+        self.assertEqual(histogram.render()[2:], [
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1.0"} 3',
+            'latency_seconds_bucket{le="+Inf"} 4',
+            'latency_seconds_sum 4.25',
+            'latency_seconds_count 4',
+        ])
+
+
+class MetricsViewTests(ViewTestCase):
+    def test_only_allowed_addresses_and_staff_can_scrape(self):
+        url = reverse('metrics')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE chess_ws_handler_seconds histogram', response.content)
+        self.assertEqual(self.client.get(url, REMOTE_ADDR='203.0.113.7').status_code, 403)
+
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        self.assertEqual(self.client.get(url, REMOTE_ADDR='203.0.113.7').status_code, 200)
+
+    def test_requests_through_nginx_are_judged_by_the_client_address(self):
+        url = reverse('metrics')
+        # Only the address nginx appended counts, not what the client sent.
+        self.assertEqual(self.client.get(url, HTTP_X_FORWARDED_FOR='127.0.0.1, 203.0.113.7').status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_X_FORWARDED_FOR='203.0.113.7, 127.0.0.1').status_code, 200)
+
+
+class HandlerMetricsTests(GameConsumerTestCase):
+    def count(self, handler):
+        # One count per bucket, then the sum.
+        counts = handler_seconds.value('GameConsumer', handler)
+        return sum(counts[:-1]) if counts else 0
+
+    async def test_unlisted_actions_share_one_label(self):
+        counts = {handler: self.count(handler) for handler in ('move', 'sync', 'explore', 'unknown', 'bogus')}
+        white = await self.connect(self.white)
+        await self.move(white, 'e2e4')
+        for action in ('sync', 'explore', 'bogus'):
+            await white.send_json_to({'action': action})
+        await white.receive_json_from()
+        await white.receive_json_from()
+        await white.receive_nothing()
+        await white.disconnect()
+        self.assertEqual(self.count('move') - counts['move'], 1)
+        self.assertEqual(self.count('sync') - counts['sync'], 1)
+        self.assertEqual(self.count('explore') - counts['explore'], 1)
+        self.assertEqual(self.count('unknown') - counts['unknown'], 1)
+        self.assertEqual(self.count('bogus'), 0)
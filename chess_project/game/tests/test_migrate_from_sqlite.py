@@ -0,0 +1,53 @@
+import json
+import os
+import tempfile
+from io import StringIO
+
+from django.contrib.auth.models import Permission, User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.test import TestCase
+
+from game.management.commands.migrate_from_sqlite import has_content_types
+
+
+class MigrateFromSqliteTests(TestCase):
+    def fixture(self, objects):
+        fd, path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as fixture:
+            json.dump(objects, fixture, indent=2)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def migrate(self, *fixtures):
+        args = ['--sqlite', '']
+        for path in fixtures:
+            args += ['--fixture', path]
+        call_command('migrate_from_sqlite', *args, stdout=StringIO())
+
+    def test_permissions_are_kept_without_content_types_to_replace_them(self):
+        permissions = Permission.objects.count()
+        self.migrate(self.fixture([
+            {'model': 'auth.user', 'pk': 50, 'fields': {'username': 'imported', 'password': '!'}},
+        ]))
+        self.assertEqual(User.objects.get(pk=50).username, 'imported')
+        self.assertEqual(Permission.objects.count(), permissions)
+
+    def test_content_types_from_the_fixture_replace_the_migrated_ones(self):
+        dump = StringIO()
+        call_command('dumpdata', 'contenttypes', 'auth.permission', stdout=dump)
+        objects = json.loads(dump.getvalue())
+        # Ids as another database may have numbered them.
+        for obj in objects:
+            if obj['model'] == 'contenttypes.contenttype':
+                obj['pk'] += 1000
+            else:
+                obj['fields']['content_type'] += 1000
+        self.migrate(self.fixture(objects))
+        self.assertEqual(ContentType.objects.filter(pk__lt=1000).count(), 0)
+        self.assertEqual(Permission.objects.count(), len(objects) - ContentType.objects.count())
+
+    def test_content_types_are_found_across_chunks(self):
+        path = self.fixture([{'model': 'contenttypes.contenttype', 'pk': 1, 'fields': {}}])
+        self.assertTrue(has_content_types(path, chunk_size=7))
+        self.assertFalse(has_content_types(self.fixture([{'model': 'auth.user', 'pk': 1}]), chunk_size=7))
@@ -0,0 +1,118 @@
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.db import DatabaseError
+from django.test import TestCase
+
+from game.live import GameSession
+from game.models import WHITE_WINS, ChessGame, GameMove, PlayerRating
+from game.persistence import GameWriter
+
+
+class GameWriterTests(TestCase):
+    def setUp(self):
+        self.white = User.objects.create_user('white')
+        self.black = User.objects.create_user('black')
+        self.game = ChessGame.objects.create(
+            player1=self.white, player2=self.black, current_turn=self.white, is_active=True,
+        )
+        self.session = GameSession(ChessGame.objects.select_related('player1', 'player2').get(id=self.game.id))
+        self.writer = GameWriter(interval=60)
+
+    def play(self, uci):
+        self.session.push(uci)
+        self.session.game.current_turn = self.session.player_to_move()
+
+    def logged(self):
+        return list(GameMove.objects.filter(game_id=self.game.id).order_by('ply').values_list('ply', 'uci'))
+
+    def row(self):
+        return ChessGame.objects.get(id=self.game.id)
+
+    async def test_moves_in_one_window_are_written_once(self):
+        self.play('e2e4')
+        self.writer.mark_dirty(self.session)
+        self.play('e7e5')
+        self.writer.mark_dirty(self.session)
+        self.assertTrue(self.session.dirty)
+        self.writer._scheduled.cancel()
+
+        with mock.patch.object(self.writer, 'write', wraps=self.writer.write) as write:
+            await self.writer.flush()
+        write.assert_called_once()
+        self.assertFalse(self.session.dirty)
+        row = await ChessGame.objects.aget(id=self.game.id)
+        self.assertEqual((row.ply, row.fen), (2, self.session.board.fen()))
+        self.assertEqual(await sync_to_async(self.logged)(), [(1, 'e2e4'), (2, 'e7e5')])
+        self.assertEqual(self.session.unsaved_moves, [])
+
+    def test_only_the_state_columns_are_written(self):
+        ChessGame.objects.filter(id=self.game.id).update(journal_entry='Written meanwhile')
+        self.play('e2e4')
+        self.writer.write(self.writer._take([self.session]))
+        row = self.row()
+        self.assertEqual((row.fen, row.journal_entry), (self.session.board.fen(), 'Written meanwhile'))
+
+    async def test_failed_writes_are_retried(self):
+        self.play('e2e4')
+        self.writer.mark_dirty(self.session)
+        self.writer._scheduled.cancel()
+        with mock.patch.object(self.writer, 'write', side_effect=Exception('database is down')), \
+                self.assertLogs('game.persistence', 'ERROR'):
+            await self.writer.flush()
+        self.assertTrue(self.session.dirty)
+        self.assertEqual(len(self.session.unsaved_moves), 1)
+        self.writer._scheduled.cancel()
+        await self.writer.flush()
+        self.assertFalse(self.session.dirty)
+        self.assertEqual(await sync_to_async(self.logged)(), [(1, 'e2e4')])
+
+    async def test_finished_games_are_written_at_once(self):
+        self.play('e2e4')
+        self.writer.mark_dirty(self.session)
+        self.writer._scheduled.cancel()
+        self.session.game.is_active = False
+        await self.writer.flush_game(self.session)
+        self.assertFalse((await ChessGame.objects.aget(id=self.game.id)).is_active)
+        with mock.patch.object(self.writer, 'write') as write:
+            await self.writer.flush()
+        write.assert_not_called()
+
+    async def test_games_moved_on_elsewhere_are_not_overwritten(self):
+        self.play('e2e4')
+        await ChessGame.objects.filter(id=self.game.id).aupdate(ply=5)
+        with self.assertLogs('game.persistence', 'WARNING'), \
+                mock.patch('game.persistence.send_to_game') as send:
+            self.assertFalse(await self.writer.flush_game(self.session))
+        self.assertTrue(self.session.stale)
+        send.assert_called_once_with(self.game.id, {'type': 'session_stale'})
+        self.assertEqual((await ChessGame.objects.aget(id=self.game.id)).fen, self.game.fen)
+        self.assertEqual(await sync_to_async(self.logged)(), [])
+
+    def test_games_ended_elsewhere_are_not_overwritten(self):
+        ChessGame.objects.filter(id=self.game.id).update(is_active=False)
+        self.play('e2e4')
+        self.assertEqual(self.writer.write(self.writer._take([self.session])), [self.session])
+        self.assertFalse(self.row().is_active)
+
+    def test_finished_games_are_rated_with_the_write(self):
+        self.play('e2e4')
+        self.session.game.is_active = False
+        self.session.game.result = WHITE_WINS
+        self.writer.write(self.writer._take([self.session]))
+        self.assertTrue(self.row().rated)
+        self.assertEqual(PlayerRating.objects.count(), 2)
+
+    async def test_a_failed_game_ending_write_is_queued_again(self):
+        self.play('e2e4')
+        self.session.game.is_active = False
+        with mock.patch.object(self.writer, 'write', side_effect=DatabaseError('database is down')), \
+                self.assertLogs('game.persistence', 'ERROR'), self.assertRaises(DatabaseError):
+            await self.writer.flush_game(self.session)
+        self.writer._scheduled.cancel()
+        self.assertEqual((self.session.saved_ply, self.session.saved_active), (0, True))
+        self.assertEqual(len(self.session.unsaved_moves), 1)
+        await self.writer.flush()
+        self.assertFalse((await ChessGame.objects.aget(id=self.game.id)).is_active)
+        self.assertEqual(await sync_to_async(self.logged)(), [(1, 'e2e4')])
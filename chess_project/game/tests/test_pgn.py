@@ -0,0 +1,118 @@
+import io
+import os
+import tempfile
+from datetime import datetime
+
+import chess
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase
+
+from game.models import ChessGame
+from game.pgn import parse_chunk, split_games, username
+
+PGN = b'''[Event "Mistyped result"]
+[White "Carlsen, Magnus"]
+[Black "Nepo"]
+[Result "1-0"]
+[TimeControl "180+2"]
+[UTCDate "2024.01.02"]
+
+1. f3 {[%clk 0:03:00]} e5 {[%clk 0:02:59.5]} 2. g4 (2. e4 Nc6) Qh4# 1-0
+
+[Event "Custom position"]
+[FEN "8/8/8/8/8/8/8/K6k w - - 0 1"]
+[SetUp "1"]
+[Result "*"]
+
+1. Kb1 *
+[Event "No blank line before it"]
+[White "?"]
+[Black ""]
+[Result "1/2-1/2"]
+
+1. e4 e5 1/2-1/2
+'''
+
+
+class SplitGamesTests(SimpleTestCase):
+    def test_chunks_end_where_the_next_game_starts(self):
+        chunks = list(split_games(io.BytesIO(PGN), games_per_chunk=2))
+        self.assertEqual([len(games) for _, games in chunks], [2, 1])
+        offset = chunks[0][0]
+        self.assertTrue(PGN[offset:].startswith(b'[Event "No blank line before it"]'))
+        self.assertEqual(chunks[-1][0], len(PGN))
+
+    def test_resuming_from_an_offset(self):
+        offset = next(split_games(io.BytesIO(PGN), games_per_chunk=2))[0]
+        self.assertEqual(list(split_games(io.BytesIO(PGN), start=offset)), [(len(PGN), [PGN[offset:]])])
+
+
+class ParseChunkTests(SimpleTestCase):
+    def setUp(self):
+        _, games = next(split_games(io.BytesIO(PGN), games_per_chunk=10))
+        self.records, self.skipped = parse_chunk(games)
+
+    def test_games_that_cannot_be_imported_are_counted(self):
+        self.assertEqual(len(self.records), 2)
+        self.assertEqual(self.skipped, {'custom starting position': 1})
+
+    def test_record(self):
+        white, black, result, status, played_at, time_control, fen, snapshot_fen, snapshot_ply, moves = self.records[0]
+        self.assertEqual((white, black), ('pgn.Carlsen_Magnus', 'pgn.Nepo'))
+        # The board has the last word over the Result tag.
+        self.assertEqual(result, '0-1')
+        self.assertEqual(status, 'Nepo won by checkmate')
+        self.assertEqual(played_at, datetime(2024, 1, 2))
+        self.assertEqual(time_control, (180, 2))
+        self.assertTrue(chess.Board(fen).is_checkmate())
+        # The last irreversible move is g4; Qh4 is not.
+        self.assertEqual(snapshot_ply, 3)
+        self.assertEqual(snapshot_fen, 'rnbqkbnr/pppp1ppp/8/4p3/6P1/5P2/PPPPP2P/RNBQKBNR b KQkq - 0 2')
+        # The variation is skipped and the clocks are read from the comments.
+        self.assertEqual(moves, [('f2f3', 180000), ('e7e5', 179500), ('g2g4', None), ('d8h4', None)])
+
+    def test_draw_between_unnamed_players(self):
+        self.assertEqual(self.records[1][:6], (None, None, '1/2-1/2', 'Draw', None, None))
+
+
+class UsernameTests(SimpleTestCase):
+    def test_names_become_valid_usernames(self):
+        self.assertEqual(username('Carlsen, Magnus'), 'pgn.Carlsen_Magnus')
+        self.assertIsNone(username(' ? '))
+        self.assertEqual(len(username('x' * 200)), 150)
+
+
+class ImportTests(TestCase):
+    def setUp(self):
+        descriptor, self.path = tempfile.mkstemp(suffix='.pgn')
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(PGN)
+        self.addCleanup(os.remove, self.path)
+
+    def import_pgn(self):
+        call_command('import_pgn', self.path, workers=0, stdout=io.StringIO(), stderr=io.StringIO())
+
+    def test_players_get_accounts_apart_from_the_sites_users(self):
+        nepo = User.objects.create_user('Nepo', password='secret')
+        self.import_pgn()
+        named, unnamed = ChessGame.objects.order_by('id')
+        self.assertEqual((named.player1.username, named.player2.username), ('pgn.Carlsen_Magnus', 'pgn.Nepo'))
+        self.assertFalse(ChessGame.objects.filter(player2=nepo).exists())
+        self.assertFalse(named.player2.is_active)
+        self.assertFalse(named.player2.has_usable_password())
+        # Unnamed players are not merged into one account.
+        self.assertNotEqual(unnamed.player1_id, unnamed.player2_id)
+        self.assertTrue(unnamed.player1.username.startswith('pgn-'))
+
+    def test_the_same_player_keeps_one_account_across_imports(self):
+        self.import_pgn()
+        call_command('import_pgn', self.path, workers=0, restart=True, stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertEqual(User.objects.filter(username='pgn.Nepo').count(), 1)
+        self.assertEqual(ChessGame.objects.filter(player2__username='pgn.Nepo').count(), 2)
+
+    def test_registered_users_are_never_attached(self):
+        User.objects.create_user('pgn.Nepo', password='secret')
+        with self.assertRaisesMessage(CommandError, 'pgn.Nepo'):
+            self.import_pgn()
+        self.assertFalse(ChessGame.objects.exists())
@@ -0,0 +1,83 @@
+from types import SimpleNamespace
+from unittest import mock
+
+from django.test import SimpleTestCase
+from psycopg2 import extensions
+
+from chess_project.pooled_postgresql.pool import ConnectionPool, PoolTimeout
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.autocommit = False
+        self.info = SimpleNamespace(transaction_status=extensions.TRANSACTION_STATUS_IDLE)
+        self.cursor = mock.MagicMock()
+        self.rolled_back = 0
+
+    def rollback(self):
+        self.rolled_back += 1
+        self.info.transaction_status = extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+@mock.patch('chess_project.pooled_postgresql.pool.time.monotonic', return_value=1000.0)
+class ConnectionPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.pool = ConnectionPool(max_size=2, timeout=0, max_idle=300, check_after=30)
+        self.opened = []
+
+    def connect(self):
+        connection = FakeConnection()
+        self.opened.append(connection)
+        return connection
+
+    def test_returned_connections_are_reused(self, monotonic):
+        first = self.pool.getconn(self.connect)
+        self.pool.putconn(first)
+        self.assertIs(self.pool.getconn(self.connect), first)
+        self.assertEqual(len(self.opened), 1)
+
+    def test_checkouts_beyond_max_size_time_out(self, monotonic):
+        taken = [self.pool.getconn(self.connect) for _ in range(2)]
+        with self.assertRaises(PoolTimeout):
+            self.pool.getconn(self.connect)
+        self.pool.putconn(taken[0])
+        self.assertIs(self.pool.getconn(self.connect), taken[0])
+
+    def test_open_transactions_are_rolled_back_on_return(self, monotonic):
+        connection = self.pool.getconn(self.connect)
+        connection.info.transaction_status = extensions.TRANSACTION_STATUS_INERROR
+        self.pool.putconn(connection)
+        self.assertEqual(connection.rolled_back, 1)
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+    def test_broken_connections_are_not_pooled(self, monotonic):
+        connection = self.pool.getconn(self.connect)
+        connection.info.transaction_status = extensions.TRANSACTION_STATUS_UNKNOWN
+        self.pool.putconn(connection)
+        self.assertTrue(connection.closed)
+        self.assertEqual(self.pool.stats()['idle'], 0)
+        self.assertIsNot(self.pool.getconn(self.connect), connection)
+
+    def test_idle_connections_are_checked_then_expired(self, monotonic):
+        connection = self.pool.getconn(self.connect)
+        self.pool.putconn(connection)
+        monotonic.return_value += 60
+        self.assertIs(self.pool.getconn(self.connect), connection)
+        connection.cursor.return_value.__enter__.return_value.execute.assert_called_once_with('SELECT 1')
+
+        self.pool.putconn(connection)
+        monotonic.return_value += 301
+        self.assertIsNot(self.pool.getconn(self.connect), connection)
+        self.assertTrue(connection.closed)
+
+    def test_discarded_connections_free_their_slot(self, monotonic):
+        taken = [self.pool.getconn(self.connect) for _ in range(2)]
+        self.pool.discard(taken[0])
+        self.assertTrue(taken[0].closed)
+        self.assertEqual(len(self.opened), 2)
+        self.pool.getconn(self.connect)
+        self.assertEqual(len(self.opened), 3)
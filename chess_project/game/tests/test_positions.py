@@ -0,0 +1,72 @@
+import chess
+from django.test import SimpleTestCase
+
+from game.positions import Position, PositionCache, game_outcome, position_key
+
+
+def squares(destinations):
+    return {destinations[i:i + 2] for i in range(0, len(destinations), 2)}
+
+
+class PositionTests(SimpleTestCase):
+    def test_legal_moves_by_origin_square(self):
+        position = Position(chess.Board())
+        self.assertEqual(len(position.legal_moves), 20)
+        self.assertEqual(squares(position.legal_payload['e2']), {'e3', 'e4'})
+        self.assertEqual(squares(position.legal_payload['g1']), {'f3', 'h3'})
+
+    def test_promotions_share_a_destination(self):
+        position = Position(chess.Board('8/P7/8/8/8/8/8/k6K w - - 0 1'))
+        self.assertTrue({'a7a8q', 'a7a8n'} <= position.legal_moves)
+        self.assertEqual(position.legal_payload['a7'], 'a8')
+
+
+class PositionCacheTests(SimpleTestCase):
+    def test_transpositions_share_an_entry(self):
+        cache = PositionCache(max_size=10)
+        first, second = chess.Board(), chess.Board()
+        for uci in ('g1f3', 'g8f6', 'b1c3'):
+            first.push_uci(uci)
+        for uci in ('b1c3', 'g8f6', 'g1f3'):
+            second.push_uci(uci)
+        self.assertIs(cache.get(first), cache.get(second, position_key(second)))
+        self.assertEqual(len(cache), 1)
+
+    def test_least_recently_used_positions_are_evicted(self):
+        cache = PositionCache(max_size=2)
+        boards = [chess.Board(), chess.Board('8/8/8/8/8/8/8/k6K w - - 0 1'), chess.Board('8/8/8/8/8/8/8/k6K b - - 0 1')]
+        start = cache.get(boards[0])
+        cache.get(boards[1])
+        cache.get(boards[0])
+        cache.get(boards[2])
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.get(boards[0]), start)
+
+
+class GameOutcomeTests(SimpleTestCase):
+    def outcome(self, board):
+        return game_outcome(board, Position(board))
+
+    def test_outcomes(self):
+        self.assertIsNone(self.outcome(chess.Board()))
+        self.assertEqual(self.outcome(chess.Board('7k/5Q2/6K1/8/8/8/8/8 b - - 0 1')), 'stalemate')
+        self.assertEqual(self.outcome(chess.Board('7k/6Q1/6K1/8/8/8/8/8 b - - 0 1')), 'checkmate')
+        self.assertEqual(self.outcome(chess.Board('8/8/8/4k3/8/8/8/4KB2 w - - 0 1')), 'insufficient_material')
+        self.assertEqual(self.outcome(chess.Board('8/8/8/4k3/8/8/8/3QK3 w - - 150 100')), 'seventyfive_moves')
+
+    def test_fivefold_repetition_needs_the_history(self):
+        board = chess.Board()
+        for _ in range(4):
+            for uci in ('g1f3', 'g8f6', 'f3g1', 'f6g8'):
+                board.push_uci(uci)
+        self.assertEqual(self.outcome(board), 'fivefold_repetition')
+        self.assertIsNone(self.outcome(chess.Board(board.fen())))
+
+    def test_cache_statistics(self):
+        cache = PositionCache(max_size=1)
+        cache.get(chess.Board())
+        cache.get(chess.Board())
+        cache.get(chess.Board('8/8/8/8/8/8/8/k6K w - - 0 1'))
+        self.assertEqual(cache.stats(), {
+            'size': 1, 'max_size': 1, 'hits': 1, 'misses': 2, 'evictions': 1, 'hit_rate': 1 / 3,
+        })
@@ -0,0 +1,105 @@
+from unittest import mock
+
+import fakeredis
+from django.test import SimpleTestCase
+
+from game.presence import InMemoryPresence, RedisPresence
+
+
+class FakeRedisPresence(RedisPresence):
+    """RedisPresence on an in-process server; the Lua scripts run as they would on Redis."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.server = fakeredis.FakeServer()
+
+    def client(self):
+        if self._client is None:
+            self._client = fakeredis.FakeRedis(server=self.server, decode_responses=True)
+            self._scripts = self._register(self._client)
+        return self._client, self._scripts
+
+    def async_client(self):
+        client = fakeredis.FakeAsyncRedis(server=self.server, decode_responses=True)
+        return client, self._register(client)
+
+
+class PresenceTests:
+    """Run against each backend; they must behave the same."""
+
+    def make_presence(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.presence = self.make_presence()
+
+    def test_snapshot_leaves_out_busy_users_and_the_asker(self, time):
+        self.presence.mark_online(1, 'alice')
+        self.presence.mark_online(2, 'bob')
+        self.presence.mark_online(3, 'carol')
+        self.presence.set_busy(2, None)
+        self.assertEqual(self.presence.snapshot(exclude_id=1), (4, [{'id': 3, 'username': 'carol'}]))
+        self.presence.set_available(2)
+        self.assertEqual(len(self.presence.available_users(exclude_id=1)), 2)
+
+    def test_every_change_takes_the_next_seq(self, time):
+        self.assertEqual(self.presence.mark_online(1, 'alice'), [
+            {'action': 'join', 'user_id': 1, 'username': 'alice', 'seq': 1, 'busy': False},
+        ])
+        self.assertEqual(self.presence.mark_online(1, 'alice'), [])
+        self.assertEqual(self.presence.set_busy(1, 2), [
+            {'action': 'busy', 'user_id': 1, 'username': 'alice', 'seq': 2, 'busy': True},
+        ])
+        self.assertEqual(self.presence.set_busy(1), [])
+        self.assertEqual(self.presence.set_available(1), [
+            {'action': 'available', 'user_id': 1, 'username': 'alice', 'seq': 3, 'busy': False},
+        ])
+        self.assertEqual(self.presence.mark_offline(1), [
+            {'action': 'leave', 'user_id': 1, 'username': '', 'seq': 4, 'busy': False},
+        ])
+        self.assertEqual(self.presence.mark_offline(1), [])
+        self.assertEqual(self.presence.snapshot(), (4, []))
+
+    def test_busy_users_join_as_busy(self, time):
+        self.presence.set_busy(1)
+        self.assertTrue(self.presence.mark_online(1, 'alice')[0]['busy'])
+
+    async def test_users_without_a_recent_heartbeat_are_swept(self, time):
+        await self.presence.aconnect(1, 'alice')
+        await self.presence.aconnect(2, 'bob')
+        time.return_value = 1060.0
+        await self.presence.aheartbeat(2)
+        time.return_value = 1091.0
+        self.assertEqual(await self.presence.aprune(), [
+            {'action': 'leave', 'user_id': 1, 'username': 'alice', 'seq': 3, 'busy': False},
+        ])
+        self.assertEqual(await self.presence.asnapshot(), (3, [{'id': 2, 'username': 'bob'}]))
+
+    async def test_users_stay_online_until_their_last_socket_closes(self, time):
+        self.assertEqual(len(await self.presence.aconnect(1, 'alice')), 1)
+        self.assertEqual(await self.presence.aconnect(1, 'alice'), [])
+        self.assertEqual(await self.presence.adisconnect(1), [])
+        self.assertEqual(await self.presence.aavailable_users(), [{'id': 1, 'username': 'alice'}])
+        self.assertEqual([delta['action'] for delta in await self.presence.adisconnect(1)], ['leave'])
+        self.assertEqual(await self.presence.aavailable_users(), [])
+
+    def test_reset_busy_replaces_the_busy_set(self, time):
+        self.presence.mark_online(1, 'alice')
+        self.presence.mark_online(2, 'bob')
+        self.presence.set_busy(1)
+        self.presence.reset_busy([2])
+        # Clients cannot tell what changed, so the seq moves on and they
+        # fetch a new snapshot.
+        self.assertEqual(self.presence.snapshot(), (4, [{'id': 1, 'username': 'alice'}]))
+
+
+@mock.patch('game.presence.time.time', return_value=1000.0)
+class RedisPresenceTests(PresenceTests, SimpleTestCase):
+    def make_presence(self):
+        return FakeRedisPresence(ttl=90)
+
+
+@mock.patch('game.presence.time.time', return_value=1000.0)
+class InMemoryPresenceTests(PresenceTests, SimpleTestCase):
+    def make_presence(self):
+        return InMemoryPresence(ttl=90)
@@ -0,0 +1,135 @@
+import math
+from unittest import mock
+
+import numpy as np
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+
+from game.management.commands.recompute_ratings import Command as RecomputeRatings
+from game.models import BLACK_WINS, DRAW, NO_RESULT, WHITE_WINS, ChessGame, PlayerRating
+from game.ratings import glicko2, idle_deviation, rate_games, replay
+
+# The example of Glickman's "Example of the Glicko-2 system": a 1500 player
+# with deviation 200 beats a 1400, then loses to a 1550 and a 1700.
+EXAMPLE_RESULTS = [(1400, 30, 1), (1550, 100, 0), (1700, 300, 0)]
+
+
+class Glicko2Tests(SimpleTestCase):
+    def test_worked_example(self):
+        rating, deviation, volatility = glicko2(1500, 200, 0.06, EXAMPLE_RESULTS, 0.5)
+        # The paper rounds its intermediate values.
+        self.assertAlmostEqual(rating, 1464.06, delta=0.01)
+        self.assertAlmostEqual(deviation, 151.52, delta=0.01)
+        self.assertAlmostEqual(volatility, 0.05999, delta=0.00001)
+
+    def test_idle_deviation_grows_up_to_the_initial_deviation(self):
+        self.assertEqual(idle_deviation(50, 0.06, 0), 50)
+        self.assertGreater(idle_deviation(50, 0.06, 10), 50)
+        self.assertEqual(idle_deviation(50, 0.06, 10 ** 9), 350)
+
+
+class ReplayTests(SimpleTestCase):
+    def ratings(self, n, rating=1500.0, deviation=350.0):
+        return (np.full(n, rating), np.full(n, deviation), np.full(n, 0.06), np.full(n, -1))
+
+    def test_one_period_matches_the_worked_example(self):
+        ratings = (
+            np.array([1500.0, 1400, 1550, 1700]), np.array([200.0, 30, 100, 300]),
+            np.full(4, 0.06), np.full(4, -1),
+        )
+        replay(np.array([0, 0, 0]), np.array([1, 2, 3]), np.array([1.0, 0, 0]), np.zeros(3, dtype=int), ratings, 0.5, 350)
+        expected = glicko2(1500, 200, 0.06, EXAMPLE_RESULTS, 0.5)
+        for values, value in zip(ratings[:3], expected):
+            self.assertAlmostEqual(values[0], value, places=6)
+        self.assertEqual(ratings[3][0], 0)
+
+    def test_single_game_periods_match_game_by_game_updates(self):
+        rng = np.random.default_rng(1)
+        players, games = 10, 300
+        white = rng.integers(0, players, games)
+        black = (white + rng.integers(1, players, games)) % players
+        score = rng.choice([0.0, 0.5, 1.0], games)
+        ratings = self.ratings(players)
+        replay(white, black, score, np.arange(games) * 3, ratings, 0.5, 350)
+
+        expected = [[1500.0, 350.0, 0.06, None] for _ in range(players)]
+        for period, (w, b, s) in enumerate(zip(white, black, score)):
+            period *= 3
+            for player in (expected[w], expected[b]):
+                if player[3] is not None:
+                    player[1] = idle_deviation(player[1], player[2], period - player[3] - 1)
+            white_after = glicko2(*expected[w][:3], [(expected[b][0], expected[b][1], s)], 0.5)
+            black_after = glicko2(*expected[b][:3], [(expected[w][0], expected[w][1], 1 - s)], 0.5)
+            expected[w][:3], expected[b][:3] = white_after, black_after
+            expected[w][3] = expected[b][3] = period
+        for i, (rating, deviation, volatility, _) in enumerate(expected):
+            self.assertTrue(math.isclose(ratings[0][i], rating, abs_tol=1e-6))
+            self.assertTrue(math.isclose(ratings[1][i], deviation, abs_tol=1e-6))
+            self.assertTrue(math.isclose(ratings[2][i], volatility, abs_tol=1e-9))
+
+
+class RateGamesTests(TestCase):
+    def setUp(self):
+        self.white = User.objects.create_user('white')
+        self.black = User.objects.create_user('black')
+
+    def finished_game(self, result, **fields):
+        return ChessGame.objects.create(player1=self.white, player2=self.black, is_active=False, result=result, **fields)
+
+    def test_a_win_moves_both_ratings_once(self):
+        game = self.finished_game(WHITE_WINS)
+        self.assertEqual(rate_games([game.id]), 1)
+        self.assertEqual(rate_games([game.id]), 0)
+
+        white, black = PlayerRating.objects.get(user=self.white), PlayerRating.objects.get(user=self.black)
+        self.assertGreater(white.rating, 1500)
+        self.assertAlmostEqual(white.rating - 1500, 1500 - black.rating)
+        self.assertLess(white.deviation, 350)
+        self.assertEqual((white.games, black.games), (1, 1))
+        self.assertTrue(ChessGame.objects.get(id=game.id).rated)
+
+    def test_a_draw_between_equals_keeps_the_ratings(self):
+        game = self.finished_game(DRAW)
+        rate_games([game.id])
+        self.assertAlmostEqual(PlayerRating.objects.get(user=self.white).rating, 1500)
+
+    def test_games_without_a_result_are_only_marked_rated(self):
+        games = [self.finished_game(NO_RESULT), ChessGame.objects.create(player1=self.white, is_active=False, result=BLACK_WINS)]
+        self.assertEqual(rate_games([game.id for game in games]), 2)
+        self.assertFalse(PlayerRating.objects.exists())
+        self.assertFalse(ChessGame.objects.filter(rated=False).exists())
+
+    def test_active_games_are_not_rated(self):
+        game = ChessGame.objects.create(player1=self.white, player2=self.black, is_active=True)
+        self.assertEqual(rate_games([game.id]), 0)
+
+
+class RecomputeRatingsTests(TestCase):
+    def setUp(self):
+        self.white = User.objects.create_user('white')
+        self.black = User.objects.create_user('black')
+
+    @mock.patch('game.management.commands.recompute_ratings.UPDATE_BATCH_SIZE', 1)
+    def test_saving_marks_games_in_batches(self):
+        replayed = [
+            ChessGame.objects.create(player1=self.white, player2=self.black, is_active=False, result=WHITE_WINS)
+            for _ in range(3)
+        ]
+        # Active when read, then ended and rated while the replay ran...
+        ended = [
+            ChessGame.objects.create(player1=self.white, player2=self.black, is_active=False, result=DRAW, rated=True)
+            for _ in range(2)
+        ]
+        # ...and created since.
+        created = ChessGame.objects.create(player1=self.white, player2=self.black, is_active=False, result=DRAW, rated=True)
+
+        RecomputeRatings().save(
+            [], np.array([game.id for game in replayed], dtype=np.int64), ended[-1].id, [game.id for game in ended],
+        )
+        self.assertEqual(
+            set(ChessGame.objects.filter(rated=True).values_list('id', flat=True)), {game.id for game in replayed},
+        )
+        self.assertEqual(
+            set(ChessGame.objects.filter(rated=False).values_list('id', flat=True)),
+            {game.id for game in ended} | {created.id},
+        )
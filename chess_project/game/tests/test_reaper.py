@@ -0,0 +1,90 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from game.models import NO_RESULT, WHITE_WINS, ChessGame, GameInvite
+from game.presence import get_presence
+from game.reaper import Reaper
+from game.tests.test_consumers import IN_MEMORY_CHANNEL_LAYERS, IN_MEMORY_PRESENCE
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, PRESENCE=IN_MEMORY_PRESENCE)
+class ReaperTests(TestCase):
+    def setUp(self):
+        self.white = User.objects.create_user('white')
+        self.black = User.objects.create_user('black')
+        self.reaper = Reaper(batch_size=2, pause=0, invite_ttl=600, invite_retention=3600,
+                             game_idle_timeout=3600, flag_grace=30)
+        self.now = timezone.now()
+
+    def game(self, **fields):
+        return ChessGame.objects.create(
+            player1=self.white, player2=self.black, current_turn=self.white, is_active=True, **fields,
+        )
+
+    def invite(self, status, age):
+        invite = GameInvite.objects.create(sender=self.white, receiver=self.black, status=status)
+        GameInvite.objects.filter(id=invite.id).update(created_at=self.now - timedelta(seconds=age))
+        return invite
+
+    def test_invites_expire_and_are_deleted_later(self):
+        fresh = self.invite('pending', 60)
+        stale = [self.invite('pending', 700) for _ in range(3)]
+        old = self.invite('declined', 4000)
+        answered = self.invite('accepted', 4000)
+        counts = self.reaper.run()
+        self.assertEqual((counts['expired invites'], counts['deleted invites']), (3, 1))
+        self.assertEqual(GameInvite.objects.get(id=fresh.id).status, 'pending')
+        self.assertEqual(set(GameInvite.objects.filter(status='expired').values_list('id', flat=True)),
+                         {invite.id for invite in stale})
+        self.assertFalse(GameInvite.objects.filter(id=old.id).exists())
+        self.assertTrue(GameInvite.objects.filter(id=answered.id).exists())
+
+    def test_games_past_their_deadline_are_lost_on_time(self):
+        flagged = self.game(time_base=60, ply=1, player2_clock_ms=5000,
+                            clock_deadline=self.now - timedelta(seconds=31))
+        running = self.game(time_base=60, clock_deadline=self.now - timedelta(seconds=5))
+        get_presence().set_busy(self.white.id, self.black.id)
+        with mock.patch('game.reaper.send_to_game_sync') as send:
+            self.assertEqual(self.reaper.flag_games(), 1)
+        flagged.refresh_from_db()
+        self.assertEqual(
+            (flagged.is_active, flagged.current_turn_id, flagged.clock_deadline, flagged.player2_clock_ms),
+            (False, None, None, 0),
+        )
+        self.assertEqual((flagged.game_status, flagged.result), ('black ran out of time. white wins!', WHITE_WINS))
+        send.assert_called_once_with(
+            flagged.id, {'type': 'game_status', 'message': flagged.game_status, 'result': WHITE_WINS},
+        )
+        self.assertEqual(get_presence()._busy, set())
+        self.assertTrue(ChessGame.objects.get(id=running.id).is_active)
+
+    def test_idle_games_are_abandoned(self):
+        idle = [self.game(last_move_at=self.now - timedelta(hours=2)) for _ in range(3)]
+        recent = self.game()
+        with mock.patch('game.reaper.send_to_game_sync'):
+            self.assertEqual(self.reaper.run()['abandoned games'], 3)
+        for game in idle:
+            game.refresh_from_db()
+            self.assertEqual(
+                (game.is_active, game.game_status, game.result),
+                (False, 'Game abandoned after 1 hours without a move.', NO_RESULT),
+            )
+        self.assertTrue(ChessGame.objects.get(id=recent.id).is_active)
+
+    def test_games_moved_on_since_they_were_read_are_left_alone(self):
+        game = self.game(last_move_at=self.now - timedelta(hours=2))
+        with mock.patch('game.reaper.send_to_game_sync') as send:
+            self.reaper._end_game(ChessGame(id=game.id, ply=3), 'Abandoned', NO_RESULT)
+        send.assert_not_called()
+        self.assertTrue(ChessGame.objects.get(id=game.id).is_active)
+
+    def test_expired_sessions_are_cleared(self):
+        Session.objects.create(session_key='old', session_data='', expire_date=self.now - timedelta(days=1))
+        Session.objects.create(session_key='new', session_data='', expire_date=self.now + timedelta(days=1))
+        self.assertEqual(self.reaper.clear_sessions(), 1)
+        self.assertEqual(list(Session.objects.values_list('session_key', flat=True)), ['new'])
@@ -0,0 +1,57 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from game.models import ChessGame, GameInvite
+from game.services import _answer_invite, _create_invite, _create_match
+
+
+class InviteTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+
+    def test_invites_need_an_existing_user(self):
+        self.assertEqual(_create_invite(self.alice, 0, None), (None, 'User does not exist'))
+        self.assertEqual(_create_invite(self.alice, 'x', None), (None, 'User does not exist'))
+
+    def test_no_second_game_with_the_same_opponent(self):
+        ChessGame.objects.create(player1=self.bob, player2=self.alice, is_active=True)
+        self.assertEqual(
+            _create_invite(self.alice, self.bob.id, None),
+            (None, 'You are already playing a game with this user.'),
+        )
+
+    def test_accepting_creates_the_game_once(self):
+        invite, error = _create_invite(self.alice, self.bob.id, None)
+        self.assertIsNone(error)
+        self.assertEqual(_answer_invite(self.alice, invite.id, True), (None, 'Invalid invite'))
+
+        accepted, error = _answer_invite(self.bob, invite.id, True)
+        self.assertIsNone(error)
+        self.assertEqual((accepted.game.player1, accepted.game.player2, accepted.status), (self.alice, self.bob, 'accepted'))
+        self.assertEqual(_answer_invite(self.bob, invite.id, True), (None, 'This invite has already been answered.'))
+        self.assertEqual(ChessGame.objects.count(), 1)
+
+    def test_timed_invites_set_up_the_clocks(self):
+        for time_control in (['x', 2], [0, 2], [60, 61], [60]):
+            self.assertEqual(_create_invite(self.alice, self.bob.id, time_control), (None, 'Invalid time control'))
+        invite, _ = _create_invite(self.alice, self.bob.id, [300, 5])
+        game = _answer_invite(self.bob, invite.id, True)[0].game
+        self.assertEqual((game.time_base, game.time_increment, game.player1_clock_ms), (300, 5, 300000))
+        # The clocks start with the first move.
+        self.assertIsNone(game.clock_deadline)
+
+    def test_no_game_is_started_for_a_player_already_playing(self):
+        invite, _ = _create_invite(self.alice, self.bob.id, None)
+        carol = User.objects.create_user('carol')
+        ChessGame.objects.create(player1=carol, player2=self.bob, is_active=True)
+        self.assertEqual(_answer_invite(self.bob, invite.id, True), (None, 'One of you already has a game in progress.'))
+        self.assertEqual(_create_match(self.alice.id, self.bob.id, (None, 0)), (None, {self.bob.id}))
+        self.assertEqual(ChessGame.objects.count(), 1)
+
+    def test_declining(self):
+        invite, _ = _create_invite(self.alice, self.bob.id, None)
+        _answer_invite(self.bob, invite.id, False)
+        self.assertEqual(GameInvite.objects.get(id=invite.id).status, 'declined')
+        self.assertFalse(ChessGame.objects.exists())
+        self.assertEqual(_answer_invite(self.bob, 0, True), (None, 'Invite does not exist'))
@@ -0,0 +1,199 @@
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from game.live import GameSession, game_sessions
+from game.models import BLACK_WINS, ChessGame, GameMove
+from game.tests.test_consumers import IN_MEMORY_CHANNEL_LAYERS
+from game.tests.test_presence import FakeRedisPresence
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ViewTestCase(TestCase):
+    def setUp(self):
+        # Game ids are reused once a test's rows are rolled back.
+        game_sessions._sessions.clear()
+        patcher = mock.patch('game.presence._presence', FakeRedisPresence())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.white = User.objects.create_user('white')
+        self.black = User.objects.create_user('black')
+        self.game = ChessGame.objects.create(
+            player1=self.white, player2=self.black, current_turn=self.white, is_active=True,
+        )
+        self.client.force_login(self.white)
+
+    def play(self, *moves):
+        session = GameSession(self.game)
+        for uci in moves:
+            session.push(uci)
+        GameMove.objects.bulk_create(session.unsaved_moves)
+        self.game.save()
+
+
+class LoginTests(ViewTestCase):
+    def test_logging_in_and_out_survives_redis_being_down(self):
+        User.objects.create_user('carol', password='secret')
+        presence = mock.Mock(**{
+            'mark_online.side_effect': RedisConnectionError('refused'),
+            'mark_offline.side_effect': RedisConnectionError('refused'),
+        })
+        with mock.patch('game.signals.get_presence', return_value=presence), self.assertLogs('game.signals', 'ERROR'):
+            response = self.client.post(reverse('login'), {'username': 'carol', 'password': 'secret'})
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(self.client.post(reverse('logout')).status_code, 302)
+
+
+class RegisterTests(ViewTestCase):
+    def test_the_names_of_imported_players_are_reserved(self):
+        self.client.logout()
+        for username in ('pgn.Nepo', 'pgn-1'):
+            response = self.client.post(reverse('register'), {
+                'username': username, 'password1': 'Unguessable-42', 'password2': 'Unguessable-42',
+            })
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('username', response.context['form'].errors)
+        self.assertFalse(User.objects.filter(username__startswith='pgn').exists())
+
+
+class BoardSvgTests(ViewTestCase):
+    def setUp(self):
+        super().setUp()
+        caches['boards'].clear()
+        self.url = reverse('game_board_svg', args=[self.game.id])
+
+    def test_unchanged_positions_are_not_sent_again(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        self.assertIn(b'<svg', response.content)
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertIn('private', response['Cache-Control'])
+
+        with mock.patch('game.rendering.render_board') as render_board:
+            revalidated = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated['ETag'], response['ETag'])
+        render_board.assert_not_called()
+
+    def test_positions_are_rendered_once(self):
+        first = self.client.get(self.url)
+        other = ChessGame.objects.create(player1=self.black, player2=self.white, current_turn=self.black)
+        with mock.patch('game.rendering.render_board') as render_board:
+            second = self.client.get(reverse('game_board_svg', args=[other.id]))
+        render_board.assert_not_called()
+        self.assertEqual(second.content, first.content)
+
+    def test_the_image_changes_with_the_position_and_orientation(self):
+        start = self.client.get(self.url)['ETag']
+        black = self.client.get(self.url, {'orientation': 'black'})['ETag']
+        self.play('e2e4')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=start)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len({start, black, response['ETag']}), 3)
+        # The last move is highlighted.
+        self.assertIn(b'fill="#cdd16a"', response.content)
+
+    async def test_live_games_are_drawn_from_their_session(self):
+        await sync_to_async(self.async_client.force_login)(self.white)
+        session = await game_sessions.acquire(self.game.id)
+        self.addCleanup(game_sessions.release, session)
+        start = (await self.async_client.get(self.url))['ETag']
+        # Not written to the row yet.
+        session.push('e2e4')
+        moved = await self.async_client.get(self.url, HTTP_IF_NONE_MATCH=start)
+        self.assertEqual(moved.status_code, 200)
+        self.assertIn(b'fill="#cdd16a"', moved.content)
+
+
+class GameViewTests(ViewTestCase):
+    def test_the_board_faces_the_viewer(self):
+        self.assertEqual(self.client.get(reverse('game_view', args=[self.game.id])).context['orientation'], 'white')
+        self.client.force_login(self.black)
+        response = self.client.get(reverse('game_view', args=[self.game.id]))
+        self.assertEqual(response.context['orientation'], 'black')
+        self.assertEqual(response.context['current_turn_username'], 'white')
+
+    async def test_live_games_are_shown_from_their_session(self):
+        await sync_to_async(self.async_client.force_login)(self.white)
+        session = await game_sessions.acquire(self.game.id)
+        self.addCleanup(game_sessions.release, session)
+        # Not written to the row yet.
+        session.push('e2e4')
+        response = await self.async_client.get(reverse('game_view', args=[self.game.id]))
+        self.assertEqual(response.context['current_turn_username'], 'black')
+
+    def test_games_waiting_for_an_opponent(self):
+        game = ChessGame.objects.create(player1=self.white, current_turn=self.white, is_active=True)
+        game.fen = '4k3/8/8/8/8/8/8/4K3 b - - 0 1'
+        game.save()
+        response = self.client.get(reverse('game_view', args=[game.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['current_turn_username'], 'unknown')
+
+
+class ExitGameTests(ViewTestCase):
+    def test_leaving_resigns(self):
+        self.play('e2e4')
+        url = reverse('exit_game', args=[self.game.id])
+        self.assertEqual(
+            self.client.post(url).json(),
+            {'status': 'success', 'exited_player': 'player1', 'opponent': 'black'},
+        )
+        game = ChessGame.objects.get(id=self.game.id)
+        self.assertEqual(
+            (game.is_active, game.ply, game.result, game.game_status),
+            (False, 1, BLACK_WINS, 'Game ended by white. black wins!'),
+        )
+        self.assertEqual(self.client.post(url).json(), {'status': 'error', 'message': 'This game is over.'})
+
+
+@override_settings(GAME_HISTORY_PAGE_SIZE=2)
+class GameHistoryTests(ViewTestCase):
+    def setUp(self):
+        super().setUp()
+        self.game.delete()
+        self.finished = [
+            ChessGame.objects.create(
+                player1=self.white, player2=self.black, is_active=False,
+                game_status='white won by checkmate', player1_move_count=i,
+            )
+            for i in range(3)
+        ] + [
+            ChessGame.objects.create(player1=self.black, player2=self.white, is_active=False, game_status='ended'),
+        ]
+        self.url = reverse('game_history')
+
+    def test_pages_follow_the_cursor(self):
+        first = self.client.get(self.url).json()
+        self.assertEqual([game['id'] for game in first['games']], [self.finished[3].id, self.finished[2].id])
+        self.assertEqual(first['next'], self.finished[2].id)
+        self.assertEqual(first['games'][0], {
+            'id': self.finished[3].id, 'opponent': 'black', 'moves': 0, 'outcome': 'Tie',
+            'edit_url': reverse('edit_game', args=[self.finished[3].id]),
+            'delete_url': reverse('delete_game', args=[self.finished[3].id]),
+        })
+        self.assertEqual(first['games'][1]['moves'], 2)
+
+        second = self.client.get(self.url, {'before': first['next']}).json()
+        self.assertEqual([game['id'] for game in second['games']], [self.finished[1].id, self.finished[0].id])
+        self.assertIsNone(second['next'])
+
+    def test_other_players_games_are_left_out(self):
+        self.client.force_login(User.objects.create_user('stranger'))
+        self.assertEqual(self.client.get(self.url).json(), {'games': [], 'next': None})
+
+    def test_home_counts_the_games_only_past_the_first_page(self):
+        self.assertEqual(self.client.get(reverse('home')).context['total_games'], 4)
+        ChessGame.objects.filter(id__in=[game.id for game in self.finished[:2]]).delete()
+        # The session, the user and the page.
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('home'))
+        self.assertEqual((response.context['total_games'], response.context['history_next']), (2, None))
+
+    def test_cursors_must_be_game_ids(self):
+        self.assertEqual(self.client.get(self.url, {'before': 'x'}).status_code, 400)
@@ -8,14 +8,20 @@ urlpatterns = [
     path('logout/', auth_views.LogoutView.as_view(next_page='login'), name='logout'),
     path('', views.home, name='home'),
     path('history/', views.history, name='history'),
+    path('history/games/', views.game_history, name='game_history'),
+    path('history/export/', views.export_games, name='export_games'),
+    path('explorer/', views.explorer, name='explorer'),
     path('rules/', views.rules, name='rules'),
     path('about/', views.about, name='about'),
     path('home/', views.home, name='home'),
     path('game/<int:game_id>/', views.game_view, name='game_view'), 
+    path('game/<int:game_id>/board.svg', views.game_board_svg, name='game_board_svg'),
     path('<int:game_id>/join/', views.join_game, name='join_game'),  
 
     path('edit-game/<int:game_id>/', views.edit_game, name='edit_game'),
     path('delete-game/<int:game_id>/', views.delete_game, name='delete_game'),
     path('game/<int:game_id>/exit/', views.exit_game, name='exit_game'),
+    path('stats/position-cache/', views.position_cache_stats, name='position_cache_stats'),
+    path('metrics', views.metrics, name='metrics'),
 
 ]
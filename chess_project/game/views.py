@@ -2,18 +2,31 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from .forms import RegisterForm
 from django.contrib.sessions.models import Session
-from django.contrib.auth.models import User
-from django.utils import timezone
-from django.http import JsonResponse
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
 from django.db.models import Q
+from django.utils.dateparse import parse_date
+from datetime import datetime, time, timedelta
 import chess
-import chess.svg
-from .models import ChessGame, GameInvite
+from .models import BLACK_WINS, NO_RESULT, WHITE_WINS, ChessGame, GameInvite, GameMove
+from .presence import broadcast, get_presence
 from django.contrib.auth import logout
 from django.views.decorators.cache import cache_control
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.urls import reverse
+from .fanout import send_to_game_sync
+from .live import game_sessions
+from .clocks import stop_clocks
+from .persistence import end_game
+from .positions import position_cache
+from .rendering import board_svg, render_etag, render_key
+from .metrics import registry
+from .exports import FORMATS, export_lines, stream
+from .explorer import explore
+from django.conf import settings
+from asgiref.sync import async_to_sync
 
 
 
@@ -33,35 +46,106 @@ def register(request):
 @cache_control(no_cache=True, must_revalidate=True, no_store=True)
 def home(request):
     if request.user.is_authenticated:
-        active_users = get_active_users(request)
-        user_games = ChessGame.objects.filter(
-            (Q(player1=request.user) | Q(player2=request.user)) & Q(is_active=False)
-        ).order_by('-id')  
-
-        user_games_with_opponents = []
-        for game in user_games:
-            if request.user == game.player1:
-                opponent = game.player2
-                player_move_count = game.player1_move_count
-            else:
-                opponent = game.player1
-                player_move_count = game.player2_move_count
-
-            user_games_with_opponents.append({
-                'game': game,
-                'opponent': opponent,
-                'player_move_count': player_move_count,
-            })
+        # The lobby socket sends the active users; only the history is
+        # rendered here.
+        games, next_before = game_history_page(request.user)
+        # Counted only when the history does not fit on the first page.
+        total_games = len(games) if next_before is None else ChessGame.objects.finished_for(request.user).count()
 
         context = {
-            'active_users': active_users,
-            'user_games_with_opponents': user_games_with_opponents,
+            'total_games': total_games,
+            'user_games_with_opponents': games,
+            'history_next': next_before,
         }
 
         return render(request, 'game_view.html', context)
     else:
         return redirect('login')
 
+def game_history_page(user, before=None):
+    """
+    One page of the user's finished games, newest first, and the cursor of
+    the next page (None on the last one). Pages are keyed on the game id, so
+    a page costs the same however far back it is.
+    """
+    games = ChessGame.objects.history_for(user)
+    if before is not None:
+        games = games.filter(id__lt=before)
+    games = list(games[:settings.GAME_HISTORY_PAGE_SIZE + 1])
+
+    next_before = None
+    if len(games) > settings.GAME_HISTORY_PAGE_SIZE:
+        games = games[:settings.GAME_HISTORY_PAGE_SIZE]
+        next_before = games[-1].id
+
+    return [
+        {
+            'id': game.id,
+            'opponent': game.opponent_username,
+            'moves': game.player_move_count,
+            # game_status is the outcome text, except for games saved as
+            # just 'ended', which carry no winner.
+            'outcome': 'Tie' if game.game_status == 'ended' else game.game_status,
+            'edit_url': reverse('edit_game', args=[game.id]),
+            'delete_url': reverse('delete_game', args=[game.id]),
+        }
+        for game in games
+    ], next_before
+
+@login_required
+def game_history(request):
+    try:
+        before = int(request.GET['before']) if 'before' in request.GET else None
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'before must be a game id.'}, status=400)
+
+    games, next_before = game_history_page(request.user, before)
+    return JsonResponse({'games': games, 'next': next_before})
+
+@login_required
+def export_games(request):
+    """
+    The user's games as PGN (?format=pgn, the default) or NDJSON
+    (?format=ndjson), streamed as they are read. Staff get every game, or
+    one user's with ?user=<username>. ?since= and ?until= (YYYY-MM-DD)
+    keep the games last played on those days or in between.
+    """
+    fmt = request.GET.get('format', 'pgn')
+    if fmt not in FORMATS:
+        return JsonResponse({'status': 'error', 'message': 'format must be pgn or ndjson.'}, status=400)
+
+    bounds = {}
+    for name in ('since', 'until'):
+        if name in request.GET:
+            try:
+                bounds[name] = parse_date(request.GET[name])
+            except ValueError:
+                bounds[name] = None
+            if bounds[name] is None:
+                return JsonResponse({'status': 'error', 'message': f'{name} must be a date, YYYY-MM-DD.'}, status=400)
+
+    if request.user.is_staff:
+        games = ChessGame.objects.all()
+        if 'user' in request.GET:
+            username = request.GET['user']
+            games = games.filter(Q(player1__username=username) | Q(player2__username=username))
+    else:
+        games = ChessGame.objects.filter(Q(player1=request.user) | Q(player2=request.user))
+    if 'since' in bounds:
+        games = games.filter(last_move_at__gte=datetime.combine(bounds['since'], time.min))
+    if 'until' in bounds:
+        games = games.filter(last_move_at__lt=datetime.combine(bounds['until'] + timedelta(days=1), time.min))
+
+    site = request.build_absolute_uri('/').rstrip('/')
+    response = StreamingHttpResponse(
+        stream(export_lines(games, fmt, site, settings.GAME_EXPORT_CHUNK_SIZE)),
+        content_type=FORMATS[fmt],
+    )
+    response['Content-Disposition'] = f'attachment; filename="games.{fmt}"'
+    # Lets nginx pass the export on as it is produced.
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 def history(request):
     return render(request, 'history.html')
 
@@ -71,22 +155,13 @@ def rules(request):
 def about(request):
     return render(request, 'about.html')
 
-def get_active_users(request):
-    active_sessions = Session.objects.filter(expire_date__gte=timezone.now())
-    user_ids = []
-    
-    for session in active_sessions:
-        data = session.get_decoded()
-        user_id = data.get('_auth_user_id')
-        if user_id:
-            user_ids.append(user_id)
-
-    active_game_user_ids = ChessGame.objects.filter(is_active=True).values_list('player1', 'player2')
-    active_game_user_ids = set([player_id for pair in active_game_user_ids for player_id in pair if player_id])
-
-    available_users = User.objects.filter(id__in=user_ids).exclude(id__in=active_game_user_ids)
-
-    return available_users
+def notify_game_ended(game_id, message):
+    # Lets the game's sockets, and the live session they share, know that the
+    # game was ended outside of GameConsumer.
+    send_to_game_sync(game_id, {
+        'type': 'game_status',
+        'message': message,
+    })
 
 @login_required
 def join_game(request, game_id):
@@ -97,42 +172,11 @@ def join_game(request, game_id):
 
     if game.player2 is None and game.is_active:
         game.player2 = request.user
-        game.save()
+        game.save(update_fields=['player2'])
+        broadcast(get_presence().set_busy(game.player1_id, game.player2_id))
 
     return redirect('game_view', game_id=game.id)
 
-@login_required
-@cache_control(no_cache=True, must_revalidate=True, no_store=True)
-def game_view(request, game_id):
-    game = get_object_or_404(ChessGame, id=game_id)
-    board = chess.Board(game.fen)
-
-    user_role = None
-    if request.user == game.player1:
-        user_role = 'white'
-    elif request.user == game.player2:
-        user_role = 'black'
-
-    game_history = ChessGame.objects.filter(
-        (Q(player1=request.user) | Q(player2=request.user)) & Q(is_active=False)
-    )
-
-    if not game.is_active:
-        return redirect('home')
-
-    context = {
-        'game': game,
-        'user_role': user_role,
-        'board_svg': chess.svg.board(board),
-        'current_turn': 'white' if board.turn == chess.WHITE else 'black',
-        'active_users': get_active_users(request),
-        'game_history': game_history,
-    }
-
-    return render(request, 'chessboard.html', context)
-
-
-
 def custom_login(request):
     if request.method == 'POST':
         form = AuthenticationForm(request, data=request.POST)
@@ -140,14 +184,10 @@ def custom_login(request):
             user = form.get_user()
             login(request, user)
 
-            ongoing_game = ChessGame.objects.filter(
-                player1=user, is_active=True
-            ).first() or ChessGame.objects.filter(
-                player2=user, is_active=True
-            ).first()
+            ongoing_game_id = ChessGame.objects.active_for(user).values_list('id', flat=True).first()
 
-            if ongoing_game:
-                return redirect('game_view', game_id=ongoing_game.id)
+            if ongoing_game_id:
+                return redirect('game_view', game_id=ongoing_game_id)
             else:
                 return redirect('home')
     else:
@@ -165,9 +205,12 @@ def custom_logout(request):
 
 
 @login_required
+@cache_control(no_cache=True, must_revalidate=True, no_store=True)
 def game_view(request, game_id):
-    game = get_object_or_404(ChessGame, id=game_id)
-    board = chess.Board(game.fen)
+    game = get_object_or_404(ChessGame.objects.select_related('player1', 'player2'), id=game_id)
+    # The game's worker has the moves not yet written to the row.
+    session = game_sessions.peek(game_id)
+    board = chess.Board(session.shown[1] if session is not None else game.fen)
 
     if board.is_checkmate():
         game_status = f"Checkmate! {'White' if board.turn == chess.BLACK else 'Black'} wins!"
@@ -176,20 +219,70 @@ def game_view(request, game_id):
     else:
         game_status = "active"
 
-    current_turn_username = game.player1.username if board.turn == chess.WHITE else game.player2.username
+    to_move = game.player1 if board.turn == chess.WHITE else game.player2
+    current_turn_username = to_move.username if to_move else "unknown"
+    orientation = 'black' if request.user == game.player2 else 'white'
 
     context = {
         'game': game,
         'current_turn_username': current_turn_username,
         'game_status': game_status,
+        'orientation': orientation,
     }
 
     return render(request, 'chessboard.html', context)
 
 
+@login_required
+def explorer(request):
+    """
+    The moves played from a position in finished games, most played first,
+    with how those games ended. The position is ?fen=, the initial one by
+    default.
+    """
+    try:
+        board = chess.Board(request.GET.get('fen', chess.STARTING_FEN))
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'fen must be a valid FEN.'}, status=400)
+    return JsonResponse({'fen': board.fen(), 'moves': explore(board)})
+
+
+@login_required
+def game_board_svg(request, game_id):
+    """
+    The game's current position as an SVG, with the last move highlighted.
+    Clients revalidate on every load and get a 304 while the position has
+    not changed. nginx sends the request to the game's worker, whose live
+    session has the moves not yet written to the row.
+    """
+    session = game_sessions.peek(game_id)
+    if session is not None:
+        ply, fen, last_move = session.shown
+    else:
+        game = get_object_or_404(ChessGame.objects.only('fen', 'ply'), id=game_id)
+        ply, fen, last_move = game.ply, game.fen, None
+    orientation = chess.BLACK if request.GET.get('orientation') == 'black' else chess.WHITE
+
+    highlight = ()
+    if last_move is None:
+        last_move = GameMove.objects.filter(game_id=game_id, ply=ply).values_list('uci', flat=True).first()
+    if last_move:
+        move = chess.Move.from_uci(last_move)
+        highlight = (move.from_square, move.to_square)
+
+    key = render_key(fen, orientation, highlight)
+    etag = render_etag(key)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(board_svg(fen, orientation, highlight, key=key), content_type='image/svg+xml')
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
 @login_required
 def exit_game(request, game_id):
-    game = get_object_or_404(ChessGame, id=game_id)
+    game = get_object_or_404(ChessGame.objects.select_related('player1', 'player2'), id=game_id)
 
     if request.user == game.player1:
         exited_player = 'player1'
@@ -199,15 +292,35 @@ def exit_game(request, game_id):
         opponent = game.player1.username if game.player1 else None
     else:
         return JsonResponse({'status': 'error', 'message': 'You are not a participant in this game.'})
-    
-    game.is_active = False
-    game.game_status = f'Game ended by {request.user.username}.'
-    game.save()
 
+    if not game.is_active or not async_to_sync(leave_game)(game_id, request.user):
+        return JsonResponse({'status': 'error', 'message': 'This game is over.'})
     return JsonResponse({'status': 'success', 'exited_player': exited_player, 'opponent': opponent})
-    
 
 
+async def leave_game(game_id, user):
+    # Ends the game through its live session, loaded here if no socket of
+    # it is on this worker, so moves not written yet are kept and the
+    # sockets are told. The opponent is credited with the win.
+    try:
+        session = await game_sessions.acquire(game_id)
+    except ChessGame.DoesNotExist:
+        return False
+    try:
+        game = session.game
+        if not game.is_active or session.stale:
+            return False
+        opponent = game.player2 if user.id == game.player1_id else game.player1
+        status = f'Game ended by {user.username}.'
+        result = NO_RESULT
+        if opponent is not None:
+            status += f' {opponent.username} wins!'
+            result = BLACK_WINS if user.id == game.player1_id else WHITE_WINS
+        stop_clocks(session)
+        return await end_game(session, status, result)
+    finally:
+        game_sessions.release(session)
+
 
 @login_required
 def edit_game(request, game_id):
@@ -219,7 +332,7 @@ def edit_game(request, game_id):
     if request.method == 'POST':
         journal_entry = request.POST.get('journal_entry')
         game.journal_entry = journal_entry
-        game.save()
+        game.save(update_fields=['journal_entry'])
         return redirect('home')
     return render(request, 'edit_game.html', {'game': game})
 
@@ -229,7 +342,33 @@ def delete_game(request, game_id):
     game = get_object_or_404(ChessGame, id=game_id)
     
     if request.user == game.player1 or request.user == game.player2:
+        if game.is_active:
+            broadcast(get_presence().set_available(game.player1_id, game.player2_id))
+            notify_game_ended(game.id, 'This game was deleted.')
         game.delete()
         return redirect(f'{reverse("home")}?deleted=1')
     else:
         return redirect('home')
+
+
+@staff_member_required
+def position_cache_stats(request):
+    # Counters of this worker's position cache, for sizing POSITION_CACHE_SIZE.
+    return JsonResponse(position_cache.stats())
+
+
+def client_address(request):
+    # Behind nginx every request comes from 127.0.0.1. nginx appends the
+    # address it was connected from to X-Forwarded-For, so only the last
+    # entry can be trusted; requests made to a worker directly have none.
+    forwarded = request.META.get('HTTP_X_FORWARDED_FOR')
+    if forwarded:
+        return forwarded.rsplit(',', 1)[-1].strip()
+    return request.META.get('REMOTE_ADDR')
+
+
+def metrics(request):
+    """This worker's metrics in the Prometheus text format, for scrapers on METRICS_ALLOWED_IPS and staff."""
+    if client_address(request) not in settings.METRICS_ALLOWED_IPS and not request.user.is_staff:
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')